@@ -0,0 +1,138 @@
+"""
+Instructions and operands of the generated assembly.
+
+Code generation emits Instruction and Label objects into the Emitter, which renders them to NASM text once, when the
+function is flushed. Until then passes over the code of a function match on opcodes and operands instead of text.
+Operands compare by value, so Register('eax') == EAX.
+
+    Instruction('mov', EAX, Memory('rbp', -4, 4))   renders as   mov eax, DWORD [rbp-4]
+"""
+
+
+class Register:
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return 'Register({!r})'.format(self.name)
+
+    def __eq__(self, other):
+        return isinstance(other, Register) and self.name == other.name
+
+    def __hash__(self):
+        return hash(self.name)
+
+
+class Memory:
+    """
+    [base+offset], size is 4 or 8 for DWORD and QWORD, None where the other operand gives it.
+    """
+    __slots__ = ('base', 'offset', 'size')
+
+    PREFIXES = {None: '', 4: 'DWORD ', 8: 'QWORD '}
+
+    def __init__(self, base, offset=0, size=None):
+        self.base = base
+        self.offset = offset
+        self.size = size
+
+    def __str__(self):
+        if self.offset:
+            return '{}[{}{:+d}]'.format(self.PREFIXES[self.size], self.base, self.offset)
+        return '{}[{}]'.format(self.PREFIXES[self.size], self.base)
+
+    def __repr__(self):
+        return 'Memory({!r}, {!r}, {!r})'.format(self.base, self.offset, self.size)
+
+    def __eq__(self, other):
+        return isinstance(other, Memory) and (self.base, self.offset, self.size) == (other.base, other.offset,
+                                                                                      other.size)
+
+    def __hash__(self):
+        return hash((self.base, self.offset, self.size))
+
+
+class Immediate:
+    """
+    Constant operand, a number or the name of a data label (string literals, vtables).
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return str(self.value)
+
+    def __repr__(self):
+        return 'Immediate({!r})'.format(self.value)
+
+    def __eq__(self, other):
+        return isinstance(other, Immediate) and self.value == other.value
+
+    def __hash__(self):
+        return hash(self.value)
+
+
+class Label:
+    """
+    Code label, the operand of jumps and calls; emitted on its own it marks its position.
+    """
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return 'Label({!r})'.format(self.name)
+
+    def __eq__(self, other):
+        return isinstance(other, Label) and self.name == other.name
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def render(self):
+        return self.name + ':'
+
+
+class Instruction:
+    __slots__ = ('opcode', 'operands')
+
+    def __init__(self, opcode, *operands):
+        self.opcode = opcode
+        self.operands = operands
+
+    def __repr__(self):
+        return 'Instruction({})'.format(', '.join(map(repr, (self.opcode,) + self.operands)))
+
+    def __eq__(self, other):
+        return isinstance(other, Instruction) and self.opcode == other.opcode and self.operands == other.operands
+
+    def __hash__(self):
+        return hash((self.opcode, self.operands))
+
+    def render(self):
+        if not self.operands:
+            return self.opcode
+        return '{} {}'.format(self.opcode, ', '.join(map(str, self.operands)))
+
+
+def render(line):
+    """
+    :return: text of an Instruction or Label; strings (directives, data, code rendered before) are kept as they are
+    """
+    return line if isinstance(line, str) else line.render()
+
+
+EAX, EBX, EDX, EDI = Register('eax'), Register('ebx'), Register('edx'), Register('edi')
+RAX, RBX, RDX, RDI = Register('rax'), Register('rbx'), Register('rdx'), Register('rdi')
+RSP, RBP, R12, R13, R14 = Register('rsp'), Register('rbp'), Register('r12'), Register('r13'), Register('r14')
@@ -0,0 +1,146 @@
+"""
+On-disk cache of the assembly of single functions and methods, for incremental compilation.
+
+An entry is found by a hash of the function's source text (so edits elsewhere in the file do not matter), the class of
+a method and the sources of the compiler, parsers included. It is used only if it was compiled at the same optimization
+level by the same backend and the functions and classes the function looked up while it was checked (the env['fun']
+and env['cls'] entries) still have the same signatures, layouts and vtables; otherwise the function is checked and
+compiled again and the entry is replaced. String labels are numbered for the whole program, so they are stored by
+literal and renamed to the labels of the current program.
+"""
+import bisect
+import functools
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# every module the AST and the code depend on: the grammar and transformer, the hand-written parser, the node classes
+# and the code generators
+COMPILER_SOURCES = ['grammar_test.py', 'fast_parser.py', 'compiler.py', 'expr.py', 'oprt.py', 'stmt.py', 'type.py',
+                    'regalloc.py', 'ir.py', 'asm.py', 'peephole.py', 'fold.py', 'asm_cache.py']
+
+STRING_LABEL = re.compile(r'\bS\d+\b')
+
+
+@functools.lru_cache(maxsize=None)
+def compiler_version():
+    digest = hashlib.sha1()
+    for name in COMPILER_SOURCES:
+        with open(os.path.join(ROOT, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def source_spans(program, text):
+    """
+    Classes have no position, so the text of a function or method runs from its start to the start of the next one
+    (or the end of the file). It may take in a class header or attributes; editing those only costs a miss.
+    :return: list of (class or None, FunDef, source text) of program.units()
+    """
+    line_starts = [0] + [match.end() for match in re.finditer('\n', text)]
+    units = program.units()
+    starts = [line_starts[fun.line - 1] + fun.column - 1 for _, fun in units]
+    boundaries = sorted(starts) + [len(text)]
+    return [(cls, fun, text[start:boundaries[bisect.bisect_right(boundaries, start)]].rstrip())
+            for (cls, fun), start in zip(units, starts)]
+
+
+def function_fingerprint(fun):
+    """
+    :param fun: env['fun'] entry or None if there is no such function
+    """
+    if fun is None:
+        return None
+    return [repr(fun['type']), [repr(arg[0]) for arg in fun['args'].args]]
+
+
+def class_fingerprint(cls):
+    """
+    Everything code outside the class can see: ancestors, object layout, vtable and method signatures.
+    :param cls: ClassDef with built tables or None if there is no such class
+    """
+    if cls is None:
+        return None
+    return [
+        sorted(cls.ancestors),
+        cls.size,
+        sorted([name, repr(attr.type), cls.attr_offsets[name]] for name, attr in cls.attributes.items()),
+        [[name, cls.method_impls[name]] for name in cls.vtable],
+        sorted([name, repr(method.type), [repr(arg[0]) for arg in method.args.args]]
+               for name, method in cls.methods_by_name.items()),
+    ]
+
+
+class AsmCache:
+    """
+    index(program, text) has to be called with the source of a parsed program before
+    Program.check_correctness(cache=...) looks its functions up with load and stores the ones it had to compile with
+    store. hits and misses count the lookups.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.version = compiler_version()
+        self.hits = 0
+        self.misses = 0
+        self.paths = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def index(self, program, text):
+        for cls, fun, source in source_spans(program, text):
+            key = repr((self.version, cls.name if cls is not None else None, source))
+            self.paths[id(fun)] = os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    @staticmethod
+    def dependencies(env, functions, classes):
+        return json.dumps({
+            'optimize': env['optimize'],
+            'backend': env['backend'],
+            'fun': {name: function_fingerprint(env['fun'].get(name)) for name in sorted(functions)},
+            'cls': {name: class_fingerprint(env['cls'].get(name)) for name in sorted(classes)},
+        }, sort_keys=True)
+
+    def load(self, env, cls, fun):
+        """
+        :return: assembly of the function, None if it is not cached or something it depends on changed
+        """
+        try:
+            with open(self.paths[id(fun)]) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            entry = None
+
+        if entry is None or self.dependencies(env, entry['fun'], entry['cls']) != entry['dependencies']:
+            self.misses += 1
+            return None
+        self.hits += 1
+
+        labels = env['strings'].labels
+        renames = {old: labels[literal] for literal, old in entry['strings'] if labels[literal] != old}
+        if not renames:
+            return entry['code']
+        return STRING_LABEL.sub(lambda m: renames.get(m.group(), m.group()), entry['code'])
+
+    def store(self, env, cls, fun, code, functions, classes, literals):
+        """
+        :param code: assembly of the function
+        :param functions: names looked up in env['fun'] while checking the function
+        :param classes: names looked up in env['cls']
+        :param literals: string literals the code refers to, collected by the process that folded and compiled it
+        """
+        entry = {
+            'fun': sorted(functions),
+            'cls': sorted(classes),
+            'dependencies': self.dependencies(env, functions, classes),
+            'strings': [[literal, env['strings'].labels[literal]] for literal in literals],
+            'code': code,
+        }
+        # written under a temporary name first, concurrent compilations never read half of an entry
+        fd, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.replace(temporary, self.paths[id(fun)])
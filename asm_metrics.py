@@ -0,0 +1,238 @@
+"""
+Static metrics of the generated assembly, for every function and method, to follow the quality of the code without
+running it.
+
+Usage: python asm_metrics.py report PATH... [--json FILE] [--parser lark|fast] [-j N]
+       python asm_metrics.py diff OLD.json NEW.json [--fail-on-increase METRIC...]
+       python asm_metrics.py peephole PATH... [--parser lark|fast] [--backend ast|ir]
+
+report compiles .lat files with the current compiler (directories are searched for them recursively, programs the
+compiler rejects are skipped) or reads .s files as they are, so builds of older compilers can be measured too. For
+every top_* and cls_* label it counts instructions, push/pop pairs, memory operands and calls, and takes the stack
+frame size from the prologue (FunDef.stack_counter) and the bytes of the string literals the function refers to.
+Functions are named by the path of the file relative to the directory given on the command line, without extension,
+and the label, so reports of two builds of a corpus can be compared with diff. diff lists what changed per function
+and in total; with --fail-on-increase it exits with 1 when the total of one of the given metrics grew. peephole
+compiles the .lat files at -O1 in one process and prints how many times every rule of peephole.py fired.
+"""
+import argparse
+import glob
+import io
+import json
+import os
+import re
+import sys
+
+METRICS = ('instructions', 'push_pop_pairs', 'memory_operands', 'calls', 'stack_frame', 'string_bytes')
+
+FUNCTION_LABEL = re.compile(r'^((?:top|cls)_\w+):$')
+# compilers before the string pool named literals L1, L2, ... like jump labels and wrote one hex number per byte
+STRING_DATA = re.compile(r'^([SL]\d+) db (.*)$')
+STRING_ALIAS = re.compile(r'^(S\d+) equ (S\d+)\+(\d+)$')
+STRING_LABEL = re.compile(r'\b[SL]\d+\b')
+DB_OPERAND = re.compile(r"'[^']*'|0x[0-9a-f]+|\d+")
+PROLOGUE = ['push rbp', 'mov rbp, rsp']
+FRAME = re.compile(r'^add rsp, (-?\d+)$')
+
+
+def string_sizes(lines):
+    """
+    :return: bytes of every string label of the data section, with the terminating zero
+    """
+    sizes = {}
+    aliases = []
+    for line in lines:
+        match = STRING_DATA.match(line)
+        if match:
+            sizes[match.group(1)] = sum(len(part) - 2 if part.startswith("'") else 1
+                                        for part in DB_OPERAND.findall(match.group(2)))
+            continue
+        match = STRING_ALIAS.match(line)
+        if match:
+            aliases.append(match.groups())
+    for label, host, offset in aliases:
+        sizes[label] = sizes[host] - int(offset)
+    return sizes
+
+
+def function_metrics(asm):
+    """
+    :param asm: assembly written by the compiler
+    :return: dict from the label of every function and method to its metrics
+    """
+    lines = [line.strip() for line in asm.split('\n')]
+    sizes = string_sizes(lines)
+
+    functions = {}
+    code = None
+    for line in lines:
+        match = FUNCTION_LABEL.match(line)
+        if match:
+            code = functions[match.group(1)] = []
+        elif line.startswith('section '):
+            code = None
+        elif code is not None and line and not line.endswith(':'):
+            code.append(line)
+
+    result = {}
+    for name, code in functions.items():
+        mnemonics = [line.split(None, 1)[0] for line in code]
+        operands = [operand for line in code if ' ' in line for operand in line.split(None, 1)[1].split(',')]
+        frame = FRAME.match(code[2]) if code[:2] == PROLOGUE and len(code) > 2 else None
+        strings = {label for line in code for label in STRING_LABEL.findall(line)}
+        result[name] = {
+            'instructions': len(code),
+            'push_pop_pairs': min(mnemonics.count('push'), mnemonics.count('pop')),
+            'memory_operands': sum(1 for operand in operands if '[' in operand),
+            'calls': mnemonics.count('call'),
+            'stack_frame': -int(frame.group(1)) if frame else 0,
+            'string_bytes': sum(sizes.get(label, 0) for label in strings),
+        }
+    return result
+
+
+def find_sources(paths):
+    """
+    :return: list of (name prefix, path) of .lat and .s files
+    """
+    sources = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(glob.glob(os.path.join(path, '**', '*.lat'), recursive=True)):
+                sources.append((os.path.splitext(os.path.relpath(name, path))[0], name))
+        else:
+            sources.append((os.path.splitext(os.path.basename(path))[0], path))
+    return sources
+
+
+def report(paths, parser='lark', jobs=1):
+    """
+    :return: dict with the metrics of every function, their totals and the names of skipped files
+    """
+    import grammar_test
+
+    sources = find_sources(paths)
+    texts = []
+    for _, path in sources:
+        with open(path) as f:
+            texts.append(f.read())
+
+    lat = [index for index, (_, path) in enumerate(sources) if path.endswith('.lat')]
+    results = grammar_test.compile_sources([texts[index] for index in lat], grammar_test.CompileOptions(parser, jobs))
+    skipped = []
+    for index, result in zip(lat, results):
+        texts[index] = result.asm
+        if not result.ok:
+            skipped.append(sources[index][1])
+
+    functions = {}
+    for (prefix, _), asm in zip(sources, texts):
+        if asm is not None:
+            for name, metrics in function_metrics(asm).items():
+                functions[prefix + ':' + name] = metrics
+    totals = {metric: sum(metrics[metric] for metrics in functions.values()) for metric in METRICS}
+    return {'functions': functions, 'totals': totals, 'skipped': skipped}
+
+
+def peephole_hits(paths, parser='lark', backend='ast'):
+    """
+    :return: dict from every peephole rule to its replacements in the .lat files, and the skipped files
+    """
+    import grammar_test
+
+    parser = grammar_test.get_parser(kind=parser)
+    hits = {}
+    skipped = []
+    for _, path in find_sources(paths):
+        if not path.endswith('.lat'):
+            continue
+        with open(path) as f:
+            text = f.read()
+        try:
+            program = grammar_test.check_program(text, parser, backend=backend)
+        except grammar_test.SYNTAX_ERRORS + (grammar_test.CompilerException,):
+            skipped.append(path)
+            continue
+        out = grammar_test.Emitter(io.StringIO())
+        program.compile(out)
+        for rule, count in out.peephole_hits.items():
+            hits[rule] = hits.get(rule, 0) + count
+    return hits, skipped
+
+
+def diff(old, new):
+    """
+    :return: lines describing the changes from report old to report new
+    """
+    lines = []
+    for name in sorted(set(old['functions']) | set(new['functions'])):
+        before, after = old['functions'].get(name), new['functions'].get(name)
+        if before is None or after is None:
+            lines.append('{} {}'.format('added' if before is None else 'removed', name))
+            continue
+        changes = ['{} {} -> {}'.format(metric, before[metric], after[metric])
+                   for metric in METRICS if before[metric] != after[metric]]
+        if changes:
+            lines.append('{}: {}'.format(name, ', '.join(changes)))
+    for metric in METRICS:
+        before, after = old['totals'][metric], new['totals'][metric]
+        change = '{:+.2%}'.format((after - before) / before) if before else ''
+        lines.append('total {:16s} {:10d} -> {:10d} {}'.format(metric, before, after, change))
+    return lines
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Static metrics of the generated assembly')
+    commands = arg_parser.add_subparsers(dest='command', required=True)
+    report_parser = commands.add_parser('report', help='measure .lat or .s files')
+    report_parser.add_argument('paths', nargs='+', help='.lat or .s files, directories with .lat files')
+    report_parser.add_argument('--json', metavar='FILE', help='write the report as JSON')
+    report_parser.add_argument('--parser', choices=['lark', 'fast'], default='lark', help='front end of the compiler')
+    report_parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+    diff_parser = commands.add_parser('diff', help='compare two JSON reports')
+    diff_parser.add_argument('old')
+    diff_parser.add_argument('new')
+    diff_parser.add_argument('--fail-on-increase', nargs='*', choices=METRICS, default=[], metavar='METRIC',
+                             help='exit with 1 if the total of a metric grew, one of ' + ', '.join(METRICS))
+    peephole_parser = commands.add_parser('peephole', help='count the replacements of the peephole rules')
+    peephole_parser.add_argument('paths', nargs='+', help='.lat files, directories with .lat files')
+    peephole_parser.add_argument('--parser', choices=['lark', 'fast'], default='lark', help='front end of the compiler')
+    peephole_parser.add_argument('--backend', choices=['ast', 'ir'], default='ast', help='code generator')
+    options = arg_parser.parse_args()
+
+    if options.command == 'report':
+        result = report(options.paths, options.parser, options.jobs)
+        for path in result['skipped']:
+            print('skipped', path)
+        print('{:40s} {}'.format('function', ' '.join('{:>15s}'.format(metric) for metric in METRICS)))
+        for name, metrics in sorted(result['functions'].items()):
+            print('{:40s} {}'.format(name, ' '.join('{:15d}'.format(metrics[metric]) for metric in METRICS)))
+        print('{:40s} {}'.format('total', ' '.join('{:15d}'.format(result['totals'][m]) for m in METRICS)))
+        if options.json:
+            with open(options.json, 'w') as f:
+                json.dump(result, f, indent=2, sort_keys=True)
+        return 0
+
+    if options.command == 'peephole':
+        hits, skipped = peephole_hits(options.paths, options.parser, options.backend)
+        for path in skipped:
+            print('skipped', path)
+        for rule, count in sorted(hits.items(), key=lambda item: -item[1]):
+            print('{:20s} {:8d}'.format(rule, count))
+        return 0
+
+    with open(options.old) as f:
+        old = json.load(f)
+    with open(options.new) as f:
+        new = json.load(f)
+    for line in diff(old, new):
+        print(line)
+    grown = [metric for metric in options.fail_on_increase if new['totals'][metric] > old['totals'][metric]]
+    if grown:
+        print('FAILED: {} grew'.format(', '.join(grown)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,303 @@
+"""
+Performance regression benchmarks of the compiler.
+
+Usage: python benchmark.py BENCHMARK [options]
+
+Every benchmark generates its own Latte input, so nothing besides the compiler is needed to run them; regalloc also
+runs the generated program when nasm and gcc are installed.
+"""
+import argparse
+import gc
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import asm_cache
+import asm_metrics
+import grammar_test
+import latc
+
+
+def parse(source, kind='lark'):
+    return grammar_test.get_parser(kind=kind).parse(source)
+
+
+def chain_program(terms):
+    ints = ' + '.join('i' for _ in range(terms))
+    strings = ' + '.join('s' for _ in range(terms))
+    return """
+    int main() {{
+        int i = 1;
+        string s = "a";
+        int x = {};
+        string y = {};
+        return 0;
+    }}
+    """.format(ints, strings)
+
+
+def bench_typecheck(options):
+    """
+    Type checking of long left-nested + chains. Every node has to be checked once, so time should grow linearly
+    with the number of terms.
+    """
+    results = []
+    for terms in [options.terms // 4, options.terms // 2, options.terms]:
+        program = parse(chain_program(terms), options.parser)
+        start = time.perf_counter()
+        program.check_correctness()
+        elapsed = time.perf_counter() - start
+        results.append((terms, elapsed))
+        print('{:6d} terms: {:.4f}s'.format(terms, elapsed))
+
+    (small_terms, small_time), (big_terms, big_time) = results[0], results[-1]
+    ratio = big_time / small_time
+    print('time ratio {:.2f} for {:.0f}x more terms'.format(ratio, big_terms / small_terms))
+    # generous bound, quadratic or exponential growth is far above it
+    return ratio < 2 * big_terms / small_terms
+
+
+def big_program(functions, statements):
+    result = []
+    for i in range(functions):
+        body = ['int a = {};'.format(i), 'string s = "f{}";'.format(i)]
+        for j in range(statements):
+            body.append('if (a < {0}) {{ a = a * 2 + {0} - b{1}(a); }} else {{ s = s + "x"; a--; }}'.format(j, i))
+        body.append('return a;')
+        result.append('int b{}(int x) {{\n  {}\n}}'.format(i, '\n  '.join(body)))
+    result.append('int main() { return b0(1); }')
+    return '\n'.join(result)
+
+
+def bench_memory(options):
+    """
+    Memory of the front end on a large generated program: the AST is built while parsing, so the peak of parsing
+    should stay close to the size of the AST. Code generation streams to the output function by function, so its
+    peak over the checked AST should stay around the size of one function.
+    """
+    source = big_program(options.functions, options.statements)
+    parser = grammar_test.get_parser(kind=options.parser)
+    gc.collect()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    program = parser.parse(source)
+    parse_time = time.perf_counter() - start
+    ast_size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    program.check_correctness()
+    with open(os.devnull, 'w') as devnull:
+        gc.collect()
+        tracemalloc.start()
+        checked_size = tracemalloc.get_traced_memory()[0]
+        program.compile(grammar_test.Emitter(devnull))
+        codegen_peak = tracemalloc.get_traced_memory()[1] - checked_size
+        tracemalloc.stop()
+
+    print('source:          {:8.1f} KiB'.format(len(source) / 1024))
+    print('parse time:      {:8.2f} s'.format(parse_time))
+    print('AST:             {:8.1f} MiB'.format(ast_size / 2 ** 20))
+    print('peak:            {:8.1f} MiB'.format(peak / 2 ** 20))
+    print('codegen peak:    {:8.1f} MiB'.format(codegen_peak / 2 ** 20))
+    return program is not None
+
+
+def deep_programs(depth):
+    blocks = '{' * depth + 'x++;' + '}' * depth
+    else_ifs = ' else '.join('if (x == {0}) x = {0};'.format(i) for i in range(depth))
+    operands = ' + '.join('x' for _ in range(depth))
+    conditions = ' && '.join('x < {}'.format(i) for i in range(depth))
+    negations = '-(' * depth + 'x' + ')' * depth
+    body = {
+        'blocks': blocks,
+        'else if': else_ifs,
+        'operands': 'x = {};'.format(operands),
+        'conditions': 'if ({}) x++;'.format(conditions),
+        'negations': 'x = {};'.format(negations),
+    }
+    return {name: 'int main() {{ int x = 0; {} return x; }}'.format(stmts) for name, stmts in body.items()}
+
+
+def bench_deep(options):
+    """
+    Checking and code generation of deeply nested programs (blocks, else if chains, long operand chains) under the
+    default recursion limit. The tree walks keep their own stack, so only the parser sees the depth.
+    """
+    ok = True
+    parser = grammar_test.get_parser(kind=options.parser)
+    for name, source in deep_programs(options.depth).items():
+        start = time.perf_counter()
+        try:
+            asm = grammar_test.compile_program(source, parser, backend=options.backend)
+        except RecursionError:
+            print('{:10s} RecursionError'.format(name))
+            ok = False
+            continue
+        print('{:10s} {:.4f}s, {} lines of assembly'.format(name, time.perf_counter() - start, asm.count('\n')))
+    return ok
+
+
+def bench_parallel(options):
+    """
+    Serial checking and code generation against a pool of --jobs processes on a large generated program. The output
+    has to be byte-identical.
+    """
+    source = big_program(options.functions, options.statements)
+    parser = grammar_test.get_parser(kind=options.parser)
+    results = {}
+    for jobs in [1, options.jobs]:
+        start = time.perf_counter()
+        results[jobs] = grammar_test.compile_program(source, parser, jobs, backend=options.backend)
+        print('-j {:<3d} {:.4f}s'.format(jobs, time.perf_counter() - start))
+    return results[1] == results[options.jobs]
+
+
+def bench_parsers(options):
+    """
+    The lark grammar against the hand-written parser on a large generated program, with and without a comment on
+    every line. Both have to build the same AST, positions included.
+    """
+    source = big_program(options.functions, options.statements)
+    sources = {'plain': source, 'comments': '/* generated\n */\n' + source.replace(';', '; // comment\n')}
+    ok = True
+    for name, text in sources.items():
+        results = {}
+        for kind in grammar_test.PARSERS:
+            parser = grammar_test.get_parser(kind=kind)
+            start = time.perf_counter()
+            program = parser.parse(text)
+            print('{:8s} {:4s} {:8.4f}s'.format(name, kind, time.perf_counter() - start))
+            results[kind] = repr(program)
+        ok = ok and results['lark'] == results['fast']
+    return ok
+
+
+def bench_incremental(options):
+    """
+    Recompilation of a large generated program after one function was edited, with the per-function assembly cache
+    filled by the previous compilation. Only the edited function should be checked and compiled again and the output
+    has to be the same as without the cache.
+    """
+    source = big_program(options.functions, options.statements)
+    edited = source.replace('int a = 1;', 'int a = 1 + 1;', 1)
+    parser = grammar_test.get_parser(kind=options.parser)
+    directory = tempfile.mkdtemp()
+    try:
+        for name, text in [('cold', source), ('warm', source), ('edited', edited)]:
+            cache = asm_cache.AsmCache(directory)
+            start = time.perf_counter()
+            asm = grammar_test.compile_program(text, parser, cache=cache)
+            print('{:8s} {:8.4f}s, {} hits, {} misses'.format(name, time.perf_counter() - start, cache.hits,
+                                                              cache.misses))
+        start = time.perf_counter()
+        expected = grammar_test.compile_program(edited, parser)
+        print('{:8s} {:8.4f}s'.format('no cache', time.perf_counter() - start))
+        return asm == expected and cache.misses == 1
+    finally:
+        shutil.rmtree(directory)
+
+
+def loop_program(iterations):
+    return """
+    int work(int n, int modulus) {{
+        int sum = 0;
+        int i = 0;
+        while (i < n) {{
+            int j = 0;
+            while (j < 100) {{
+                sum = sum + i * j - (j + 3);
+                if (sum > modulus) {{
+                    sum = sum - modulus;
+                }}
+                j++;
+            }}
+            i++;
+        }}
+        return sum;
+    }}
+
+    int main() {{
+        printInt(work({}, 1000007));
+        return 0;
+    }}
+    """.format(iterations)
+
+
+def bench_regalloc(options):
+    """
+    Nested loops compiled with -O0, every variable on the stack, and -O1, variables in registers (regalloc.py).
+    Compares static metrics of the loop function and, with nasm and gcc installed, the run time of the programs,
+    which have to print the same.
+    """
+    source = loop_program(options.iterations)
+    metrics = {}
+    for optimize in [0, 1]:
+        asm = grammar_test.compile_program(source, grammar_test.get_parser(kind=options.parser), optimize=optimize)
+        metrics[optimize] = asm_metrics.function_metrics(asm)['top_work']
+        print('-O{} {}'.format(optimize, ', '.join('{} {}'.format(metric, metrics[optimize][metric])
+                                                 for metric in ('instructions', 'push_pop_pairs', 'memory_operands'))))
+    ok = metrics[1]['memory_operands'] < metrics[0]['memory_operands']
+
+    if shutil.which(latc.NASM[0]) is None or shutil.which(latc.LINK[0]) is None:
+        print('nasm or gcc not found, run time not measured')
+        return ok
+
+    directory = tempfile.mkdtemp()
+    try:
+        outputs, times = {}, {}
+        for optimize in [0, 1]:
+            executable = os.path.join(directory, 'O{}'.format(optimize))
+            latc.build_executable(source, executable, latc.ArtifactCache(os.path.join(directory, 'cache')),
+                                  options.parser, optimize=optimize)
+            times[optimize] = float('inf')
+            for _ in range(3):
+                start = time.perf_counter()
+                outputs[optimize] = subprocess.run([executable], stdout=subprocess.PIPE, check=True).stdout
+                times[optimize] = min(times[optimize], time.perf_counter() - start)
+            print('-O{} run {:.4f}s'.format(optimize, times[optimize]))
+        print('speedup {:.2f}x'.format(times[0] / times[1]))
+        return ok and outputs[0] == outputs[1] and times[1] < times[0]
+    finally:
+        shutil.rmtree(directory)
+
+
+BENCHMARKS = {
+    'deep': bench_deep,
+    'incremental': bench_incremental,
+    'memory': bench_memory,
+    'parallel': bench_parallel,
+    'parsers': bench_parsers,
+    'regalloc': bench_regalloc,
+    'typecheck': bench_typecheck,
+}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Latte compiler benchmarks')
+    arg_parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    arg_parser.add_argument('--terms', type=int, default=200, help='length of generated expressions')
+    arg_parser.add_argument('--functions', type=int, default=200, help='number of functions in generated programs')
+    arg_parser.add_argument('--statements', type=int, default=50, help='number of statements in generated functions')
+    arg_parser.add_argument('--depth', type=int, default=10000, help='nesting depth of generated programs')
+    arg_parser.add_argument('--iterations', type=int, default=300000, help='outer loop runs of regalloc')
+    arg_parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='processes of the parallel benchmark')
+    arg_parser.add_argument('--parser', choices=grammar_test.PARSERS, default='lark', help='front end to benchmark')
+    arg_parser.add_argument('--backend', choices=['ast', 'ir'], default='ast',
+                            help='code generator of deep and parallel')
+    options = arg_parser.parse_args()
+
+    if options.benchmark != 'deep':
+        sys.setrecursionlimit(10000)
+    if not BENCHMARKS[options.benchmark](options):
+        print('FAILED')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
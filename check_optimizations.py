@@ -0,0 +1,337 @@
+"""
+Behaviour checks of the optimizations of -O1, on small inputs whose expected result is written next to them.
+
+Usage: python check_optimizations.py [CHECK...] [--parser lark|fast]
+
+peephole runs every rule of peephole.py on a window it has to rewrite and on a similar one it has to keep. regalloc
+compiles a function whose locals live across a call of a function that uses the caller-saved registers: they have to
+stay in registers, saved around the call or callee-saved. fold declares a local initialized with an expression and
+looks at what fold.py left of it: integer arithmetic wraps to 32 bits, divisions idiv traps on and comparisons of
+strings, which compare addresses, stay, and locals are propagated only while nothing assigns them; a constant
+condition computed by an operator does not make a branch count as returning, at any level. With nasm and gcc
+installed, regalloc and fold also run their programs, which have to print the same at -O0 and -O1. cache compiles a
+folded concatenation with -j 2 into an asm_cache.AsmCache, then the program with more literals before it, which
+renumbers the labels: the cached function has to refer to the folded string. The exit status is 1 when a check fails.
+"""
+import argparse
+import functools
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import asm
+import asm_cache
+import compiler
+import fold
+import grammar_test
+import latc
+import peephole
+from asm import EAX, EBX, Immediate, Instruction, Label, Memory, RAX, RBX, RSP
+
+
+def run_peephole(lines):
+    """
+    :return: rendered lines after peephole.optimize and the rules that fired
+    """
+    hits = dict.fromkeys(peephole.RULE_NAMES, 0)
+    result = peephole.optimize(lines, hits)
+    return [asm.render(line) for line in result], {name for name, count in hits.items() if count}
+
+
+def peephole_cases():
+    """
+    :return: list of (rule, code, expected code), expected is None where the code has to stay as it is
+    """
+    local, other = Memory('rbp', -4, 4), Memory('rbp', -8, 4)
+    first, second = Label('.L1'), Label('.L2')
+    return [
+        ('push_pop', [Instruction('push', RBX), Instruction('pop', RBX)], []),
+        ('push_pop', [Instruction('push', RBX), Instruction('pop', RAX)], None),
+        ('pop_push', [Instruction('pop', RAX), Instruction('push', RAX)], ['mov rax, QWORD [rsp]']),
+        ('pop_push', [Instruction('pop', RAX), Instruction('push', RBX)], None),
+        ('memory_self_copy', [Instruction('push', RAX), Instruction('mov', EAX, local), Instruction('mov', local, EAX),
+                              Instruction('pop', RAX)], []),
+        ('memory_self_copy', [Instruction('push', RAX), Instruction('mov', EBX, local), Instruction('mov', local, EBX),
+                              Instruction('pop', RAX)], None),
+        ('memory_self_copy', [Instruction('push', RAX), Instruction('mov', EAX, local), Instruction('mov', other, EAX),
+                              Instruction('pop', RAX)], None),
+        ('self_move', [Instruction('mov', RAX, RAX)], []),
+        ('self_move', [Instruction('mov', EAX, EAX)], None),
+        ('jump_to_next', [Instruction('jmp', first), first], ['.L1:']),
+        ('jump_to_next', [Instruction('jmp', second), first], None),
+        ('branch_over_jump', [Instruction('je', first), Instruction('jmp', second), first], ['jne .L2', '.L1:']),
+        ('branch_over_jump', [Instruction('je', second), Instruction('jmp', second), first], None),
+        ('compare_zero', [Instruction('cmp', EAX, Immediate(0))], ['test eax, eax']),
+        ('compare_zero', [Instruction('cmp', local, Immediate(0))], None),
+        ('add_zero', [Instruction('sub', RSP, Immediate(0)), Instruction('mov', EAX, local)],
+         ['mov eax, DWORD [rbp-4]']),
+        ('add_zero', [Instruction('add', EAX, Immediate(0)), Instruction('je', first)], None),
+    ]
+
+
+def check_peephole(options):
+    """
+    :return: list of (description, passed)
+    """
+    results = []
+    for rule, lines, expected in peephole_cases():
+        code = [asm.render(line) for line in lines]
+        result, fired = run_peephole(lines)
+        if expected is None:
+            results.append(('{} keeps {}'.format(rule, ' / '.join(code)), result == code and not fired))
+        else:
+            results.append(('{} rewrites {}'.format(rule, ' / '.join(code)), result == expected and fired == {rule}))
+    return results
+
+
+@functools.lru_cache(maxsize=None)
+def tools_found():
+    if shutil.which(latc.NASM[0]) is None or shutil.which(latc.LINK[0]) is None:
+        print('nasm or gcc not found, programs are not run')
+        return False
+    return True
+
+
+def run_program(source, parser):
+    """
+    :return: dict from optimization level to the output of the program, None without nasm or gcc
+    """
+    if not tools_found():
+        return None
+    directory = tempfile.mkdtemp()
+    try:
+        outputs = {}
+        for optimize in [0, 1]:
+            executable = os.path.join(directory, 'O{}'.format(optimize))
+            latc.build_executable(source, executable, latc.ArtifactCache(os.path.join(directory, 'cache')), parser,
+                                  optimize=optimize)
+            outputs[optimize] = subprocess.run([executable], stdout=subprocess.PIPE, check=True).stdout
+        return outputs
+    finally:
+        shutil.rmtree(directory)
+
+
+CALL_PROGRAM = """
+int f(int x) {
+    int a = x * 3;
+    int b = a + x;
+    return a + b;
+}
+
+int g(int x, int y) {
+    int product = x * y;
+    int sum = x + y;
+    int z = f(x);
+    return product + sum + z;
+}
+
+int main() {
+    printInt(g(5, 7));
+    return 0;
+}
+"""
+
+
+def function_code(text, label):
+    """
+    :return: lines of the function at label in the assembly
+    """
+    lines = text.split('\n')
+    start = lines.index(label + ':') + 1
+    end = lines.index('ret', start)
+    return lines[start:end + 1]
+
+
+def check_regalloc(options):
+    """
+    :return: list of (description, passed)
+    """
+    program = grammar_test.check_program(CALL_PROGRAM, grammar_test.get_parser(kind=options.parser))
+    allocation = next(fun.allocation for _, fun in program.units() if fun.name == 'g')
+    saves = [register.full.name for registers in allocation.call_saves.values() for register in registers]
+    code = function_code(program.compile(), 'top_g')
+    call = code.index('call top_f')
+    results = [
+        ('x crossing the call of f is in the callee-saved r15', [register.full.name for register in allocation.saved]
+         == ['r15']),
+        ('product and sum crossing the call of f are saved by the caller', len(saves) == 2),
+        ('the prologue saves r15 and the epilogue restores it', 'push r15' in code[:call]
+         and 'mov r15, QWORD [rbp-8]' in code[call:]),
+    ]
+    for register in saves:
+        results.append(('{} is pushed before the call of f and popped after it'.format(register),
+                        'push ' + register in code[:call] and 'pop ' + register in code[call:]))
+
+    outputs = run_program(CALL_PROGRAM, options.parser)
+    if outputs is not None:
+        results.append(('the program prints 82 at -O0 and -O1', outputs[0] == outputs[1] == b'82\n'))
+    return results
+
+
+# (type, statements before, expression, value of the literal it folds to or None if it has to stay)
+FOLD_CASES = [
+    ('int', '', '2147483646 + 2', -2 ** 31),
+    ('int', '', '-2147483646 - 3', 2 ** 31 - 1),
+    ('int', '', '65536 * 32768', -2 ** 31),
+    ('int', '', '65536 * 65536', 0),
+    ('int', '', '-7 / 2', -3),
+    ('int', '', '-7 % 2', -1),
+    ('int', '', '7 % -2', 1),
+    ('boolean', '', '"a" == "a"', None),
+    ('boolean', '', '"a" != "b"', None),
+    ('boolean', '', '1 < 2 && !false', True),
+    ('string', '', '"a" + "b"', b'ab'),
+    ('string', '', '"\\1" + "23"', b'\x0123'),
+    ('string', '', '"a\\\\" + "\\tb\\n"', b'a\\\tb\n'),
+    ('int', 'int x = 3;', 'x * 4', 12),
+    ('int', 'int x = 3; x++;', 'x * 4', None),
+    ('int', 'int x = 3; if (x > 0) x = 4;', 'x * 4', None),
+]
+
+# divisions idiv traps on, compiled but not run
+TRAP_CASES = [
+    ('int', 'int x = 3;', 'x / 0', None),
+    ('int', 'int x = 3;', 'x % 0', None),
+    ('int', 'int m = -2147483646 - 2;', 'm / -1', None),
+    ('int', 'int m = -2147483646 - 2;', 'm % -1', None),
+]
+
+FOLD_PROGRAM = """
+int main() {{
+    {}
+    {} result = {};
+    {}
+    return 0;
+}}
+"""
+
+PRINT = {'int': 'printInt(result);', 'string': 'printString(result);',
+         'boolean': 'if (result) printString("true"); else printString("false");'}
+
+# bodies of an int function the checker rejects for a missing return at every level, its return analysis only
+# decides conditions that are literals
+NO_RETURN_BODIES = ['if (1 == 1) return 8;', 'if (!false) return 8;', 'while (1 < 2) {}']
+
+NO_RETURN_PROGRAM = """
+int k() {{
+    {}
+}}
+
+int main() {{
+    return k();
+}}
+"""
+
+
+def rejected_without_return(source, parser, optimize):
+    try:
+        grammar_test.check_program(source, parser, optimize=optimize)
+    except compiler.NoReturnException:
+        return True
+    return False
+
+
+def check_fold(options):
+    """
+    :return: list of (description, passed)
+    """
+    parser = grammar_test.get_parser(kind=options.parser)
+    results = []
+    for checked_type, before, expression, expected in FOLD_CASES + TRAP_CASES:
+        source = FOLD_PROGRAM.format(before, checked_type, expression, PRINT[checked_type])
+        program = grammar_test.check_program(source, parser)
+        value = next(node.value for _, fun in program.units() for node in fold.postorder(fun.block)
+                     if isinstance(node, compiler.VarDef) and node.name == 'result')
+        code = '{} {}'.format(before, expression).strip()
+        if expected is None:
+            results.append(('{} stays'.format(code), not isinstance(value, fold.LITERALS)))
+        else:
+            results.append(('{} folds to {}'.format(code, expected),
+                            isinstance(value, fold.LITERALS) and value.get_real_value() == expected))
+
+    source = FOLD_PROGRAM.format('', 'int', '0', '\n'.join(
+        '{{ {} {} result = {}; {} }}'.format(before, checked_type, expression, PRINT[checked_type])
+        for checked_type, before, expression, _ in FOLD_CASES))
+    outputs = run_program(source, options.parser)
+    if outputs is not None:
+        results.append(('the cases print the same at -O0 and -O1', outputs[0] == outputs[1]))
+
+    for body in NO_RETURN_BODIES:
+        source = NO_RETURN_PROGRAM.format(body)
+        results.append(('{} is rejected for a missing return at -O0 and -O1'.format(body),
+                        rejected_without_return(source, parser, 0) and rejected_without_return(source, parser, 1)))
+    return results
+
+
+CACHE_PROGRAM = """
+void f() {
+    printString("hel" + "lo");
+}
+
+int main() {
+    f();
+    return 0;
+}
+"""
+
+CACHE_EDITED = """
+void g() {
+    printString("a");
+    printString("b");
+}
+""" + CACHE_PROGRAM
+
+
+def check_cache(options):
+    """
+    :return: list of (description, passed)
+    """
+    parser = grammar_test.get_parser(kind=options.parser)
+    directory = tempfile.mkdtemp()
+    try:
+        grammar_test.compile_program(CACHE_PROGRAM, parser, jobs=2, cache=asm_cache.AsmCache(directory))
+        cache = asm_cache.AsmCache(directory)
+        cached = grammar_test.compile_program(CACHE_EDITED, parser, jobs=2, cache=cache)
+    finally:
+        shutil.rmtree(directory)
+    expected = grammar_test.compile_program(CACHE_EDITED, parser)
+    return [
+        ('f and main compiled by workers are taken from the cache', cache.hits == 2),
+        ('the edited program compiles as without the cache', cached == expected),
+    ]
+
+
+CHECKS = {
+    'cache': check_cache,
+    'fold': check_fold,
+    'peephole': check_peephole,
+    'regalloc': check_regalloc,
+}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Behaviour checks of the optimizations')
+    arg_parser.add_argument('checks', nargs='*', metavar='CHECK',
+                            help='checks to run, all by default: {}'.format(', '.join(sorted(CHECKS))))
+    arg_parser.add_argument('--parser', choices=grammar_test.PARSERS, default='lark', help='front end of the checks')
+    options = arg_parser.parse_args()
+    unknown = [name for name in options.checks if name not in CHECKS]
+    if unknown:
+        arg_parser.error('unknown checks: {}'.format(', '.join(unknown)))
+
+    failed = 0
+    total = 0
+    for name in options.checks or sorted(CHECKS):
+        for description, passed in CHECKS[name](options):
+            total += 1
+            if not passed:
+                failed += 1
+                print('FAILED {}: {}'.format(name, description))
+    print('{} checks, {} failed'.format(total, failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
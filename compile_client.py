@@ -0,0 +1,54 @@
+"""
+Thin client for the compile server started with `python grammar_test.py --server SOCKET`.
+
+Usage: python compile_client.py SOCKET file.lat
+
+Behaves like `python grammar_test.py file.lat`: writes file.s next to the source, prints the error and exits with 1
+on failure. It deliberately imports nothing from the compiler, so it starts without loading lark. When the server
+is not running the file is compiled in-process instead.
+"""
+import json
+import socket
+import sys
+
+
+def request_compile(socket_path, source):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps({'source': source}).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as f:
+            return json.loads(f.readline().decode('utf-8'))
+
+
+def compile_locally(source):
+    import grammar_test
+
+    result = grammar_test.compile_source(source)
+    return {'asm': result.asm} if result.ok else {'error': str(result.diagnostics[0])}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('Usage: {} SOCKET file.lat'.format(sys.argv[0]))
+        sys.exit(2)
+
+    socket_path, path = sys.argv[1:]
+
+    try:
+        with open(path) as f:
+            source = f.read()
+    except FileNotFoundError as e:
+        print(e)
+        sys.exit(1)
+
+    try:
+        response = request_compile(socket_path, source)
+    except (FileNotFoundError, ConnectionRefusedError):
+        response = compile_locally(source)
+
+    if 'error' in response:
+        print(response['error'])
+        sys.exit(1)
+
+    with open(path[:-4] + '.s', 'w') as f:
+        f.write(response['asm'])
@@ -1,8 +1,14 @@
-from copy import deepcopy
+import io
+import multiprocessing
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from types import GeneratorType
 from typing import List
 
+import peephole
+import profiling
 import type
+from asm import Instruction, Immediate, Label, Memory, Register, RAX, RBP, RSP, render
 
 # from type import INT_TYPE, STRING_TYPE, VOID_TYPE
 
@@ -15,6 +21,10 @@ class CompilerException(Exception):
         self.rlmsg = msg
         self.obj = obj
 
+    def __reduce__(self):
+        # errors of parallel checking travel between processes without the AST node
+        return self.__class__, (self.rlmsg, Position(self.obj.line, self.obj.column))
+
 
 class RedefinitionException(CompilerException):
     pass
@@ -44,32 +54,230 @@ class InvalidCastException(CompilerException):
     pass
 
 
-class Counter:
-    INSTANCE = None
+def trampoline(step):
+    """
+    Runs a tree walk written as generators without using the Python stack. A step yields the walk of a child (a
+    generator) to get its result, plain values are sent straight back, so leaves can be ordinary methods. Exceptions
+    are thrown into the waiting parent, as if the child was called directly.
+    :return: result of the outermost step
+    """
+    if not isinstance(step, GeneratorType):
+        return step
+
+    stack = [step]
+    value = None
+    error = None
+    while True:
+        try:
+            if error is not None:
+                error, thrown = None, error
+                child = stack[-1].throw(thrown)
+            else:
+                child = stack[-1].send(value)
+        except StopIteration as stop:
+            stack.pop()
+            if not stack:
+                return stop.value
+            value = stop.value
+            continue
+        except Exception as e:
+            stack.pop()
+            if not stack:
+                raise
+            error = e
+            continue
+
+        if isinstance(child, GeneratorType):
+            stack.append(child)
+            value = None
+        else:
+            value = child
+
+
+class Emitter:
+    """
+    Append-only buffer of assembly lines. Code generation emits into it and flush() writes what was collected so far
+    to the output stream, so only the code of the function being compiled is kept in memory. Code is emitted as
+    asm.Instruction and asm.Label objects and rendered to text by flush(); directives, data and the code of functions
+    compiled elsewhere are plain strings.
+
+    The emitter belongs to one compilation and also hands out jump labels. They are NASM local labels numbered from 1
+    in every function, so the code of a function does not depend on anything compiled before it.
+
+    It also keeps the register allocation of the function being compiled (regalloc.Allocation, optimize is False
+    without one): free temporaries, registers saved around calls and callee-saved registers restored on return. live
+    holds the registers with values of enclosing expressions, which temporary() never hands out and calls save when
+    they are caller-saved.
+
+    With peephole set by start_function, flush() runs peephole.optimize over the function first; peephole_hits counts
+    the replacements of every rule over all functions compiled into this emitter.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lines = []
+        self.started = False
+        self.label_counter = 0
+        self.optimize = False
+        self.temporaries = []
+        self.call_saves = {}
+        self.restore = []
+        self.live = []
+        self.peephole = False
+        self.peephole_hits = dict.fromkeys(peephole.RULE_NAMES, 0)
+
+    def start_function(self, name, allocation=None, peephole=False):
+        self.label_counter = 0
+        self.peephole = peephole
+        self.optimize = allocation is not None
+        self.temporaries = allocation.temporaries if allocation is not None else []
+        self.call_saves = allocation.call_saves if allocation is not None else {}
+        self.restore = allocation.restore if allocation is not None else []
+        self.live = []
+        self.emit(Label(name))
+
+    def temporary(self, *exclude):
+        """
+        :return: caller-saved register holding no variable or value of an enclosing expression, None if there is none
+        """
+        for register in self.temporaries:
+            if register not in self.live and register not in exclude:
+                return register
+        return None
+
+    def saves(self, call, location):
+        """
+        :param call: node of a call that may change caller-saved registers
+        :param location: register receiving the result
+        :return: registers to save around the call, variables living across it and live temporaries
+        """
+        if id(call) not in self.call_saves:
+            return []
+        saves = list(self.call_saves[id(call)])
+        for register in self.live:
+            if register in CALLER_SAVED_REGISTERS and register not in saves:
+                saves.append(register)
+        return [register for register in saves if register != location]
+
+    def new_label(self):
+        self.label_counter += 1
+        return Label('.L{}'.format(self.label_counter))
+
+    def emit(self, *lines):
+        self.lines.extend(lines)
+
+    def extend(self, lines):
+        self.lines.extend(lines)
+
+    def flush(self):
+        if not self.lines:
+            return
+        if self.peephole:
+            self.lines = peephole.optimize(self.lines, self.peephole_hits)
+            self.peephole = False
+        if self.started:
+            self.stream.write('\n')
+        self.stream.write('\n'.join(map(render, self.lines)))
+        self.lines = []
+        self.started = True
+
+
+class StringPool:
+    """
+    String literals of the whole program. Every literal is decoded once, equal strings share one label and a string
+    that is the tail of a longer one points into it instead of being stored again.
+    """
 
     def __init__(self):
-        self.counter = 0
+        self.labels = {}
+        self.values = {}
 
     @staticmethod
-    def get():
-        if Counter.INSTANCE is None:
-            Counter.INSTANCE = Counter()
-        Counter.INSTANCE.counter += 1
-        return Counter.INSTANCE.counter
+    def decode(literal):
+        """
+        :param literal: string literal as written in the source, with quotes and escapes
+        :return: bytes of the string, without the terminating zero
+        """
+        return literal[1:-1].encode('utf-8').decode('unicode_escape').encode('latin-1')
+
+    @staticmethod
+    def quote(value):
+        """
+        :return: a literal decoding to the bytes value, printable characters as they are and other bytes as \\x escapes
+        """
+        return '"{}"'.format(''.join(chr(byte) if 32 <= byte < 127 and chr(byte) not in '"\\'
+                                     else '\\x{:02x}'.format(byte) for byte in value))
+
+    def add(self, literal):
+        """
+        :param literal: string literal as written in the source, with quotes and escapes
+        :return: label of the string in the data section
+        """
+        try:
+            return self.labels[literal]
+        except KeyError:
+            pass
+
+        value = self.decode(literal) + b'\0'
+        if value not in self.values:
+            self.values[value] = 'S{}'.format(len(self.values) + 1)
+        self.labels[literal] = self.values[value]
+        return self.values[value]
+
+    @staticmethod
+    def data(value):
+        """
+        :return: operands of db, printable characters are quoted, other bytes are numbers
+        """
+        parts = []
+        run = []
+        for byte in value:
+            if 32 <= byte < 127 and byte != ord("'"):
+                run.append(chr(byte))
+                continue
+            if run:
+                parts.append("'{}'".format(''.join(run)))
+                run = []
+            parts.append(str(byte))
+        if run:
+            parts.append("'{}'".format(''.join(run)))
+        return ','.join(parts)
+
+    def compile(self, out):
+        # sorted by reversed bytes, a string is followed by the strings it is a suffix of
+        hosts = {}
+        host = None
+        for value in sorted(self.values, key=lambda value: value[::-1], reverse=True):
+            if host is None or not host.endswith(value):
+                host = value
+            hosts[value] = host
+
+        for value, label in self.values.items():
+            if hosts[value] is value:
+                out.emit('{} db {}'.format(label, self.data(value)))
+        for value, label in self.values.items():
+            host = hosts[value]
+            if host is not value:
+                out.emit('{} equ {}+{}'.format(label, self.values[host], len(host) - len(value)))
 
 
 class AssemblyLocation:
+    """
+    Place of a value, operand is the asm operand to use in instructions.
+    """
     __metaclass__ = ABCMeta
 
     def __init__(self, location: str):
         self.location = location
+        self.operand = None
 
     @abstractmethod
-    def mov_to_memory(self, dest: 'MemoryLocation') -> List[str]:
+    def mov_to_memory(self, dest: 'MemoryLocation') -> List[Instruction]:
         raise NotImplemented
 
-    def mov_to_register(self, dest: 'RegisterLocation') -> List[str]:
-        return ['mov {}, {}'.format(dest, self)]
+    @abstractmethod
+    def mov_to_register(self, dest: 'RegisterLocation', out: Emitter):
+        raise NotImplemented
 
     def __repr__(self):
         return self.location
@@ -85,103 +293,306 @@ class MemoryLocation(AssemblyLocation):
         asm_type = {4: 'DWORD', 8: 'QWORD'}[size]
         super().__init__('{} [{}{}{}]'.format(asm_type, register, self.sign(location), abs(location)))
         self.size = size
+        self.offset = location
+        self.register = register
         self.abs_location = '{}{}{}'.format(register, self.sign(location), abs(location))
+        self.memory = self.operand = Memory(register, location, size)
 
-    def mov_to_register(self, dest: 'RegisterLocation') -> List[str]:
-        if self.size == 8:
-            register = dest.full_name
-        else:
-            register = dest
-        return ['mov {}, {}'.format(register, self)]
+    def mov_to_register(self, dest: 'RegisterLocation', out: Emitter):
+        out.emit(Instruction('mov', dest.sized(self.size), self.memory))
 
     def mov_to_memory(self, dest: 'MemoryLocation'):
-        temp_register = 'rax' if self.size == 8 else 'eax'
+        temp_register = RegisterLocation('eax', 'rax').sized(self.size)
 
         return [
-            'push rax',
-            'mov {}, {}'.format(temp_register, self),
-            'mov {}, {}'.format(dest, temp_register),
-            'pop rax'
+            Instruction('push', RAX),
+            Instruction('mov', temp_register, self.memory),
+            Instruction('mov', dest.memory, temp_register),
+            Instruction('pop', RAX)
         ]
 
 
 class PointerLocation(AssemblyLocation):
-    def mov_to_memory(self, dest: 'MemoryLocation') -> List[str]:
+    def mov_to_memory(self, dest: 'MemoryLocation') -> List[Instruction]:
         return MemoryLocation.mov_to_memory(self, dest)
 
 
 class RegisterLocation(AssemblyLocation):
+    """
+    General purpose register, register is its 32-bit and full its 64-bit name as asm.Register.
+    """
+
     def __init__(self, location, full_name):
         super().__init__(location)
         self.full_name = full_name
+        self.register = self.operand = Register(location)
+        self.full = Register(full_name)
+
+    def sized(self, size):
+        """
+        :return: the register for a value of size bytes
+        """
+        return self.full if size == 8 else self.register
 
     def mov_to_memory(self, dest: 'MemoryLocation'):
-        return ['mov {}, {}'.format(dest, self)]
+        return [Instruction('mov', dest.memory, self.register)]
 
     def __eq__(self, other):
         # print(other.__dict__)
         return self.location == other.location
 
-    def mov_to_register(self, dest: 'RegisterLocation') -> List[str]:
-        return ['mov {}, {}'.format(dest.full_name, self.full_name)]
+    def mov_to_register(self, dest: 'RegisterLocation', out: Emitter):
+        out.emit(Instruction('mov', dest.full, self.full))
+
+
+# registers the code generation does not use on its own, free for variables and temporaries (regalloc.py)
+CALLEE_SAVED_REGISTERS = [RegisterLocation('r15d', 'r15')]
+CALLER_SAVED_REGISTERS = [RegisterLocation('ecx', 'rcx'), RegisterLocation('esi', 'rsi'),
+                          RegisterLocation('r8d', 'r8'), RegisterLocation('r9d', 'r9'),
+                          RegisterLocation('r10d', 'r10'), RegisterLocation('r11d', 'r11')]
 
 
 class BaseBase:
-    line = None
-    column = None
+    """
+    Base of AST nodes. Nodes keep their data in __slots__ instead of a per-instance __dict__. FIELDS lists the slots
+    of a class and all its bases; every field starts as None and the list drives __repr__ and __eq__.
+    """
+    __slots__ = ('line', 'column')
+
+    FIELDS = ('column', 'line')
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.FIELDS = tuple(sorted({field for klass in cls.__mro__ for field in klass.__dict__.get('__slots__', ())}))
+
+    def __new__(cls, *args, **kwargs):
+        self = super().__new__(cls)
+        for field in cls.FIELDS:
+            setattr(self, field, None)
+        return self
 
     def __repr__(self):
         params = ''
-        for attr, val in sorted(self.__dict__.items()):
+        for attr in self.FIELDS:
+            val = getattr(self, attr)
             params += '{}={}, '.format(attr, val if not isinstance(val, str) else {'"{}"'.format(val)})
 
         params = '(' + params[:-2] + ')' if params else '()'
         return self.__class__.__name__ + params
 
     def __eq__(self, other):
-        return self.__class__ == other.__class__ and self.__dict__ == other.__dict__
+        return self.__class__ == other.__class__ and \
+               all(getattr(self, attr) == getattr(other, attr) for attr in self.FIELDS)
 
+    def nodes(self):
+        """
+        All nodes of the subtree, parents before children and fields in FIELDS order.
+        """
+        stack = [self]
+        while stack:
+            value = stack.pop()
+            if isinstance(value, BaseBase):
+                yield value
+                stack.extend(reversed([getattr(value, field) for field in value.FIELDS]))
+            elif isinstance(value, (list, tuple)):
+                stack.extend(reversed(value))
+
+    def outline(self, positions=True):
+        """
+        Flat description of the subtree for comparing and hashing trees: for every node of nodes() its class and its
+        fields, child nodes replaced by their class names.
+        :param positions: include line and column, without them the outline only changes with the code itself
+        """
+        result = []
+        for node in self.nodes():
+            fields = [(field, _outline_value(getattr(node, field))) for field in node.FIELDS
+                      if positions or field not in ('line', 'column')]
+            result.append((node.__class__.__name__, tuple(fields)))
+        return result
 
-def not_so_deep_copy(env):
-    new_env = {}
-    for key, value in env.items():
-        if key == 'cls':
-            continue
-        new_env[key] = deepcopy(value)
+    def register_strings(self, pool):
+        pass
+
+
+def _outline_value(value):
+    if isinstance(value, BaseBase):
+        return value.__class__.__name__
+    if isinstance(value, (list, tuple)):
+        return tuple(_outline_value(item) for item in value)
+    if isinstance(value, str):
+        # lark hands over its tokens, a subclass of str
+        return str(value)
+    return value
+
+
+class Position(BaseBase):
+    __slots__ = ()
+
+    def __init__(self, line, column):
+        self.line = line
+        self.column = column
+
+
+class SymbolTable:
+    """
+    Variables visible at the current point of semantic checking.
+
+    Every name maps to a stack of its declarations, the innermost on top, and every scope remembers the names it
+    declared. Lookup is a single dict access, entering a scope is O(1) and leaving it costs one pop per name the
+    scope declared.
+    """
+
+    def __init__(self):
+        self.symbols = {}
+        self.scopes = [[]]
+
+    def push_scope(self):
+        self.scopes.append([])
+
+    def pop_scope(self):
+        for name in self.scopes.pop():
+            declarations = self.symbols[name]
+            declarations.pop()
+            if not declarations:
+                del self.symbols[name]
 
-    new_env['cls'] = env['cls']
-    return new_env
+    def __contains__(self, name):
+        return name in self.symbols
+
+    def __getitem__(self, name):
+        return self.symbols[name][-1]
+
+    def __setitem__(self, name, value):
+        self.symbols.setdefault(name, []).append(value)
+        self.scopes[-1].append(name)
+
+
+def copy_env(env):
+    """
+    Copies flags of the environment (level, was_return, stack_counter...). Tables of variables, functions, classes
+    and strings are shared with the original, variables are scoped with SymbolTable.push_scope/pop_scope instead.
+    """
+    return dict(env)
+
+
+class DependencyRecorder:
+    """
+    View of env['fun'] or env['cls'] remembering the names looked up through it, that is the functions and classes
+    whose signatures and layouts the checked code depends on.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.names = set()
+
+    def __getitem__(self, name):
+        self.names.add(name)
+        return self.table[name]
+
+    def __contains__(self, name):
+        self.names.add(name)
+        return name in self.table
+
+
+def check_and_compile_unit(base_env, cls, fun):
+    """
+    Checks and compiles a single function, or a method of cls, on its own.
+    :return: assembly of the function, the sets of names of functions and classes it looked up and the sorted string
+        literals of the function after folding, which the assembly refers to by their labels
+    """
+    env = copy_env(base_env)
+    env['var'] = SymbolTable()
+    env['fun'] = functions = DependencyRecorder(base_env['fun'])
+    env['cls'] = classes = DependencyRecorder(base_env['cls'])
+    if cls is not None:
+        env = cls.method_env(env)
+        classes.names.add(cls.name)
+    trampoline(fun.check_correctness(env))
+
+    stream = io.StringIO()
+    out = Emitter(stream)
+    trampoline(fun.compile(out))
+    out.flush()
+
+    literals = set()
+    for node in fun.nodes():
+        node.register_strings(literals)
+    return stream.getvalue(), functions.names, classes.names, sorted(literals)
+
+
+_parallel_state = None
+
+
+def _check_and_compile_unit(index):
+    """
+    Task of a worker of Program.check_and_compile_parallel. The program and its global tables are inherited from
+    the parent when the pool forks.
+    """
+    base_env, units = _parallel_state
+    cls, fun = units[index]
+    return check_and_compile_unit(base_env, cls, fun)
 
 
 class Program(BaseBase):
+    __slots__ = ('functions', 'classes', 'strings', 'code')
+
     def __init__(self, functions, classes):
         self.functions = functions
         self.classes = classes
         self.strings = None
+        self.code = None
 
-    def check_for_cycles_in_inheritance(self, env):
+    def units(self):
+        """
+        :return: (class or None, FunDef) of every function and method in the order of the output
+        """
+        return [(None, def_) for def_ in self.functions] + \
+               [(cls, method) for cls in self.classes for method in cls.methods]
+
+    def build_class_hierarchy(self, env):
+        """
+        Indexes classes parents first, so every class builds its tables from the finished tables of its parent.
+        Undefined parents and cycles in inheritance are found by the same walk.
+        """
+        done = set()
 
         for cls in self.classes:
+            path = []
+            on_path = set()
             curr_cls = cls
-            inh = set()
 
-            while (curr_cls.parent is not None):
-                if curr_cls.name in inh:
+            while curr_cls.name not in done:
+                if curr_cls.name in on_path:
                     raise CycleException("found cycle in inheritance line of class {}".format(curr_cls.name), self)
-                inh.add(curr_cls.name)
+                path.append(curr_cls)
+                on_path.add(curr_cls.name)
 
+                if curr_cls.parent is None:
+                    break
                 try:
                     curr_cls = env['cls'][curr_cls.parent]
                 except KeyError:
                     raise UndefinedVariableException('Class {} is not defined'.format((curr_cls.parent)), self)
 
-    def check_correctness(self):
+            for curr_cls in reversed(path):
+                parent = env['cls'][curr_cls.parent] if curr_cls.parent is not None else None
+                curr_cls.build_tables(parent)
+                done.add(curr_cls.name)
+
+    def check_correctness(self, jobs=1, cache=None, optimize=1, backend='ast'):
         """
         void printInt(int)
         void printString(string)
         void error()
         int readInt()
         string readString()
+
+        With jobs > 1 functions and methods are checked and compiled in a pool of forked processes, the assembly is
+        kept in self.code. The first error in the order of the output is raised, as in the serial mode.
+        :param cache: asm_cache.AsmCache, functions found there are neither checked nor compiled again
+        :param optimize: 0 keeps every variable on the stack, 1 folds constants (fold.py), allocates registers
+            (regalloc.py) and optimizes the code of every function with peephole.py
+        :param backend: 'ast' generates code from the tree, 'ir' lowers functions to the IR of ir.py first
         :return:
         """
         env = {
@@ -193,12 +604,14 @@ class Program(BaseBase):
                 'readString': {'type': type.STRING_TYPE, 'args': Args([])}
             },
             'cls': {},
-            'var': {},
+            'var': SymbolTable(),
             'level': 0,
             'was_return': False,
-            'strings': {},
+            'strings': StringPool(),
             'in_class': False,
-            'this': None
+            'this': None,
+            'optimize': optimize,
+            'backend': backend
         }
 
         was_main = False
@@ -219,203 +632,267 @@ class Program(BaseBase):
                 raise RedefinitionException('Redefinition of class {}'.format(cls.name), self)
             env['cls'][cls.name] = cls
 
-        self.check_for_cycles_in_inheritance(env)
+        # labels of strings come from a walk of the whole tree, not from the order in which functions are checked
+        for node in self.nodes():
+            node.register_strings(env['strings'])
+        if optimize:
+            import fold
+            fold.register_strings(self, env['strings'])
+        self.strings = env['strings']
+
+        self.build_class_hierarchy(env)
+
+        if cache is not None:
+            self.code = self.check_and_compile_cached(env, jobs, cache)
+            return
+
+        if jobs > 1:
+            self.code = [code for code, _, _, _ in self.check_and_compile_parallel(env, jobs, self.units())]
+            return
 
         for def_ in self.functions:
-            new_env = def_.check_correctness(env)
-            env['strings'].update(new_env['strings'].items())
+            trampoline(def_.check_correctness(env))
 
         for cls in self.classes:
-            new_env = cls.check_correctness(env)
-            env['strings'].update(new_env['strings'].items())
+            trampoline(cls.check_correctness(env))
 
-        self.strings = env['strings']
+    def check_and_compile_parallel(self, env, jobs, units):
+        """
+        :return: check_and_compile_unit results of units
+        """
+        global _parallel_state
 
-    def compile(self):
-        res = []
-        res.append('global ' + 'top_main')
+        _parallel_state = (env, units)
+        try:
+            with ProcessPoolExecutor(jobs, mp_context=multiprocessing.get_context('fork')) as pool:
+                return list(pool.map(_check_and_compile_unit, range(len(units)),
+                                     chunksize=max(1, len(units) // (4 * jobs))))
+        finally:
+            _parallel_state = None
 
-        res.append('extern top_printString')
-        res.append('extern top_printInt')
-        res.append('extern top_strConcat')
-        res.append('extern top_error')
-        res.append('extern top_readInt')
-        res.append('extern top_readString')
-        res.append('extern malloc')
+    def check_and_compile_cached(self, env, jobs, cache):
+        """
+        Takes the assembly of unchanged functions from the cache, the others are checked and compiled as with
+        check_and_compile_parallel, or one by one for a single job, and stored.
+        :return: assembly of every unit
+        """
+        units = self.units()
+        code = [cache.load(env, cls, fun) for cls, fun in units]
+        missing = [index for index, asm in enumerate(code) if asm is None]
+        if jobs > 1 and len(missing) > 1:
+            results = self.check_and_compile_parallel(env, jobs, [units[index] for index in missing])
+        else:
+            results = [check_and_compile_unit(env, *units[index]) for index in missing]
 
-        res.append('section .data')
-        res.append('')
-        for string, label in self.strings.items():
-            res.append('{} db '.format(label) +
-                       ','.join([hex(ord(c)) for c in string[1:-1].encode('utf-8').decode("unicode_escape")] + ['0']))
+        for index, (asm, functions, classes, literals) in zip(missing, results):
+            cls, fun = units[index]
+            cache.store(env, cls, fun, asm, functions, classes, literals)
+            code[index] = asm
+        return code
+
+    def compile(self, out=None):
+        """
+        Generates assembly of the checked program. The data section goes first, then the code is written function by
+        function.
+        :param out: Emitter to write to, if None the assembly is returned as a string
+        """
+        if out is None:
+            stream = io.StringIO()
+            self.compile(Emitter(stream))
+            return stream.getvalue()
+
+        out.emit('global ' + 'top_main')
+
+        out.emit('extern top_printString')
+        out.emit('extern top_printInt')
+        out.emit('extern top_strConcat')
+        out.emit('extern top_error')
+        out.emit('extern top_readInt')
+        out.emit('extern top_readString')
+        out.emit('extern malloc')
+
+        out.emit('section .data')
+        out.emit('')
+        self.strings.compile(out)
 
         for cls in self.classes:
-            res.append('vtable_' + cls.name + ' dq ' + cls.get_virtual_methods())
+            out.emit('vtable_' + cls.name + ' dq ' + cls.get_virtual_methods())
+
+            out.emit('section .text')
 
-            res.append('section .text')
+        out.emit('')
+        if self.code is not None:
+            code = iter(self.code)
+            for def_ in self.functions:
+                out.emit(next(code), '')
+                out.flush()
+
+            for cls in self.classes:
+                for method in cls.methods:
+                    out.emit(next(code))
+                    out.flush()
+                out.emit('')
+                out.flush()
+            return
 
-        res.append('')
         for def_ in self.functions:
-            res += def_.compile()
-            res.append('')
+            trampoline(def_.compile(out))
+            out.emit('')
+            out.flush()
 
         for cls in self.classes:
-            res += cls.compile()
-            res.append('')
-
-        return '\n'.join(res)
+            trampoline(cls.compile(out))
+            out.emit('')
+            out.flush()
 
 
 class ClassDef(BaseBase):
+    __slots__ = ('name', 'fields', 'methods', 'parent', 'root', 'ancestors', 'size', 'all_fields', 'attributes',
+                 'attr_offsets', 'method_decls', 'method_impls', 'method_slots', 'methods_by_name', 'vtable')
+
     def __init__(self, name, fields, methods, parent=None):
         self.name = name
         self.fields = fields
         self.methods = methods
         self.parent = parent
-        self.inheritance_chain = None
+        self.root = None
+        self.ancestors = None
         self.size = None
-        self.vt_table = None
-
-    def get_method_offset(self, method_name):
-        offset = 0
-        for obj in self.vt_table:
-            for method in sorted(obj['methods']):
-                if method == method_name:
-                    return offset
-                offset += 8
-
-        raise Exception("Method not found????")
-
-    def get_attr_offset(self, attr_name):
-
-        offset = 8
-        for obj in self.vt_table:
-            for attr in obj['fields']:
-                if attr.name == attr_name:
-                    return offset
-                offset += 8
-
-        raise Exception("Attribute not found???? {} {}".format(attr, self.vt_table))
-
-    def get_method(self, name, env):
-        for method in self.methods:
-            if method.name == name:
-                return method
-
-        if self.parent is None:
-            raise NoAttributeException('Class {} does not contain method {}'.format(self.name, name), self)
+        self.all_fields = None
+        self.attributes = None
+        self.attr_offsets = None
+        self.method_decls = None
+        self.method_impls = None
+        self.method_slots = None
+        self.methods_by_name = None
+        self.vtable = None
+
+    def build_tables(self, parent):
+        """
+        Computes memory layout and method tables of the class. Tables of the parent have to be built already, they
+        are copied and extended, so every lookup afterwards is a single dict access.
+        Object layout: vtable pointer followed by fields of all classes in the inheritance line, root first.
+        Vtable: methods introduced by each class in the inheritance line, root first, sorted by name inside a class.
+        """
+        if parent is None:
+            self.root = None
+            self.ancestors = {self.name}
+            self.all_fields = []
+            self.attributes = {}
+            self.attr_offsets = {}
+            self.method_decls = {}
+            self.method_impls = {}
+            self.method_slots = {}
+            self.methods_by_name = {}
+            self.vtable = []
         else:
-            return env['cls'][self.parent].get_method(name, env)
+            self.root = parent.root or parent
+            self.ancestors = parent.ancestors | {self.name}
+            self.all_fields = list(parent.all_fields)
+            self.attributes = dict(parent.attributes)
+            self.attr_offsets = dict(parent.attr_offsets)
+            self.method_decls = dict(parent.method_decls)
+            self.method_impls = dict(parent.method_impls)
+            self.method_slots = dict(parent.method_slots)
+            self.methods_by_name = dict(parent.methods_by_name)
+            self.vtable = list(parent.vtable)
 
-    def get_attribute(self, name, env):
         for attr in self.fields:
-            if attr.name == name:
-                return attr
-
-        if self.parent is None:
-            raise NoAttributeException('Class {} does not contain attribute {}'.format(self.name, name), self)
-        else:
-            return env['cls'][self.parent].get_attribute(name, env)
-
-    def check_correctness(self, env):
-
-        curr_class = self
-        inheritance_chain = []
-        while True:
-            inheritance_chain.append(curr_class)
-            if curr_class.parent is None:
-                break
-            curr_class = env['cls'][curr_class.parent]
-
-        all_attrs = []
-        all_methods = []
-
-        vt_table = []
-
-        self.inheritance_chain = list(reversed(inheritance_chain))
-
-        for curr_class in self.inheritance_chain:
-            cur_obj = {}
-
-            for attr in curr_class.fields:
-                for known_attr in all_attrs:
-                    if attr.name == known_attr.name:
-                        raise RedefinitionException(
-                            'Redefinition of attribute {} in class {}'.format(attr.name, curr_class.name), self)
-                all_attrs.append(attr)
-
-            cur_obj['fields'] = curr_class.fields
-            cur_obj['methods'] = {}
-            for method in curr_class.methods:
-                found = False
-                for known_method in all_methods:
-                    if method.name == known_method.name:
-                        if known_method.type != method.type:
-                            raise RedefinitionException(
-                                "Wrong type of result in method {} in class {}".format(method.name, curr_class.name),
-                                self)
-                        if [a[0] for a in known_method.args.args] != [a[0] for a in method.args.args]:
-                            raise RedefinitionException(
-                                "Wrong types of arguments in method {} in class {}".format(method.name,
-                                                                                           curr_class.name), self)
+            if attr.name in self.attr_offsets:
+                raise RedefinitionException(
+                    'Redefinition of attribute {} in class {}'.format(attr.name, self.name), self)
+            self.attr_offsets[attr.name] = 8 + 8 * len(self.all_fields)
+            self.attributes[attr.name] = attr
+            self.all_fields.append(attr)
+
+        own_methods = {}
+        for method in self.methods:
+            known_method = self.method_decls.get(method.name)
+            if known_method is not None:
+                if known_method.type != method.type:
+                    raise RedefinitionException(
+                        "Wrong type of result in method {} in class {}".format(method.name, self.name), self)
+                if [a[0] for a in known_method.args.args] != [a[0] for a in method.args.args]:
+                    raise RedefinitionException(
+                        "Wrong types of arguments in method {} in class {}".format(method.name, self.name), self)
+            else:
+                self.method_decls[method.name] = method
+            own_methods.setdefault(method.name, method)
+            self.method_impls[method.name] = self.name
 
-                        for obj in vt_table:
-                            if method.name in obj['methods']:
-                                obj['methods'][method.name] = curr_class.name
-                        found = True
-                        break
-                if not found:
-                    cur_obj['methods'][method.name] = curr_class.name
+        for name in sorted(name for name in own_methods if name not in self.method_slots):
+            self.method_slots[name] = len(self.vtable)
+            self.vtable.append(name)
 
-                all_methods.append(method)
-            vt_table.append(cur_obj)
+        self.methods_by_name.update(own_methods)
+        self.size = 8 + 8 * len(self.all_fields)
 
-        self.vt_table = vt_table
+    def get_method_offset(self, method_name):
+        return 8 * self.method_slots[method_name]
 
-        env = not_so_deep_copy(env)
+    def get_attr_offset(self, attr_name):
+        return self.attr_offsets[attr_name]
+
+    def get_method(self, name):
+        try:
+            return self.methods_by_name[name]
+        except KeyError:
+            root = self.root or self
+            raise NoAttributeException('Class {} does not contain method {}'.format(root.name, name), root)
+
+    def get_attribute(self, name):
+        try:
+            return self.attributes[name]
+        except KeyError:
+            root = self.root or self
+            raise NoAttributeException('Class {} does not contain attribute {}'.format(root.name, name), root)
+
+    def method_env(self, env):
+        """
+        :return: env of the methods, with self and the fields in a new scope
+        """
+        env = copy_env(env)
         env['in_class'] = self.name
+        env['var'].push_scope()
 
         env['var']['self'] = {'type': type.Type(self.name), 'level': 1, 'location': MemoryLocation(16, 8)}
 
-        for attr in all_attrs:
+        for attr in self.all_fields:
             location = self.get_attr_offset(attr.name)
             env['var'][attr.name] = {'type': attr.type, 'level': 1,
                                      'location': MemoryLocation(location, type.get_size(attr.type), 'r13')}
+        return env
 
-        # for method in all_methods:
-        #     env['fun'][method.name] = { 'type': method.type, 'args': method.args }
+    def check_correctness(self, env):
+        env = self.method_env(env)
 
         for method in self.methods:
-            new_env = method.check_correctness(env)
-            env['strings'].update(new_env['strings'].items())
-        self.size = 8 + 8 * len(all_attrs)
+            yield method.check_correctness(env)
+
+        env['var'].pop_scope()
         return env
 
     def get_virtual_methods(self):
-        methods = []
-        offset = 0
-        for obj in self.vt_table:
-            for method in sorted(obj['methods']):
-                name = 'cls_' + obj['methods'][method] + '_' + method
-                methods.append(name)
-                offset += 8
+        methods = ['cls_' + self.method_impls[method] + '_' + method for method in self.vtable]
         return ','.join(methods + ['0'])
 
-    def compile(self):
-        result = []
-
+    def compile(self, out):
         for method in self.methods:
-            result += method.compile()
-        return result
+            yield method.compile(out)
+            out.flush()
 
 
 class Field(BaseBase):
+    __slots__ = ('name', 'type')
+
     def __init__(self, name, type):
         self.name = name
         self.type = type
 
 
 class FunDef(BaseBase):
+    __slots__ = ('type', 'name', 'args', 'block', 'stack_counter', 'is_method', 'allocation', 'ir')
+
     def __init__(self, type, name, args, block):
         self.type = type
         self.name = name
@@ -423,12 +900,20 @@ class FunDef(BaseBase):
         self.block = block
         self.stack_counter = None
         self.is_method = False
+        self.allocation = None
+        self.ir = None
 
     def check_correctness(self, env):
-        env = not_so_deep_copy(env)
+        name = env['in_class'] + '.' + self.name if env['in_class'] else self.name
+        with profiling.measure('check', name):
+            return (yield self.check_body(env))
+
+    def check_body(self, env):
+        env = copy_env(env)
 
         env['current_fun'] = (self.name, self.type)
         env['stack_counter'] = 0
+        env['var'].push_scope()
         self.is_method = env['in_class']
 
         stack_location = 16
@@ -436,16 +921,19 @@ class FunDef(BaseBase):
         if self.is_method:
             stack_location += 8
 
+        arg_locations = []
         for arg in self.args.args:
             if arg[0] == type.VOID_TYPE:
                 raise TypeException('Parameter {} cannot be void'.format(arg[1]), self)
             size = type.get_size(arg[0])
             if arg[1] in env['var']:
                 raise RedefinitionException('Redefinition of argument {}'.format(arg[1]), self)
-            env['var'][arg[1]] = {'type': arg[0], 'level': 1, 'location': MemoryLocation(stack_location, size)}
+            arg_locations.append(MemoryLocation(stack_location, size))
+            env['var'][arg[1]] = {'type': arg[0], 'level': 1, 'location': arg_locations[-1]}
             stack_location += 8
 
-        block_env = self.block.check_correctness(env)
+        block_env = yield self.block.check_correctness(env)
+        env['var'].pop_scope()
 
         if not block_env['was_return']:
             if self.type != type.VOID_TYPE:
@@ -454,43 +942,82 @@ class FunDef(BaseBase):
                 self.block.stmts.append(RETURN_VOID)
 
         self.stack_counter = block_env['stack_counter']
+        self.allocation = None
+        self.ir = None
+        if env['optimize']:
+            import fold
+            fold.fold(self.block, env['strings'])
+        if env['backend'] == 'ir':
+            import ir
+            args = arg_locations
+            if self.is_method:
+                args = [env['var']['self']['location']] + args
+            self.ir = ir.Function(self.label(), args)
+            if self.is_method:
+                self.ir.self_temp = self.ir.args[0]
+            yield self.block.lower(self.ir)
+            self.ir.finish()
+            self.allocation = ir.allocate(self.ir) if env['optimize'] else None
+        elif env['optimize']:
+            # regalloc walks the statement and expression classes, whose modules import this one
+            import regalloc
+            self.allocation = regalloc.allocate(self, arg_locations)
+            self.stack_counter = self.allocation.stack_counter
         return block_env
 
-    def compile(self):
-
+    def label(self):
         if self.is_method:
-            name = 'cls_' + self.is_method + '_' + self.name
-        else:
-            name = 'top_' + self.name
-
-        return [
-                   name + ':',
-                   'push rbp',
-                   'mov rbp, rsp',
-                   'add rsp, {}'.format(self.stack_counter)
-               ] + self.block.compile()
+            return 'cls_' + self.is_method + '_' + self.name
+        return 'top_' + self.name
+
+    def compile(self, out):
+        name = self.label()
+
+        with profiling.measure('compile', self.is_method + '.' + self.name if self.is_method else self.name):
+            if self.ir is not None:
+                import ir
+                out.start_function(name, peephole=self.allocation is not None)
+                ir.Selector(self.ir, self.allocation, out).select()
+                return
+            out.start_function(name, self.allocation, peephole=self.allocation is not None)
+            out.emit(Instruction('push', RBP),
+                     Instruction('mov', RBP, RSP),
+                     Instruction('add', RSP, Immediate(self.stack_counter)))
+            if self.allocation is not None:
+                for register in self.allocation.saved:
+                    out.emit(Instruction('push', register.full))
+                for register, location in self.allocation.loads:
+                    location.mov_to_register(register, out)
+            return (yield self.block.compile(out))
 
 
 class Block(BaseBase):
+    __slots__ = ('stmts',)
+
     def __init__(self, stmts):
         self.stmts = stmts
 
     def check_correctness(self, env):
-        env = not_so_deep_copy(env)
+        env = copy_env(env)
         env['level'] += 1
+        env['var'].push_scope()
         for stmt in self.stmts:
-            env = stmt.check_correctness(env)
+            env = yield stmt.check_correctness(env)
+        env['var'].pop_scope()
         return env
 
-    def compile(self):
-        result = []
+    def compile(self, out):
         for stmt in self.stmts:
-            result += stmt.compile()
+            yield stmt.compile(out)
 
-        return result
+    def lower(self, fn):
+        for stmt in self.stmts:
+            yield stmt.lower(fn)
 
 
 class Args(BaseBase):
+    __slots__ = ('args',)
+
     def __init__(self, args):
         self.args = args
 
@@ -504,6 +1031,8 @@ class Args(BaseBase):
 
 
 class VarDef(BaseBase):
+    __slots__ = ('type', 'name', 'value', 'location')
+
     def __init__(self, type, name, value):
         self.type = type
         self.name = name
@@ -513,27 +1042,35 @@ class VarDef(BaseBase):
     def check_correctness(self, env):
         if self.type == type.VOID_TYPE:
             raise TypeException('Variable {} type cannot be void'.format(self.name), self)
-        value_type = self.value.get_type(env)
+        value_type = yield self.value.get_type(env)
 
         if not type.is_type_matching(self.type, value_type, env):
             raise TypeException("Cannot assign {} to variable {} of type {}".format(value_type, self.name, self.type),
                                 self)
-        env = not_so_deep_copy(env)
+        env = copy_env(env)
 
         env['stack_counter'] -= type.get_size(self.type)
         self.location = MemoryLocation(env['stack_counter'], type.get_size(self.type))
         env['var'][self.name] = {'level': env['level'], 'type': self.type, 'location': self.location}
         return env
 
-    def compile(self):
+    def compile(self, out):
+        if isinstance(self.location, RegisterLocation):
+            return (yield self.value.mov_to_register(self.location, out))
+
+        r = out.temporary()
+        if r is not None:
+            yield self.value.mov_to_register(r, out)
+            out.emit(Instruction('mov', self.location.memory, r.sized(self.location.size)))
+            return
+
         r = RegisterLocation('eax', 'rax')
 
-        if self.location.size == 4:
-            register = 'eax'
-        else:
-            register = 'rax'
+        out.emit(Instruction('push', RAX))
+        yield self.value.mov_to_register(r, out)
+        out.emit(Instruction('mov', self.location.memory, r.sized(self.location.size)),
+                 Instruction('pop', RAX))
 
-        return ['push rax'] + \
-               self.value.mov_to_register(r) + \
-               ['mov {}, {}'.format(self.location, register),
-                'pop rax']
+    def lower(self, fn):
+        value = yield self.value.lower(fn)
+        fn.emit('copy', fn.variable(self.location), [value])
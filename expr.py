@@ -1,8 +1,8 @@
-from typing import List
-
 from compiler import BaseBase, UndefinedVariableException, RegisterLocation, MemoryLocation, ABCMeta, abstractmethod, \
-    Counter, InvalidCastException, CompilerException
-from type import INT_TYPE, BOOL_TYPE, STRING_TYPE, get_size, can_be_casted, NULL_TYPE
+    InvalidCastException, CompilerException, Emitter, StringPool
+from type import INT_TYPE, BOOL_TYPE, STRING_TYPE, VOID_TYPE, get_size, can_be_casted, NULL_TYPE
+from asm import Instruction, Immediate, Label, Memory, RAX, RDI, RSP, R12, R13, R14
+import ir
 
 
 def get_default_value(_type):
@@ -19,22 +19,66 @@ def get_default_value(_type):
 
 class ExpBase(BaseBase):
     __metaclass__ = ABCMeta
+    __slots__ = ('checked_type',)
+
+    def get_type(self, env):
+        """
+        Type of the expression. It is computed by check_type on the first call and stored on the node, later calls
+        and later phases only read it.
+        """
+        if self.checked_type is None:
+            self.checked_type = yield self.check_type(env)
+        return self.checked_type
 
     @abstractmethod
-    def mov_to_register(self, location: RegisterLocation) -> List[str]:
+    def check_type(self, env):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def mov_to_register(self, location: RegisterLocation, out: Emitter):
         raise NotImplementedError()
 
     def is_reference(self):
         return False
 
-    def get_reference(self, location: RegisterLocation):
+    def get_reference(self, location: RegisterLocation, out: Emitter):
         raise AttributeError("Cannot give reference")
 
     def get_real_value(self):
         raise AttributeError("Cannot give real value")
 
+    def get_condition_value(self):
+        """
+        Value of a condition as the return analysis of the checker sees it, which does not depend on the optimization
+        level: literals decide it and expressions computed by an operator count as false.
+        :raises AttributeError: if the value is not known before run time
+        """
+        return self.get_real_value()
+
+    def operand(self):
+        """
+        :return: register or constant holding the value, which then needs no code; None if it has to be computed
+        """
+        return None
+
+    def lower(self, fn):
+        """
+        Appends the instructions computing the value to fn (ir.Function).
+        :return: operand holding the value
+        """
+        raise NotImplementedError()
+
+    def lower_jump(self, fn, if_true, if_false):
+        """
+        Ends the current block of fn with a jump to the block if_true or if_false by the value.
+        """
+        value = yield self.lower(fn)
+        fn.branch('ne', value, ir.Const(0), if_true, if_false)
+
 
 class ExpVariable(ExpBase):
+    __slots__ = ('name', 'location')
+
     def __init__(self, name):
         self.name = name
         self.location = None
@@ -42,7 +86,7 @@ class ExpVariable(ExpBase):
     def set_location(self, location: MemoryLocation):
         self.location = location
 
-    def get_type(self, env):
+    def check_type(self, env):
         try:
             var = env['var'][self.name]
             self.location = var['location']
@@ -50,91 +94,149 @@ class ExpVariable(ExpBase):
         except:
             raise UndefinedVariableException('Variable {} is undefined'.format(self.name), self)
 
-    def mov_to_register(self, location: RegisterLocation) -> List[str]:
-        return self.location.mov_to_register(location)
+    def mov_to_register(self, location: RegisterLocation, out: Emitter):
+        self.location.mov_to_register(location, out)
+
+    def operand(self):
+        return self.location if isinstance(self.location, RegisterLocation) else None
 
-    def boolean_jmp(self, if_true, if_false):
-        return [
-            'cmp {}, 0'.format(self.location),
-            'je {}'.format(if_false),
-            'jmp {}'.format(if_true)
-        ]
+    def boolean_jmp(self, if_true, if_false, out: Emitter):
+        out.emit(Instruction('cmp', self.location.operand, Immediate(0)),
+                 Instruction('je', if_false),
+                 Instruction('jmp', if_true))
 
     def is_reference(self):
         return True
 
-    def get_reference(self, location: RegisterLocation):
-        return ['lea {}, [{}]'.format(location.full_name, self.location.abs_location)]
+    def get_reference(self, location: RegisterLocation, out: Emitter):
+        out.emit(Instruction('lea', location.full, Memory(self.location.register, self.location.offset)))
+
+    def is_field(self):
+        return self.location.register == 'r13'
+
+    def lower(self, fn):
+        if self.is_field():
+            return fn.emit('load', fn.temp(self.location.size), [fn.self_temp], self.location.offset)
+        return fn.variable(self.location)
+
+    def lower_reference(self, fn):
+        """
+        :return: (None, temp) of a variable, (object, offset) of a field
+        """
+        if self.is_field():
+            return fn.self_temp, self.location.offset
+        return None, fn.variable(self.location)
 
 class ExpLitInt(ExpBase):
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
-    def get_type(self, env):
+    def check_type(self, env):
         if not (-2**32 < self.value < 2**31 - 1):
             raise CompilerException('Constant does not fit in int type {}'.format(self.value), self)
 
         return INT_TYPE
 
-    def mov_to_register(self, location: RegisterLocation) -> List[str]:
-        return ['mov {}, {}'.format(location, self.value)]
+    def mov_to_register(self, location: RegisterLocation, out: Emitter):
+        out.emit(Instruction('mov', location.register, Immediate(self.value)))
 
     def get_real_value(self):
         return self.value
 
+    def operand(self):
+        return self.value
+
+    def lower(self, fn):
+        return ir.Const(self.value)
+
 
 class ExpLitTrue(ExpBase):
-    def get_type(self, env):
+    __slots__ = ()
+
+    def check_type(self, env):
         return BOOL_TYPE
 
     def generate_value(self):
         return '1', []
 
-    def boolean_jmp(self, if_true, if_false):
-        return ['jmp {}'.format(if_true)]
+    def boolean_jmp(self, if_true, if_false, out: Emitter):
+        out.emit(Instruction('jmp', if_true))
 
-    def mov_to_register(self, location: RegisterLocation) -> List[str]:
-        return ['mov {}, 1'.format(location)]
+    def mov_to_register(self, location: RegisterLocation, out: Emitter):
+        out.emit(Instruction('mov', location.register, Immediate(1)))
 
     def get_real_value(self):
         return True
 
+    def lower(self, fn):
+        return ir.Const(1)
+
+    def lower_jump(self, fn, if_true, if_false):
+        fn.emit('jmp', target=if_true)
+
 
 class ExpLitFalse(ExpBase):
-    def get_type(self, env):
+    __slots__ = ()
+
+    def check_type(self, env):
         return BOOL_TYPE
 
     def generate_value(self):
         return '0', []
 
-    def boolean_jmp(self, if_true, if_false):
-        return ['jmp {}'.format(if_false)]
+    def boolean_jmp(self, if_true, if_false, out: Emitter):
+        out.emit(Instruction('jmp', if_false))
 
-    def mov_to_register(self, location: RegisterLocation) -> List[str]:
-        return ['mov {}, 0'.format(location)]
+    def mov_to_register(self, location: RegisterLocation, out: Emitter):
+        out.emit(Instruction('mov', location.register, Immediate(0)))
 
     def get_real_value(self):
         return False
 
+    def lower(self, fn):
+        return ir.Const(0)
+
+    def lower_jump(self, fn, if_true, if_false):
+        fn.emit('jmp', target=if_false)
+
 
 class ExpLitString(ExpBase):
+    __slots__ = ('value', 'ptr')
+
     def __init__(self, value):
         self.value = value
         self.ptr = None
 
-    def get_type(self, env):
-        if self.value not in env['strings']:
-            env['strings'][self.value] = 'L{}'.format(Counter.get())
-        self.ptr = env['strings'][self.value]
+    def register_strings(self, pool):
+        pool.add(self.value)
+
+    def check_type(self, env):
+        self.ptr = env['strings'].add(self.value)
         return STRING_TYPE
 
-    def mov_to_register(self, location: RegisterLocation) -> List[str]:
-        return ['mov {}, {}'.format(location.full_name, self.ptr)]
+    def get_real_value(self):
+        """
+        :return: bytes of the string, escapes decoded
+        """
+        return StringPool.decode(self.value)
+
+    def mov_to_register(self, location: RegisterLocation, out: Emitter):
+        out.emit(Instruction('mov', location.full, Immediate(self.ptr)))
+
+    def lower(self, fn):
+        return ir.Symbol(self.ptr)
 
 
 class ExpLitNull(ExpBase):
-    def mov_to_register(self, location: RegisterLocation) -> List[str]:
-        return ['xor {}, {}'.format(location.full_name, location.full_name)]
+    __slots__ = ()
+
+    def mov_to_register(self, location: RegisterLocation, out: Emitter):
+        out.emit(Instruction('xor', location.full, location.full))
+
+    def lower(self, fn):
+        return ir.Const(0)
 
     INSTANCE = None
 
@@ -144,11 +246,13 @@ class ExpLitNull(ExpBase):
             ExpLitNull.INSTANCE = ExpLitNull()
         return ExpLitNull.INSTANCE
 
-    def get_type(self, env):
+    def check_type(self, env):
         return NULL_TYPE
 
 
 class ExpApp(ExpBase):
+    __slots__ = ('name', 'args', 'type')
+
     RESULT_REGISTER = RegisterLocation('eax', 'rax')
 
     def __init__(self, name, args):
@@ -156,8 +260,10 @@ class ExpApp(ExpBase):
         self.args = args
         self.type = None
 
-    def get_type(self, env):
-        types = [x.get_type(env) for x in self.args]
+    def check_type(self, env):
+        types = []
+        for x in self.args:
+            types.append((yield x.get_type(env)))
         try:
             try:
                 env['fun'][self.name]['args'].check_types(types, env)
@@ -169,57 +275,81 @@ class ExpApp(ExpBase):
             raise UndefinedVariableException('Function {} is undefined'.format(self.name), self)
 
     @classmethod
-    def mov_any_call_to_register(cls, location: RegisterLocation, name: str, args):
-        result = [
-            'push r12',
-            'mov r12, rsp',
-            'and rsp, 0xFFFFFFFFFFFFFFF0',
-        ]
+    def mov_any_call_to_register(cls, location: RegisterLocation, target, args, out: Emitter, before_call=(),
+                                 saves=()):
+        """
+        Calls target (asm.Label or asm.Memory) with args pushed on the aligned stack and moves the result to location.
+        :param before_call: instructions emitted after the arguments are evaluated, right before the call
+        :param saves: registers the call may change that have to be kept, see Emitter.saves
+        """
+        if location != cls.RESULT_REGISTER:
+            out.emit(Instruction('push', RAX))
+
+        for register in saves:
+            out.emit(Instruction('push', register.full))
+
+        out.emit(Instruction('push', R12),
+                 Instruction('mov', R12, RSP),
+                 Instruction('and', RSP, Immediate(-16)))
 
         if len(args) % 2 == 0:
-            result.append('sub rsp, 8')
+            out.emit(Instruction('sub', RSP, Immediate(8)))
 
         for e in reversed(args):
-            result += e.mov_to_register(cls.RESULT_REGISTER)
-            result += ['push {}'.format(cls.RESULT_REGISTER.full_name)]
+            yield e.mov_to_register(cls.RESULT_REGISTER, out)
+            out.emit(Instruction('push', RAX))
 
-        result += [
-            'call {}'.format(name),
-            'mov rsp, r12',
-            'pop r12',
-            # 'add rsp, {}'.format(len(args) * 8)
-        ]
+        out.extend(before_call)
+        out.emit(Instruction('call', target),
+                 Instruction('mov', RSP, R12),
+                 Instruction('pop', R12))
+
+        for register in reversed(saves):
+            out.emit(Instruction('pop', register.full))
 
         if location != cls.RESULT_REGISTER:
-            result = ['push {}'.format(cls.RESULT_REGISTER.full_name)] + result + [
-                'mov {}, {}'.format(location.full_name, cls.RESULT_REGISTER.full_name),
-                'pop {}'.format(cls.RESULT_REGISTER.full_name)
-            ]
+            out.emit(Instruction('mov', location.full, RAX),
+                     Instruction('pop', RAX))
 
-        return result
+    def mov_to_register(self, location: RegisterLocation, out: Emitter):
+        return self.mov_any_call_to_register(location, Label('top_' + self.name), self.args, out,
+                                             saves=out.saves(self, location))
 
-    def mov_to_register(self, location: RegisterLocation):
-        return self.mov_any_call_to_register(location, 'top_' + self.name, self.args)
+    @staticmethod
+    def lower_args(args, fn):
+        """
+        :return: operands of args, evaluated last to first like mov_any_call_to_register does
+        """
+        values = []
+        for e in reversed(args):
+            values.append((yield e.lower(fn)))
+        return values[::-1]
+
+    def lower(self, fn):
+        args = yield self.lower_args(self.args, fn)
+        dest = fn.temp(get_size(self.type)) if self.type != VOID_TYPE else None
+        return fn.emit('call', dest, args, 'top_' + self.name)
 
-    def boolean_jmp(self, if_true, if_false):
+    def boolean_jmp(self, if_true, if_false, out: Emitter):
         r = RegisterLocation('eax', 'rax')
-        result = ['push rax'] + self.mov_to_register(r)
+        out.emit(Instruction('push', RAX))
+        yield self.mov_to_register(r, out)
 
-        return result + [
-                'cmp rax, 0',
-                'pop rax',
-                'je {}'.format(if_false),
-                'jmp {}'.format(if_true)
-            ]
+        out.emit(Instruction('cmp', RAX, Immediate(0)),
+                 Instruction('pop', RAX),
+                 Instruction('je', if_false),
+                 Instruction('jmp', if_true))
 
 
 class ExpOperator(ExpBase):
+    __slots__ = ('operator',)
+
     def __init__(self, operator):
         self.operator = operator
 
-    def get_type(self, env):
+    def check_type(self, env):
         try:
-            return self.operator.get_type(env)
+            return (yield self.operator.get_type(env))
         except CompilerException as e:
             if e.obj.line is None or e.obj.column is None:
                 raise CompilerException(e.rlmsg, self)
@@ -227,105 +357,126 @@ class ExpOperator(ExpBase):
                 raise e
 
 
-    def mov_to_register(self, location: RegisterLocation):
-        return self.operator.calc_to_register(location)
+    def mov_to_register(self, location: RegisterLocation, out: Emitter):
+        return self.operator.calc_to_register(location, out)
 
-    def boolean_jmp(self, if_true, if_false):
-        return self.operator.boolean_jmp(if_true, if_false)
+    def boolean_jmp(self, if_true, if_false, out: Emitter):
+        return self.operator.boolean_jmp(if_true, if_false, out)
 
     def get_real_value(self):
-        self.operator.get_real_value()
+        return (yield self.operator.get_real_value())
+
+    def get_condition_value(self):
+        return False
+
+    def lower(self, fn):
+        return self.operator.lower(fn)
+
+    def lower_jump(self, fn, if_true, if_false):
+        return self.operator.lower_jump(fn, if_true, if_false)
 
 
 class ExpNew(ExpBase):
+    __slots__ = ('type', 'cls')
+
     def __init__(self, type):
         self.type = type
         self.cls = None
 
-    def get_type(self, env):
+    def check_type(self, env):
         try:
             self.cls = env['cls'][self.type.type_name]
         except KeyError:
             raise UndefinedVariableException('Class {} undefined'.format(self.type), self)
         return self.type
 
-    def mov_to_register(self, location: RegisterLocation):
-        result = [
-            'push rdi',
-            'mov rdi, {}'.format(self.cls.size),
-            'call malloc',
-            'mov QWORD [rax], {}'.format('vtable_' + self.cls.name)
-        ]
+    def mov_to_register(self, location: RegisterLocation, out: Emitter):
+        if location.full != RAX:
+            out.emit(Instruction('push', RAX))
+
+        saves = out.saves(self, location)
+        out.emit(Instruction('push', RDI))
+        for register in saves:
+            out.emit(Instruction('push', register.full))
+
+        out.emit(Instruction('mov', RDI, Immediate(self.cls.size)),
+                 Instruction('call', Label('malloc')),
+                 Instruction('mov', Memory('rax', 0, 8), Immediate('vtable_' + self.cls.name)))
+
+        for attr in self.cls.all_fields:
+            out.emit(Instruction('mov', Memory('rax', self.cls.get_attr_offset(attr.name), 8), Immediate(0)))
 
-        offset = 8
-        for obj in self.cls.vt_table:
-            for _ in obj['fields']:
-                result.append('mov QWORD [rax + {}], 0'.format(offset))
-                offset += 8
+        for register in reversed(saves):
+            out.emit(Instruction('pop', register.full))
+        out.emit(Instruction('pop', RDI))
 
-        result.append('pop rdi')
+        if location.full != RAX:
+            out.emit(Instruction('mov', location.full, RAX),
+                     Instruction('pop', RAX))
 
-        if location.full_name != 'rax':
-            result.insert(0, 'push rax')
-            result.append('mov {}, rax'.format(location.full_name))
-            result.append('pop rax')
-        return result
+    def lower(self, fn):
+        return fn.emit('new', fn.temp(8), target=self.cls)
 
 
 class ExpAttribute(ExpBase):
+    __slots__ = ('expr', 'attr', 'cls', 'type')
+
     def __init__(self, expr, attr):
         self.expr = expr
         self.attr = attr
         self.cls = None
         self.type = None
 
-    def get_type(self, env):
-        cls = self.expr.get_type(env).type_name
+    def check_type(self, env):
+        cls = (yield self.expr.get_type(env)).type_name
 
         try:
-            attr = env['cls'][cls].get_attribute(self.attr, env)
+            attr = env['cls'][cls].get_attribute(self.attr)
             self.cls = env['cls'][cls]
             self.type = attr.type
             return self.type
         except KeyError:
             raise UndefinedVariableException('Class {} is undefined'.format(cls), self)
 
-    def mov_to_register(self, location: RegisterLocation) -> List[str]:
-        result = self.expr.mov_to_register(location)
+    def mov_to_register(self, location: RegisterLocation, out: Emitter):
+        yield self.expr.mov_to_register(location, out)
         offset = self.cls.get_attr_offset(self.attr)
-
-        if get_size(self.type) == 4:
-            register = location
-            type = 'DWORD'
-        else:
-            register = location.full_name
-            type = 'QWORD'
-
-        result.append('mov {}, {} [{}+{}]'.format(register, type, location.full_name, offset))
-        return result
+        size = get_size(self.type)
+        out.emit(Instruction('mov', location.sized(size), Memory(location.full_name, offset, size)))
 
     def is_reference(self):
         return True
 
-    def get_reference(self, location: RegisterLocation):
-        result = self.mov_to_register(location)
-        result[-1] = result[-1].replace('mov', 'lea').replace(location.location, location.full_name).replace('DWORD', '').replace('QWORD', '')
-        return result
+    def get_reference(self, location: RegisterLocation, out: Emitter):
+        yield self.expr.mov_to_register(location, out)
+        out.emit(Instruction('lea', location.full, Memory(location.full_name, self.cls.get_attr_offset(self.attr))))
+
+    def lower(self, fn):
+        base = yield self.expr.lower(fn)
+        return fn.emit('load', fn.temp(get_size(self.type)), [base], self.cls.get_attr_offset(self.attr))
+
+    def lower_reference(self, fn):
+        base = yield self.expr.lower(fn)
+        return base, self.cls.get_attr_offset(self.attr)
 
 
 class ExpMethodCall(ExpBase):
+    __slots__ = ('expr', 'method', 'args', 'cls')
+
     def __init__(self, expr, method, args):
         self.expr = expr
         self.method = method
         self.args = args
         self.cls = None
 
-    def get_type(self, env):
-        types = [x.get_type(env) for x in self.args]
-        cls = self.expr.get_type(env).type_name
+    def check_type(self, env):
+        types = []
+        for x in self.args:
+            types.append((yield x.get_type(env)))
+        cls = (yield self.expr.get_type(env)).type_name
 
         try:
-            method = env['cls'][cls].get_method(self.method, env)
+            method = env['cls'][cls].get_method(self.method)
             try:
                 method.args.check_types(types, env)
             except CompilerException as e:
@@ -335,42 +486,51 @@ class ExpMethodCall(ExpBase):
         except KeyError:
             raise UndefinedVariableException('Class {} is undefined'.format(cls), self)
 
-    def mov_to_register(self, location: RegisterLocation):
+    def mov_to_register(self, location: RegisterLocation, out: Emitter):
         r = RegisterLocation('r14d', 'r14')
         offset = self.cls.get_method_offset(self.method)
 
-        result = ['push r14', 'push r13']
-        result += self.expr.mov_to_register(r)
+        out.emit(Instruction('push', R14), Instruction('push', R13))
+        yield self.expr.mov_to_register(r, out)
 
-        result += ExpApp.mov_any_call_to_register(location, '[r14 + {}]'.format(offset), [r] + self.args)
+        yield ExpApp.mov_any_call_to_register(location, Memory('r14', offset), [r] + self.args, out,
+                                              before_call=[Instruction('mov', R13, R14),
+                                                           Instruction('mov', R14, Memory('r14', 0, 8))],
+                                              saves=out.saves(self, location))
 
-        idx = result.index('call [r14 + {}]'.format(offset))
+        out.emit(Instruction('pop', R13), Instruction('pop', R14))
 
-        result = result[:idx] + ['mov r13, r14', 'mov r14, QWORD [r14]'] + result[idx:]
+    def lower(self, fn):
+        obj = yield self.expr.lower(fn)
+        args = yield ExpApp.lower_args(self.args, fn)
+        dest = fn.temp(get_size(self.checked_type)) if self.checked_type != VOID_TYPE else None
+        return fn.emit('callv', dest, [obj] + args, self.cls.get_method_offset(self.method))
 
-        return result + ['pop r13', 'pop r14']
-
-    def boolean_jmp(self, if_true, if_false):
+    def boolean_jmp(self, if_true, if_false, out: Emitter):
         r = RegisterLocation('eax', 'rax')
-        result = ['push rax'] + self.mov_to_register(r)
+        out.emit(Instruction('push', RAX))
+        yield self.mov_to_register(r, out)
 
-        return result + [
-            'cmp rax, 0',
-            'pop rax',
-            'je {}'.format(if_false),
-            'jmp {}'.format(if_true)
-        ]
+        out.emit(Instruction('cmp', RAX, Immediate(0)),
+                 Instruction('pop', RAX),
+                 Instruction('je', if_false),
+                 Instruction('jmp', if_true))
 
 class ExpCast(ExpBase):
+    __slots__ = ('expr', 'type')
+
     def __init__(self, expr, type):
         self.expr = expr
         self.type = type
 
-    def get_type(self, env):
-        t = self.expr.get_type(env)
+    def check_type(self, env):
+        t = yield self.expr.get_type(env)
         if not can_be_casted(t, self.type, env):
             raise InvalidCastException("Type {} cannot be casted to {}".format(t, self.type), self)
         return self.type
 
-    def mov_to_register(self, location: RegisterLocation):
-        return self.expr.mov_to_register(location)
\ No newline at end of file
+    def mov_to_register(self, location: RegisterLocation, out: Emitter):
+        return self.expr.mov_to_register(location, out)
+
+    def lower(self, fn):
+        return self.expr.lower(fn)
@@ -0,0 +1,487 @@
+"""
+Hand-written front end for Latte: a tokenizer and a recursive descent parser with precedence climbing for binary
+operators. It needs nothing outside the standard library and builds the same AST as the lark grammar in
+grammar_test.py, with the same line and column on every node, so the two parsers are interchangeable.
+
+The lark parser lexes every token in the context of the LALR state, and a few of its quirks are kept on purpose:
+ - a word is a keyword only where the grammar accepts that keyword (int if = 1; declares a variable named if),
+   after the closing brace of a block every keyword but extends is reserved and after a class name extends is,
+ - "(" id ")" at the start of an operand is always a cast, so (a) alone is a syntax error, but -(a) is not,
+ - "--" at the start of an operand is two minuses, elsewhere it is the decrement,
+ - a block comment extends to the last */ of the file.
+Nested constructs are parsed by generators run with compiler.trampoline, so nesting depth is not limited by the
+Python stack.
+"""
+import re
+
+from compiler import ClassDef, Field, FunDef, Block, Args, VarDef, Program, trampoline
+from expr import ExpVariable, ExpLitInt, ExpLitTrue, ExpLitFalse, ExpLitString, ExpLitNull, ExpApp, ExpOperator, \
+    ExpNew, ExpAttribute, ExpMethodCall, ExpCast, get_default_value
+from oprt import PlusOperator, MinusOperator, TimesOperator, DivisionOperator, ModOperator, LTOperator, LEOperator, \
+    GTOperator, GEOperator, EQOperator, NEOperator, NegOperator, NotOperator, AndOperator, OrOperator
+from stmt import BlockStmt, DeclStmt, AsgStmt, PPStmt, MMStrmt, RetVoidStmt, RetValueStmt, IfStmt, EmptyStmt, \
+    IfElseStmt, WhileStmt, ExprStmt
+from type import Type, INT_TYPE, BOOL_TYPE, STRING_TYPE, VOID_TYPE
+
+# whitespace is matched in front of every token, most frequent tokens first
+TOKEN = re.compile(r'''
+    [ \t\f\r\n]*
+    (?:
+      (?P<name>[A-Za-z_][A-Za-z_0-9]*)
+    | (?P<op><=|>=|==|!=|&&|\|\||\+\+|--|[-+*%<>=!(){},;.]|/(?![*/]))
+    | (?P<int>[0-9]+)
+    | (?P<string>"(?:[^"\\\n]|\\.)*")
+    | (?P<comment>//[^\n]*|\#[^\n]*)
+    | (?P<block>/\*)
+    | (?P<end>\Z)
+    )''', re.VERBOSE)
+
+SPACE = re.compile(r'[ \t\f\r\n]*')
+
+TYPES = {'int': INT_TYPE, 'string': STRING_TYPE, 'boolean': BOOL_TYPE, 'void': VOID_TYPE}
+
+LITERALS = {'true': ExpLitTrue, 'false': ExpLitFalse, 'null': ExpLitNull}
+
+STATEMENT_KEYWORDS = {'return', 'if', 'while', 'new'} | set(TYPES) | set(LITERALS)
+
+# keywords the lark lexer reserves after "}" of a block, where a statement, a member or a definition may follow
+AFTER_BLOCK_KEYWORDS = STATEMENT_KEYWORDS | {'else', 'class'}
+
+AFTER_CLASS_NAME = ('extends',)
+
+# operator token -> (precedence, operator class); || and && are right associative
+BINARY_OPERATORS = {
+    '||': (1, OrOperator),
+    '&&': (2, AndOperator),
+    '<': (3, LTOperator),
+    '<=': (3, LEOperator),
+    '>': (3, GTOperator),
+    '>=': (3, GEOperator),
+    '==': (3, EQOperator),
+    '!=': (3, NEOperator),
+    '+': (4, PlusOperator),
+    '-': (4, MinusOperator),
+    '*': (5, TimesOperator),
+    '/': (5, DivisionOperator),
+    '%': (5, ModOperator),
+}
+
+RIGHT_ASSOCIATIVE = 2
+
+
+class ParseError(Exception):
+    def __init__(self, token):
+        kind, value, line, column = token
+        what = 'end of input' if kind == '$END' else repr(value)
+        super().__init__('Unexpected {} at line {} column {}'.format(what, line, column))
+        self.line = line
+        self.column = column
+
+
+def tokenize(text):
+    """
+    Splits Latte source into tokens.
+    :return: list of (kind, value, line, column) tuples, kind is 'name', 'int', 'string' or the punctuation itself.
+    The list ends with '$END' at the position of the last token, as lark reports it. A character that does not start
+    any token ends the list with an '$ERROR' token, so the parser reports the first error in source order.
+    """
+    tokens = []
+    append = tokens.append
+    match = TOKEN.match
+    pos = 0
+    line = 1
+    line_start = 0
+    while True:
+        m = match(text, pos)
+        if m is None:
+            kind = '$ERROR'
+            start = SPACE.match(text, pos).end()
+        else:
+            kind = m.lastgroup
+            start = m.start(kind)
+        if start != pos and '\n' in text[pos:start]:
+            line += text.count('\n', pos, start)
+            line_start = text.rindex('\n', pos, start) + 1
+
+        if kind == 'name' or kind == 'int' or kind == 'string':
+            append((kind, m.group(kind), line, start - line_start + 1))
+        elif kind == 'op':
+            value = m.group(kind)
+            append((value, value, line, start - line_start + 1))
+        elif kind == 'block':
+            # lark's /\*(.|\n|\r)+\*/ is greedy and needs a character between the delimiters
+            close = text.rfind('*/')
+            if close < start + 3:
+                append(('/', '/', line, start - line_start + 1))
+                pos = start + 1
+                continue
+            pos = close + 2
+            if '\n' in text[start:pos]:
+                line += text.count('\n', start, pos)
+                line_start = text.rindex('\n', start, pos) + 1
+            continue
+        elif kind == '$ERROR':
+            append((kind, text[start], line, start - line_start + 1))
+            return tokens
+        elif kind == 'end':
+            break
+        pos = m.end()
+
+    last = tokens[-1] if tokens else ('$END', '', 1, 1)
+    append(('$END', '', last[2], last[3]))
+    return tokens
+
+
+def located(node, token):
+    node.line = token[2]
+    node.column = token[3]
+    return node
+
+
+def atom(token):
+    kind, value = token[0], token[1]
+    if kind == 'int':
+        return located(ExpLitInt(int(value)), token)
+    if kind == 'string':
+        return located(ExpLitString(value), token)
+    if value in LITERALS:
+        return located(LITERALS[value](), token)
+    return located(ExpVariable(value), token)
+
+
+class Parser:
+    """
+    Drop-in replacement for the lark parser returned by grammar_test.get_parser().
+    """
+
+    def parse(self, text):
+        """
+        :return: Program
+        :raises ParseError: on syntax errors
+        """
+        return trampoline(_Parse(tokenize(text)).program())
+
+
+class _Parse:
+    """
+    State of one parse. Methods that parse nested constructs are generators yielding the parse of the nested part,
+    expression methods return the node together with the first token of its source, which positions the enclosing
+    node.
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.index = 0
+        self.class_end = -1
+
+    def expect(self, kind):
+        token = self.tokens[self.index]
+        if token[0] != kind:
+            raise ParseError(token)
+        self.index += 1
+        return token
+
+    def name(self, reserved=()):
+        token = self.tokens[self.index]
+        if token[0] != 'name' or token[1] in reserved:
+            raise ParseError(token)
+        self.index += 1
+        return token[1]
+
+    def after_block(self):
+        previous = self.index - 1
+        return previous >= 0 and previous != self.class_end and self.tokens[previous][0] == '}'
+
+    def type_(self):
+        """
+        :return: type and its token
+        """
+        token = self.tokens[self.index]
+        if token[0] != 'name' or token[1] in AFTER_BLOCK_KEYWORDS and token[1] not in TYPES and self.after_block():
+            raise ParseError(token)
+        self.index += 1
+        return TYPES.get(token[1]) or Type(token[1]), token
+
+    def typed_name(self):
+        """
+        Type followed by a name, as in definitions and arguments.
+        :return: type, name and the token of the type
+        """
+        type_, start = self.type_()
+        return type_, self.name(() if start[1] in TYPES else AFTER_CLASS_NAME), start
+
+    # ==== Definitions ====
+
+    def program(self):
+        functions = []
+        classes = []
+        while True:
+            token = self.tokens[self.index]
+            if token[0] == '$END' and (functions or classes):
+                return Program(functions, classes)
+            if token[0] == 'name' and token[1] == 'class':
+                classes.append((yield self.class_def()))
+            else:
+                functions.append((yield self.fun_def(*self.typed_name())))
+
+    def class_def(self):
+        start = self.expect('name')
+        name = self.name()
+        parent = None
+        token = self.tokens[self.index]
+        if token[0] == 'name' and token[1] == 'extends':
+            self.index += 1
+            parent = self.name()
+        self.expect('{')
+
+        fields = []
+        methods = []
+        while self.tokens[self.index][0] != '}':
+            type_, member, member_start = self.typed_name()
+            if self.tokens[self.index][0] == ';':
+                self.index += 1
+                fields.append(located(Field(member, type_), member_start))
+            else:
+                methods.append((yield self.fun_def(type_, member, member_start)))
+        self.class_end = self.index
+        self.index += 1
+
+        result = ClassDef(name, fields, methods)
+        if parent is not None:
+            result.parent = parent
+            located(result, start)
+        return result
+
+    def fun_def(self, type_, name, start):
+        self.expect('(')
+        if self.tokens[self.index][0] == ')':
+            args = Args([])
+        else:
+            arg_type, arg_name, args_start = self.typed_name()
+            args = [(arg_type, arg_name)]
+            while self.tokens[self.index][0] == ',':
+                self.index += 1
+                arg_type, arg_name, _ = self.typed_name()
+                args.append((arg_type, arg_name))
+            args = located(Args(args), args_start)
+        self.expect(')')
+        block = yield self.block()
+        return located(FunDef(type_, name, args, block), start)
+
+    # ==== Statements ====
+
+    def block(self):
+        start = self.expect('{')
+        stmts = []
+        first = True
+        while self.tokens[self.index][0] != '}':
+            stmts.append((yield self.statement(first)))
+            first = False
+        self.index += 1
+        return located(Block(stmts), start)
+
+    def statement(self, first=True):
+        """
+        :param first: statement does not follow another one, else is not a keyword there
+        """
+        tokens = self.tokens
+        start = tokens[self.index]
+        kind = start[0]
+        if kind == '{':
+            return BlockStmt((yield self.block()))
+        if kind == ';':
+            self.index += 1
+            return located(EmptyStmt(), start)
+
+        if kind == 'name':
+            word = start[1]
+            if word in STATEMENT_KEYWORDS or word == 'else' and not first or \
+                    word in AFTER_BLOCK_KEYWORDS and self.after_block():
+                if word == 'return':
+                    self.index += 1
+                    if tokens[self.index][0] == ';':
+                        self.index += 1
+                        return located(RetVoidStmt(), start)
+                    value, _ = yield self.expression()
+                    self.expect(';')
+                    return located(RetValueStmt(value), start)
+                if word == 'if':
+                    self.index += 1
+                    self.expect('(')
+                    cond, _ = yield self.expression()
+                    self.expect(')')
+                    stmt = yield self.statement()
+                    token = tokens[self.index]
+                    if token[0] == 'name' and token[1] == 'else':
+                        self.index += 1
+                        return located(IfElseStmt(cond, stmt, (yield self.statement())), start)
+                    return located(IfStmt(cond, stmt), start)
+                if word == 'while':
+                    self.index += 1
+                    self.expect('(')
+                    cond, _ = yield self.expression()
+                    self.expect(')')
+                    return located(WhileStmt(cond, (yield self.statement())), start)
+                if word in TYPES:
+                    self.index += 1
+                    return (yield self.declaration(TYPES[word], start))
+                if word not in LITERALS and word != 'new':
+                    raise ParseError(start)
+            elif tokens[self.index + 1][0] == 'name':
+                self.index += 1
+                return (yield self.declaration(Type(word), start))
+
+        expr, _ = yield self.expression()
+        token = tokens[self.index]
+        self.index += 1
+        if token[0] == '=':
+            value, _ = yield self.expression()
+            self.expect(';')
+            return located(AsgStmt(expr, value), start)
+        if token[0] == '++':
+            self.expect(';')
+            return located(PPStmt(expr), start)
+        if token[0] == '--':
+            self.expect(';')
+            return located(MMStrmt(expr), start)
+        if token[0] == ';':
+            return located(ExprStmt(expr), start)
+        raise ParseError(token)
+
+    def declaration(self, type_, start):
+        reserved = () if start[1] in TYPES else AFTER_CLASS_NAME
+        variables = []
+        while True:
+            name = self.name(reserved)
+            reserved = ()
+            if self.tokens[self.index][0] == '=':
+                self.index += 1
+                value, _ = yield self.expression()
+                variables.append(VarDef(type_, name, value))
+            else:
+                variables.append(VarDef(type_, name, get_default_value(type_)))
+            if self.tokens[self.index][0] != ',':
+                break
+            self.index += 1
+        self.expect(';')
+        return located(DeclStmt(type_, variables), start)
+
+    # ==== Expressions ====
+
+    def expression(self, min_precedence=1):
+        """
+        Precedence climbing over BINARY_OPERATORS. A literal or a variable that no operator binds to, the most common
+        expression, is returned directly, anything else as a generator for the trampoline.
+        :return: node and its first token
+        """
+        left = self.leaf()
+        if left is not None:
+            binary = BINARY_OPERATORS.get(self.tokens[self.index][0])
+            if binary is None or binary[0] < min_precedence:
+                return left
+        return self.climb(left, min_precedence)
+
+    def climb(self, left, min_precedence):
+        if left is None:
+            left = yield self.operand()
+        left, start = left
+        tokens = self.tokens
+        while True:
+            token = tokens[self.index]
+            try:
+                precedence, operator = BINARY_OPERATORS[token[0]]
+            except KeyError:
+                return left, start
+            if precedence < min_precedence:
+                return left, start
+            self.index += 1
+
+            if precedence <= RIGHT_ASSOCIATIVE:
+                right, _ = yield self.expression(precedence)
+                left = located(ExpOperator(operator(left, right)), start)
+            else:
+                right, _ = yield self.expression(precedence + 1)
+                left = ExpOperator(located(operator(left, right), token))
+
+    def leaf(self):
+        """
+        :return: literal or variable at the current token and the token, None if it is not one or a call or an
+        attribute access starts there
+        """
+        tokens = self.tokens
+        start = tokens[self.index]
+        kind = start[0]
+        if kind == 'name' and start[1] != 'new' or kind == 'int' or kind == 'string':
+            follow = tokens[self.index + 1][0]
+            if follow != '(' and follow != '.':
+                self.index += 1
+                return atom(start), start
+        return None
+
+    def operand(self, cast=True):
+        """
+        Operand of a binary operator (or the operand of a cast when cast is set), or of a unary operator otherwise:
+        casts and new can not follow - and !.
+        :return: node and its first token
+        """
+        tokens = self.tokens
+        index = self.index
+        start = tokens[index]
+        kind = start[0]
+
+        if cast:
+            if kind == '(':
+                name = tokens[index + 1]
+                if name[0] == 'name' and name[1] not in LITERALS and name[1] != 'new' and tokens[index + 2][0] == ')':
+                    self.index = index + 3
+                    expr, _ = self.leaf() or (yield self.operand())
+                    return located(ExpCast(expr, Type(name[1])), start), start
+            elif kind == 'name' and start[1] == 'new':
+                self.index = index + 1
+                return located(ExpNew(Type(self.name())), start), start
+
+        if kind == '-' or kind == '!':
+            self.index = index + 1
+            expr, _ = self.leaf() or (yield self.operand(False))
+            operator = NegOperator if kind == '-' else NotOperator
+            return located(ExpOperator(operator(expr)), start), start
+        if kind == '--':
+            self.index = index + 1
+            expr, _ = self.leaf() or (yield self.operand(False))
+            inner = located(ExpOperator(NegOperator(expr)), (kind, '-', start[2], start[3] + 1))
+            return located(ExpOperator(NegOperator(inner)), start), start
+        if kind == '!=':
+            raise ParseError(('=', '=', start[2], start[3] + 1))
+
+        self.index = index + 1
+        if kind == '(':
+            expr, _ = yield self.expression()
+            self.expect(')')
+        elif kind == 'name' and start[1] not in LITERALS and tokens[index + 1][0] == '(':
+            expr = located(ExpApp(start[1], (yield self.arguments())), start)
+        elif kind == 'name' or kind == 'int' or kind == 'string':
+            expr = atom(start)
+        else:
+            raise ParseError(start)
+
+        while tokens[self.index][0] == '.':
+            self.index += 1
+            name = self.name()
+            if tokens[self.index][0] == '(':
+                expr = located(ExpMethodCall(expr, name, (yield self.arguments())), start)
+            else:
+                expr = located(ExpAttribute(expr, name), start)
+        return expr, start
+
+    def arguments(self):
+        self.expect('(')
+        args = []
+        if self.tokens[self.index][0] != ')':
+            while True:
+                arg, _ = yield self.expression()
+                args.append(arg)
+                if self.tokens[self.index][0] != ',':
+                    break
+                self.index += 1
+        self.expect(')')
+        return args
@@ -0,0 +1,178 @@
+"""
+Constant folding and propagation over the body of a checked function, run at -O1 before register allocation and
+lowering (FunDef.check_body).
+
+An expression whose value the operators compute with get_real_value is replaced by a literal: ints, bools and
+concatenations of string literals. Integer arithmetic is the machine's, results wrap to 32 bits and division truncates
+towards zero; divisions idiv traps on are not folded. A local variable that is never assigned, incremented or
+decremented after its declaration keeps the value it was declared with, so when that value is a literal its reads
+are replaced by the literal as well.
+
+Strings are concatenated as decoded bytes, so an escape never runs into the other operand, and the result is pooled
+under a literal quoting those bytes (StringPool.quote). The labels of string literals are fixed before any function is
+checked, possibly in another process. register_strings adds the concatenations of literals written in the source to
+the StringPool beforehand; a concatenation that only becomes constant by propagation stays a call of strConcat.
+
+    int x = 1024 * 4;          int x = 4096;
+    printInt(x + y);    ->     printInt(4096 + y);
+"""
+import compiler
+import expr
+import oprt
+import stmt
+from type import BOOL_TYPE, INT_TYPE, STRING_TYPE
+
+LITERALS = (expr.ExpLitInt, expr.ExpLitTrue, expr.ExpLitFalse, expr.ExpLitString)
+
+
+def children(node):
+    """
+    Child nodes of node in FIELDS order, without the classes that expressions refer to after checking.
+    """
+    result = []
+    for field in node.FIELDS:
+        value = getattr(node, field)
+        if isinstance(value, list):
+            result.extend(item for item in value if isinstance(item, compiler.BaseBase))
+        elif isinstance(value, compiler.BaseBase) and not isinstance(value, compiler.ClassDef):
+            result.append(value)
+    return result
+
+
+def postorder(root):
+    """
+    Nodes of the subtree, children before their parent and in source order otherwise.
+    """
+    stack = [(root, False)]
+    while stack:
+        node, done = stack.pop()
+        if done:
+            yield node
+            continue
+        stack.append((node, True))
+        stack.extend((child, False) for child in reversed(children(node)))
+
+
+def string_concatenation(node, values):
+    """
+    :param values: id of a node -> its bytes, for the nodes visited before
+    :return: bytes of node if it is a string literal or a concatenation of string literals, otherwise None
+    """
+    if isinstance(node, expr.ExpLitString):
+        return node.get_real_value()
+    if isinstance(node, expr.ExpOperator) and isinstance(node.operator, oprt.PlusOperator):
+        left, right = values.get(id(node.operator.param1)), values.get(id(node.operator.param2))
+        if left is not None and right is not None:
+            return left + right
+    return None
+
+
+def register_strings(program, pool):
+    """
+    Adds the outermost concatenations of string literals of the program to pool, before the functions are checked.
+    """
+    values = {}
+    inner = set()
+    concatenations = []
+    for _, fun in program.units():
+        for node in postorder(fun.block):
+            value = string_concatenation(node, values)
+            if value is None:
+                continue
+            values[id(node)] = value
+            if isinstance(node, expr.ExpOperator):
+                inner.update((id(node.operator.param1), id(node.operator.param2)))
+                concatenations.append(node)
+    for node in concatenations:
+        if id(node) not in inner:
+            pool.add(compiler.StringPool.quote(values[id(node)]))
+
+
+def assigned_locations(block):
+    """
+    :return: ids of the locations of variables that are assigned, incremented or decremented in the block
+    """
+    assigned = set()
+    for node in postorder(block):
+        if isinstance(node, (stmt.AsgStmt, stmt.PPStmt, stmt.MMStrmt)) and isinstance(node.expr, expr.ExpVariable):
+            assigned.add(id(node.expr.location))
+    return assigned
+
+
+def literal(value, checked_type, pool, position):
+    """
+    :return: checked literal node of value, None for a string the pool has no label of
+    """
+    if checked_type == BOOL_TYPE:
+        node = expr.ExpLitTrue() if value else expr.ExpLitFalse()
+    elif checked_type == INT_TYPE:
+        node = expr.ExpLitInt(value)
+    elif checked_type == STRING_TYPE and compiler.StringPool.quote(value) in pool.labels:
+        node = expr.ExpLitString(compiler.StringPool.quote(value))
+        node.ptr = pool.labels[node.value]
+    else:
+        return None
+    node.checked_type = checked_type
+    node.line, node.column = position.line, position.column
+    return node
+
+
+def evaluable(operator):
+    """
+    :return: whether get_real_value of operator only looks at literals, it would walk a whole subtree otherwise
+    """
+    if isinstance(operator, oprt.OneParamOperatorBase):
+        return isinstance(operator.param, LITERALS)
+    if isinstance(operator.param1, expr.ExpLitFalse) and isinstance(operator, oprt.AndOperator) or \
+            isinstance(operator.param1, expr.ExpLitTrue) and isinstance(operator, oprt.OrOperator):
+        return True
+    return isinstance(operator.param1, LITERALS) and isinstance(operator.param2, LITERALS)
+
+
+class Folder:
+    """
+    Replaces the constant expressions of a function body, see the module docstring.
+    """
+
+    def __init__(self, block, pool):
+        self.block = block
+        self.pool = pool
+        self.assigned = assigned_locations(block)
+        # id of the location of a constant local -> its literal
+        self.constants = {}
+
+    def fold(self):
+        for node in postorder(self.block):
+            for field in node.FIELDS:
+                value = getattr(node, field)
+                if isinstance(value, list):
+                    value[:] = [self.constant(item) or item if isinstance(item, expr.ExpBase) else item
+                                for item in value]
+                elif isinstance(value, expr.ExpBase):
+                    replacement = self.constant(value)
+                    if replacement is not None:
+                        setattr(node, field, replacement)
+            if isinstance(node, compiler.VarDef) and id(node.location) not in self.assigned \
+                    and isinstance(node.value, LITERALS):
+                self.constants[id(node.location)] = node.value
+
+    def constant(self, node):
+        """
+        :return: literal replacing node, whose subexpressions are folded already, None if it is not constant
+        """
+        if isinstance(node, expr.ExpVariable):
+            value = self.constants.get(id(node.location))
+            if value is None:
+                return None
+            return literal(value.get_real_value(), node.checked_type, self.pool, node)
+        if not isinstance(node, expr.ExpOperator) or not evaluable(node.operator):
+            return None
+        try:
+            value = compiler.trampoline(node.get_real_value())
+        except AttributeError:
+            return None
+        return literal(value, node.checked_type, self.pool, node)
+
+
+def fold(block, pool):
+    Folder(block, pool).fold()
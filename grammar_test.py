@@ -1,6 +1,13 @@
+import contextlib
+import cProfile
+import functools
+import hashlib
+import multiprocessing
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
-from lark import Tree, Token
+from lark import Token
 
 from expr import *
 from oprt import *
@@ -8,6 +15,8 @@ from type import *
 from stmt import *
 from compiler import *
 
+import asm_cache
+import fast_parser
 import lark
 
 grammar = r"""
@@ -104,14 +113,81 @@ grammar = r"""
     %ignore WS
     """
 
+PARSER_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.lark_cache')
 
+
+def get_parser(cache_dir=PARSER_CACHE_DIR, kind='lark'):
+    """
+    Builds the LALR parser for the Latte grammar. Parse tables are pickled into cache_dir under a name derived
+    from the grammar text and lark version, so warm starts skip grammar analysis and table construction.
+    MyTransformer runs inside the parser, parse() returns the Program without building a parse tree first.
+    :param cache_dir: directory for serialized parser tables, None disables caching
+    :param kind: 'lark', or 'fast' for the hand-written parser of fast_parser.py building the same AST
+    :return: lark.Lark instance or fast_parser.Parser
+    """
+    if kind == 'fast':
+        return fast_parser.Parser()
+
+    cache = False
+    if cache_dir is not None:
+        key = hashlib.sha1((grammar + lark.__version__).encode('utf-8')).hexdigest()
+        cache = os.path.join(cache_dir, 'latte_{}.lark'.format(key))
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+        except OSError:
+            cache = False
+
+    options = dict(start="program", parser='lalr', keep_all_tokens=True, transformer=MyTransformer(), debug=True)
+    try:
+        return lark.Lark(grammar, cache=cache, **options)
+    except OSError:
+        # cache directory not writable, build tables in memory only
+        return lark.Lark(grammar, **options)
+
+
+# terminals the transformer needs, all the other tokens are keywords and punctuation
+VALUE_TERMINALS = {'CNAME', 'INT', 'ESCAPED_STRING'}
+
+
+class Located:
+    """
+    Value of a reduced rule on the parser stack, with the position of the first token of the rule.
+    """
+    __slots__ = ('value', 'position')
+
+    def __init__(self, value, position):
+        self.value = value
+        self.position = position
+
+
+def build_node(f, rule, children, meta):
+    """
+    Calls the MyTransformer method of a rule while the parser reduces it. The parser keeps all tokens, so a rule
+    starts at its first child, keyword and punctuation tokens are dropped before the method sees the children.
+    The position is passed in place of lark's meta.
+    """
+    first = children[0]
+    position = Position(first.line, first.column) if isinstance(first, Token) else first.position
+
+    params = []
+    for child in children:
+        if isinstance(child, Located):
+            params.append(child.value)
+        elif child.type in VALUE_TERMINALS:
+            params.append(child)
+
+    result = profiling.call('transformer', f, params, position)
+    if rule == 'program':
+        return result
+    return Located(result, position)
+
+
+@lark.v_args(wrapper=build_node)
 class MyTransformer(lark.Transformer):
 
-    @lark.v_args(meta=True)
     def string_value(self, params, meta):
         return params[0].value
 
-    @lark.v_args(meta=True)
     def program(self, params, meta):
 
         classes = []
@@ -125,14 +201,12 @@ class MyTransformer(lark.Transformer):
 
         return Program(functions, classes)
 
-    @lark.v_args(meta=True)
     def field(self, params, meta):
         result = Field(params[1], params[0])
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def arg(self, params, meta):
         args = []
         for i in range(0, len(params), 2):
@@ -143,19 +217,16 @@ class MyTransformer(lark.Transformer):
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def block(self, params, meta):
         result = Block(params)
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def decl(self, params, meta):
         return params
 
     # ==== Definitions ====
-    @lark.v_args(meta=True)
     def fun_def(self, params, meta):
         if len(params) == 3:
             d_type, d_name, d_block = params
@@ -167,7 +238,7 @@ class MyTransformer(lark.Transformer):
         result.column = meta.column
         return result
 
-    def cls_def(self, params):
+    def cls_def(self, params, meta):
         name = params[0]
         fields = []
         methods = []
@@ -182,12 +253,11 @@ class MyTransformer(lark.Transformer):
         result = ClassDef(name, fields, methods)
         return result
 
-    @lark.v_args(meta=True)
     def cls_extends_def(self, params, meta):
         name = params[0]
         parent = params[1]
 
-        cls = self.cls_def([name] + params[2:])
+        cls = self.cls_def([name] + params[2:], meta)
         cls.parent = parent
         result = cls
         result.line = meta.line
@@ -196,25 +266,22 @@ class MyTransformer(lark.Transformer):
 
     # ==== Statements ====
 
-    @lark.v_args(meta=True)
     def s_empty(self, params, meta):
         result = EmptyStmt()
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def s_ret_void(self, params, meta):
         result = RetVoidStmt()
         result.line = meta.line
         result.column = meta.column
         return result
 
-    def s_block(self, params):
+    def s_block(self, params, meta):
         result = BlockStmt(params[0])
         return result
 
-    @lark.v_args(meta=True)
     def s_decl(self, params, meta):
         variables = []
         type = params[0]
@@ -229,56 +296,48 @@ class MyTransformer(lark.Transformer):
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def s_asg(self, params, meta):
         result = AsgStmt(params[0], params[1])
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def s_pp(self, params, meta):
         result = PPStmt(params[0])
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def s_mm(self, params, meta):
         result = MMStrmt(params[0])
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def s_ret_val(self, params, meta):
         result = RetValueStmt(params[0])
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def s_if(self, params, meta):
         result = IfStmt(params[0], params[1])
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def s_if_else(self, params, meta):
         result = IfElseStmt(params[0], params[1], params[2])
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def s_while(self, params, meta):
         result = WhileStmt(params[0], params[1])
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def s_expr(self, params, meta):
         result = ExprStmt(params[0])
         result.line = meta.line
@@ -287,43 +346,35 @@ class MyTransformer(lark.Transformer):
 
     # ==== TYPES ====
 
-    @lark.v_args(meta=True)
     def t_int(self, params, meta):
         return INT_TYPE
 
-    @lark.v_args(meta=True)
     def t_bool(self, params, meta):
         return BOOL_TYPE
 
-    @lark.v_args(meta=True)
     def t_void(self, params, meta):
         return VOID_TYPE
 
-    @lark.v_args(meta=True)
     def t_string(self, params, meta):
         return STRING_TYPE
 
-    @lark.v_args(meta=True)
     def t_class(self, params, meta):
         return Type(params[0])
 
     # ==== Expressions ====
 
-    @lark.v_args(meta=True)
     def e_or(self, params, meta):
         result = ExpOperator(OrOperator(params[0], params[1]))
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def e_and(self, params, meta):
         result = ExpOperator(AndOperator(params[0], params[1]))
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def e_op(self, params, meta):
         param1, operator, param2 = params
         operator.param1 = param1
@@ -332,169 +383,149 @@ class MyTransformer(lark.Transformer):
 
         return result
 
-    @lark.v_args(meta=True)
     def e_neg(self, params, meta):
         result = ExpOperator(NegOperator(params[0]))
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def e_not(self, params, meta):
         result = ExpOperator(NotOperator(params[0]))
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def p_var(self, params, meta):
         result = ExpVariable(params[0])
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def p_true(self, params, meta):
         result = ExpLitTrue()
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def p_false(self, params, meta):
         result = ExpLitFalse()
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def call(self, params, meta):
         result = ExpApp(params[0], params[1:])
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def p_string(self, params, meta):
         result = ExpLitString(params[0])
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def p_int(self, params, meta):
         result = ExpLitInt(int(params[0]))
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def p_null(self, params, meta):
         result = ExpLitNull()
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def e_new(self, params, meta):
         result = ExpNew(Type(params[0]))
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def e_cls_call(self, params, meta):
         result = ExpMethodCall(params[0], params[1], params[2:])
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def e_cls_attr(self, params, meta):
         result = ExpAttribute(params[0], params[1])
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def e_cast(self, params, meta):
         result = ExpCast(params[1], Type(params[0]))
         result.line = meta.line
         result.column = meta.column
         return result
 
+    def expr8(self, params, meta):
+        # parenthesized expression
+        return params[0]
+
     # ==== Operators ====
-    @lark.v_args(meta=True)
     def op_plus(self, params, meta):
         result = PlusOperator(None, None)
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def op_minus(self, params, meta):
         result = MinusOperator(None, None)
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def op_times(self, params, meta):
         result = TimesOperator(None, None)
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def op_div(self, params, meta):
         result = DivisionOperator(None, None)
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def op_mod(self, params, meta):
         result = ModOperator(None, None)
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def op_lt(self, params, meta):
         result = LTOperator(None, None)
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def op_le(self, params, meta):
         result = LEOperator(None, None)
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def op_gt(self, params, meta):
         result = GTOperator(None, None)
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def op_ge(self, params, meta):
         result = GEOperator(None, None)
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def op_eq(self, params, meta):
         result = EQOperator(None, None)
         result.line = meta.line
         result.column = meta.column
         return result
 
-    @lark.v_args(meta=True)
     def op_ne(self, params, meta):
         result = NEOperator(None, None)
         result.line = meta.line
@@ -502,33 +533,289 @@ class MyTransformer(lark.Transformer):
         return result
 
 
+PARSERS = ('lark', 'fast')
+
+# exceptions raised by parse() of either parser
+SYNTAX_ERRORS = (lark.exceptions.LarkError, fast_parser.ParseError)
+
+
+def syntax_error_message(e):
+    line = getattr(e, 'line', 'undefined')
+    column = getattr(e, 'column', 'undefined')
+    return "Syntax error at line {} column {}".format(line, column)
+
+
+def check_program(text, parser=None, jobs=1, cache=None, optimize=1, backend='ast'):
+    """
+    Parses and checks Latte source.
+    :param text: program source
+    :param parser: parser returned by get_parser(), built on demand if None
+    :param jobs: number of processes checking and compiling functions
+    :param cache: asm_cache.AsmCache with the assembly of functions compiled before
+    :param optimize: optimization level, see Program.check_correctness
+    :param backend: 'ast' or 'ir', see Program.check_correctness
+    :return: checked Program, ready to be compiled
+    :raises SYNTAX_ERRORS: on syntax errors
+    :raises CompilerException: on semantic errors
+    """
+    if parser is None:
+        parser = get_parser()
+    program = parser.parse(text)
+    if cache is not None:
+        cache.index(program, text)
+    program.check_correctness(jobs, cache, optimize, backend)
+    return program
+
+
+def compile_program(text, parser=None, jobs=1, cache=None, optimize=1, backend='ast'):
+    """
+    Parses, checks and compiles Latte source.
+    :return: assembly as a string
+    """
+    return check_program(text, parser, jobs, cache, optimize, backend).compile()
+
+
+class CompileOptions:
+    """
+    :param parser: front end, one of PARSERS
+    :param jobs: number of processes, see compile_source and compile_sources
+    :param cache: directory of the per-function assembly cache (asm_cache.py), None to compile everything
+    :param optimize: optimization level, see Program.check_correctness
+    :param backend: 'ast' or 'ir', see Program.check_correctness
+    """
+    __slots__ = ('parser', 'jobs', 'cache', 'optimize', 'backend')
+
+    def __init__(self, parser='lark', jobs=1, cache=None, optimize=1, backend='ast'):
+        self.parser = parser
+        self.jobs = jobs
+        self.cache = cache
+        self.optimize = optimize
+        self.backend = backend
+
+
+class Diagnostic:
+    """
+    Error in a compiled program. kind is 'syntax' or 'semantic', message does not include the position and str()
+    gives the text the command line compiler prints.
+    """
+    __slots__ = ('kind', 'message', 'line', 'column')
+
+    def __init__(self, kind, message, line, column):
+        self.kind = kind
+        self.message = message
+        self.line = line
+        self.column = column
+
+    def __str__(self):
+        if self.kind == 'syntax':
+            return syntax_error_message(self)
+        return 'At line {}, column {}: {}'.format(self.line, self.column, self.message)
+
+    def __repr__(self):
+        return 'Diagnostic({!r}, {!r}, {!r}, {!r})'.format(self.kind, self.message, self.line, self.column)
+
+
+class CompileResult:
+    """
+    Assembly of a program, None if it has diagnostics.
+    """
+    __slots__ = ('asm', 'diagnostics')
+
+    def __init__(self, asm, diagnostics):
+        self.asm = asm
+        self.diagnostics = diagnostics
+
+    @property
+    def ok(self):
+        return not self.diagnostics
+
+
+_shared_parsers = {}
+
+
+def shared_parser(kind='lark'):
+    """
+    :return: parser of the given kind, built on the first call and reused by every later one
+    """
+    try:
+        return _shared_parsers[kind]
+    except KeyError:
+        parser = _shared_parsers[kind] = get_parser(kind=kind)
+        return parser
+
+
+def compile_source(text, options=None):
+    """
+    Compiles Latte source in memory with the shared parser. Nothing is read from or written to disk and errors in the
+    program are returned instead of raised; other exceptions are compiler bugs and propagate.
+    :param text: program source
+    :param options: CompileOptions, jobs are the processes checking and compiling functions of the program
+    :return: CompileResult
+    """
+    if options is None:
+        options = CompileOptions()
+    cache = asm_cache.AsmCache(options.cache) if options.cache is not None else None
+    try:
+        return CompileResult(compile_program(text, shared_parser(options.parser), options.jobs, cache,
+                                             options.optimize, options.backend), [])
+    except SYNTAX_ERRORS as e:
+        diagnostic = Diagnostic('syntax', 'Syntax error', getattr(e, 'line', None), getattr(e, 'column', None))
+    except CompilerException as e:
+        diagnostic = Diagnostic('semantic', e.rlmsg, e.obj.line, e.obj.column)
+    return CompileResult(None, [diagnostic])
+
+
+def compile_sources(texts, options=None):
+    """
+    Compiles many programs with the shared parser. With more than one job the programs are spread over a pool of
+    forked processes, which inherit the parser, and each program is compiled by a single process.
+    :param texts: iterable of program sources
+    :param options: CompileOptions
+    :return: list of CompileResult in the order of texts
+    """
+    if options is None:
+        options = CompileOptions()
+    texts = list(texts)
+    jobs = min(options.jobs, len(texts))
+    if jobs <= 1:
+        return [compile_source(text, options) for text in texts]
+
+    shared_parser(options.parser)
+    compile_one = functools.partial(compile_source, options=CompileOptions(options.parser, cache=options.cache,
+                                                                                 optimize=options.optimize,
+                                                                                 backend=options.backend))
+    with ProcessPoolExecutor(jobs, mp_context=multiprocessing.get_context('fork')) as pool:
+        return list(pool.map(compile_one, texts, chunksize=max(1, len(texts) // (4 * jobs))))
+
+
+def serve(socket_path, parser_kind='lark'):
+    """
+    Compile server. Keeps the parser and compiler modules loaded and answers requests sent over a Unix socket.
+    Each request and response is a single line of JSON: {"source": ...} is answered with {"asm": ...} on success
+    or {"error": ...} carrying the same message the command line compiler would print.
+    """
+    import json
+    import signal
+    import socketserver
+
+    options = CompileOptions(parser_kind)
+    shared_parser(parser_kind)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                request = json.loads(line.decode('utf-8'))
+                result = compile_source(request['source'], options)
+                response = {'asm': result.asm} if result.ok else {'error': str(result.diagnostics[0])}
+                self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+                self.wfile.flush()
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    server = socketserver.UnixStreamServer(socket_path, Handler)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+
 if __name__ == '__main__':
+    import argparse
     import logging
 
     logging.basicConfig(level=logging.DEBUG)
 
-    path = sys.argv[1]
-
-    with open(path) as f:
+    arg_parser = argparse.ArgumentParser(description='Latte compiler')
+    arg_parser.add_argument('path', nargs='?', help='.lat file, assembly is written next to it as .s')
+    arg_parser.add_argument('--server', metavar='SOCKET', help='run as compile server listening on a Unix socket')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=1, help='check and compile functions in N processes')
+    arg_parser.add_argument('--parser', choices=PARSERS, default='lark', help='front end, both build the same AST')
+    arg_parser.add_argument('--cache', metavar='DIR', help='reuse the assembly of unchanged functions kept in DIR')
+    arg_parser.add_argument('-O', dest='optimize', type=int, choices=[0, 1], default=1,
+                            help='optimization level, 0 keeps every variable on the stack and skips peephole.py')
+    arg_parser.add_argument('--backend', choices=['ast', 'ir'], default='ast',
+                            help='generate code from the tree or from the three-address IR of ir.py')
+    arg_parser.add_argument('--dump-ir', action='store_true',
+                            help='print the IR of every function, implies --backend ir, needs -j 1 and no --cache')
+    arg_parser.add_argument('--timings', metavar='FILE',
+                            help='write wall time and memory of every phase and function and the hits of the '
+                                 'peephole rules as JSON, - for stdout')
+    arg_parser.add_argument('--no-memory', action='store_true',
+                            help='leave memory out of --timings, tracemalloc slows the compiler down several times')
+    arg_parser.add_argument('--profile', metavar='FILE', help='write cProfile statistics for pstats')
+    options = arg_parser.parse_args()
+
+    if options.server:
+        serve(options.server, options.parser)
+        sys.exit(0)
+
+    if options.path is None:
+        arg_parser.error('path is required')
+    if options.dump_ir:
+        if options.jobs > 1 or options.cache:
+            arg_parser.error('--dump-ir needs -j 1 and no --cache, the IR is built in the checking process')
+        options.backend = 'ir'
+
+    path = options.path
+    report = profiling.Report(not options.no_memory) if options.timings else None
+    profiler = cProfile.Profile() if options.profile else None
+    if profiler is not None:
+        profiler.enable()
+
+    def phase(name):
+        return report.phase(name) if report is not None else contextlib.nullcontext({})
+
+    with report if report is not None else contextlib.nullcontext():
         try:
-            program = lark.Lark(grammar, start="program", parser='lalr', propagate_positions=True, debug=True).parse(
-                f.read())
+            with phase('read'):
+                with open(path) as f:
+                    source = f.read()
         except FileNotFoundError as e:
             print(e)
             exit(1)
-        except lark.exceptions.LarkError as e:
-            line = getattr(e, 'line', 'undefined')
-            column = getattr(e, 'column', 'undefined')
 
-            print("Syntax error at line {} column {}".format(line, column))
+        try:
+            cache = asm_cache.AsmCache(options.cache) if options.cache else None
+            with phase('load parser'):
+                parser = get_parser(kind=options.parser)
+            with phase('parse') as parse_phase:
+                program = parser.parse(source)
+            if report is not None and 'transformer' in report.counters:
+                parse_phase['transformer'] = report.counters['transformer']
+            if cache is not None:
+                cache.index(program, source)
+            with phase('check'):
+                program.check_correctness(options.jobs, cache, options.optimize, options.backend)
+            if options.dump_ir:
+                for _, fun in program.units():
+                    print(fun.ir.dump())
+            with phase('compile') as compile_phase:
+                with open(path[:-4] + '.s', 'w') as f:
+                    writer = profiling.TimedWriter(f)
+                    emitter = Emitter(writer)
+                    program.compile(emitter)
+                compile_phase['write'] = writer.wall
+        except SYNTAX_ERRORS as e:
+            print(syntax_error_message(e))
             exit(1)
-        program = MyTransformer().transform(program)
-    try:
-        program.check_correctness()
-        asm = program.compile()
-        with open(sys.argv[1][:-4] + '.s', 'w') as f:
-            f.write(asm)
-
-    except CompilerException as e:
-        print(e)
-        sys.exit(1)
+        except CompilerException as e:
+            print(e)
+            sys.exit(1)
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(options.profile)
+
+    if report is not None:
+        report.info.update(path=path, parser=options.parser, jobs=options.jobs, optimize=options.optimize,
+                           backend=options.backend,
+                           cache=None if cache is None else {'hits': cache.hits, 'misses': cache.misses},
+                           peephole=emitter.peephole_hits)
+        if options.timings == '-':
+            print(report.json())
+        else:
+            with open(options.timings, 'w') as f:
+                f.write(report.json())
@@ -0,0 +1,523 @@
+"""
+Three-address intermediate representation of a function and its translation to x86, the backend of
+grammar_test.py --backend ir.
+
+A Function is a list of BasicBlocks in the order of the output. Every block ends with a jmp, br or ret, which give the
+edges of the control-flow graph (succs and preds). Instructions work on operands: Temps, the virtual registers holding
+local variables, arguments and intermediate values, constants and string labels. Temps may be assigned more than once,
+the IR is not in SSA form. The nodes of the checked AST build it with their lower and lower_jump methods, in the
+evaluation order of the AST backend, so both backends print the same.
+
+Instruction selection computes liveness on the control-flow graph, gives every temp one interval from its first to its
+last live position and allocates registers with regalloc.linear_scan; at -O0 every temp gets a stack slot instead.
+Each instruction is then translated on its own, with rax, rdx and rdi as scratch registers.
+
+    x = a + b * 2   becomes   %3 = mul %1, 2
+                              %4 = add %0, %3
+                              %2 = copy %4
+"""
+from asm import Instruction, Immediate, Label, Memory, EAX, EDX, EDI, RAX, RDX, RDI, RBP, RSP, R12
+from compiler import CALLER_SAVED_REGISTERS, MemoryLocation
+
+# x86 conditional jumps of the relations of br, and the relation with swapped outcomes
+JUMPS = {'lt': 'jl', 'le': 'jle', 'gt': 'jg', 'ge': 'jge', 'eq': 'je', 'ne': 'jne'}
+NEGATIONS = {'lt': 'ge', 'le': 'gt', 'gt': 'le', 'ge': 'lt', 'eq': 'ne', 'ne': 'eq'}
+
+TERMINATORS = {'jmp', 'br', 'ret'}
+CALLS = {'call', 'callv', 'new'}
+
+
+class Temp:
+    __slots__ = ('index', 'size')
+
+    def __init__(self, index, size):
+        self.index = index
+        self.size = size
+
+    def __repr__(self):
+        return '%{}'.format(self.index)
+
+
+class Const:
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return str(self.value)
+
+
+class Symbol:
+    """
+    Address of a label, a string literal of the data section.
+    """
+    __slots__ = ('label',)
+
+    size = 8
+
+    def __init__(self, label):
+        self.label = label
+
+    def __repr__(self):
+        return self.label
+
+
+class Instr:
+    """
+    dest = op args. target is the function label of call, the vtable offset of callv, the ClassDef of new, the stack
+    offset of arg, the field offset of load and store, the block of jmp and (relation, true block, false block) of br.
+    """
+    __slots__ = ('op', 'dest', 'args', 'target')
+
+    def __init__(self, op, dest=None, args=(), target=None):
+        self.op = op
+        self.dest = dest
+        self.args = list(args)
+        self.target = target
+
+    def __repr__(self):
+        args = ', '.join(map(repr, self.args))
+        if self.op == 'jmp':
+            text = 'jmp {}'.format(self.target.label)
+        elif self.op == 'br':
+            relation, if_true, if_false = self.target
+            text = 'br {} {}, {}, {}'.format(relation, args, if_true.label, if_false.label)
+        elif self.op == 'call':
+            text = 'call {}({})'.format(self.target, args)
+        elif self.op == 'callv':
+            text = 'callv [{!r}]+{}({})'.format(self.args[0], self.target, args)
+        elif self.op == 'new':
+            text = 'new {}'.format(self.target.name)
+        elif self.op == 'arg':
+            text = 'arg {}'.format(self.target)
+        elif self.op in ('load', 'store'):
+            text = '{} {!r}+{}{}'.format(self.op, self.args[0], self.target,
+                                         ''.join(', {!r}'.format(arg) for arg in self.args[1:]))
+        else:
+            text = '{} {}'.format(self.op, args).rstrip()
+        return text if self.dest is None else '{!r} = {}'.format(self.dest, text)
+
+
+class BasicBlock:
+    __slots__ = ('label', 'instrs', 'succs', 'preds')
+
+    def __init__(self, label):
+        self.label = label
+        self.instrs = []
+        self.succs = []
+        self.preds = []
+
+    def terminated(self):
+        return bool(self.instrs) and self.instrs[-1].op in TERMINATORS
+
+
+class Function:
+    """
+    IR of a function under construction: emit appends to the current block, start places a new block after the
+    others and makes it current, falling through to it with a jmp.
+    """
+
+    def __init__(self, name, args=()):
+        self.name = name
+        self.blocks = []
+        self.temps = 0
+        self.labels = 0
+        self.variables = {}
+        self.current = None
+        self.self_temp = None
+        self.start(self.new_block())
+        self.args = []
+        for location in args:
+            self.args.append(self.variable(location))
+            self.emit('arg', self.args[-1], target=location.offset)
+
+    def temp(self, size):
+        self.temps += 1
+        return Temp(self.temps - 1, size)
+
+    def variable(self, location):
+        """
+        :return: temp of the variable or argument at location, the stack location the checker gave it
+        """
+        temp = self.variables.get(id(location))
+        if temp is None:
+            temp = self.variables[id(location)] = self.temp(location.size)
+        return temp
+
+    def new_block(self):
+        self.labels += 1
+        return BasicBlock('.L{}'.format(self.labels))
+
+    def start(self, block):
+        if self.current is not None and not self.current.terminated():
+            self.emit('jmp', target=block)
+        self.blocks.append(block)
+        self.current = block
+
+    def emit(self, op, dest=None, args=(), target=None):
+        if self.current.terminated():
+            # code after a return or a jump of a constant condition
+            self.start(self.new_block())
+        self.current.instrs.append(Instr(op, dest, args, target))
+        return dest
+
+    def jump(self, block):
+        """
+        Jumps to block unless the current block has already ended, with a return in a branch of an if.
+        """
+        if not self.current.terminated():
+            self.emit('jmp', target=block)
+
+    def branch(self, relation, left, right, if_true, if_false):
+        self.emit('br', args=[left, right], target=(relation, if_true, if_false))
+
+    def finish(self):
+        """
+        Drops the blocks no path reaches and fills in the edges.
+        """
+        reached = {id(self.blocks[0])}
+        stack = [self.blocks[0]]
+        while stack:
+            block = stack.pop()
+            block.succs = successors(block)
+            for succ in block.succs:
+                if id(succ) not in reached:
+                    reached.add(id(succ))
+                    stack.append(succ)
+        self.blocks = [block for block in self.blocks if id(block) in reached]
+        for block in self.blocks:
+            for succ in block.succs:
+                succ.preds.append(block)
+        return self
+
+    def dump(self):
+        lines = ['function {}({})'.format(self.name, ', '.join(map(repr, self.args)))]
+        for block in self.blocks:
+            preds = ', '.join(pred.label for pred in block.preds)
+            lines.append('{}:{}'.format(block.label, '  ; preds ' + preds if preds else ''))
+            lines.extend('    {!r}'.format(instr) for instr in block.instrs)
+        return '\n'.join(lines) + '\n'
+
+
+def successors(block):
+    if not block.instrs:
+        return []
+    last = block.instrs[-1]
+    if last.op == 'jmp':
+        return [last.target]
+    if last.op == 'br':
+        return [last.target[1], last.target[2]] if last.target[1] is not last.target[2] else [last.target[1]]
+    return []
+
+
+def uses(instr):
+    return [arg for arg in instr.args if isinstance(arg, Temp)]
+
+
+def liveness(function):
+    """
+    :return: dicts from id of a block to the sets of ids of temps live at its start and at its end
+    """
+    used, defined = {}, {}
+    for block in function.blocks:
+        use, define = set(), set()
+        for instr in block.instrs:
+            use.update(id(temp) for temp in uses(instr) if id(temp) not in define)
+            if instr.dest is not None:
+                define.add(id(instr.dest))
+        used[id(block)], defined[id(block)] = use, define
+
+    live_in = {id(block): set() for block in function.blocks}
+    live_out = {id(block): set() for block in function.blocks}
+    work = list(function.blocks)
+    while work:
+        block = work.pop()
+        out = set()
+        for succ in block.succs:
+            out |= live_in[id(succ)]
+        live_out[id(block)] = out
+        new_in = used[id(block)] | (out - defined[id(block)])
+        if new_in != live_in[id(block)]:
+            live_in[id(block)] = new_in
+            work.extend(block.preds)
+    return live_in, live_out
+
+
+def allocate(function):
+    """
+    Linear scan over the instructions numbered in the order of the blocks.
+    :return: dict from id of a temp to its register, spilled temps are missing, and dict from id of a call
+        instruction to the caller-saved registers living across it
+    """
+    import regalloc
+
+    preserving = {'top_' + name for name in regalloc.PRESERVING_CALLS}
+    live_in, live_out = liveness(function)
+    intervals = {}
+
+    def extend(temp_id, temp, position):
+        interval = intervals.get(temp_id)
+        if interval is None:
+            interval = intervals[temp_id] = regalloc.Interval(temp, position, None)
+        interval.start = min(interval.start, position)
+        interval.end = max(interval.end, position)
+
+    temps = {}
+    calls = []
+    position = 0
+    for block in function.blocks:
+        first = position
+        for instr in block.instrs:
+            for temp in uses(instr):
+                temps[id(temp)] = temp
+                extend(id(temp), temp, position)
+            if instr.dest is not None:
+                temps[id(instr.dest)] = instr.dest
+                extend(id(instr.dest), instr.dest, position)
+            if instr.op in CALLS and not (instr.op == 'call' and instr.target in preserving):
+                calls.append((instr, position))
+            position += 1
+        for temp_id in live_in[id(block)]:
+            extend(temp_id, temps.get(temp_id), first)
+        for temp_id in live_out[id(block)]:
+            extend(temp_id, temps.get(temp_id), position - 1)
+
+    for interval in intervals.values():
+        interval.calls = sum(1 for _, point in calls if interval.start < point < interval.end)
+    regalloc.linear_scan(list(intervals.values()))
+
+    registers = {temp_id: interval.register for temp_id, interval in intervals.items()
+                 if interval.register is not None}
+    call_saves = {}
+    for instr, point in calls:
+        call_saves[id(instr)] = [interval.register for interval in intervals.values()
+                                 if interval.register is not None and interval.register in CALLER_SAVED_REGISTERS
+                                 and interval.start < point < interval.end]
+    return registers, call_saves
+
+
+class Selector:
+    """
+    Translates the instructions of a finished Function to x86.
+    :param allocation: result of allocate, None keeps every temp on the stack
+    """
+
+    def __init__(self, function, allocation, out):
+        self.function = function
+        self.out = out
+        self.registers, self.call_saves = allocation if allocation is not None else ({}, {})
+        self.slots = {}
+        self.frame = 0
+        self.saved = []
+        for register in self.registers.values():
+            if register not in CALLER_SAVED_REGISTERS and register not in self.saved:
+                self.saved.append(register)
+        # the frame has to be known before the first return restores the saved registers from below it
+        for block in function.blocks:
+            for instr in block.instrs:
+                for temp in uses(instr) + ([instr.dest] if instr.dest is not None else []):
+                    self.location(temp)
+
+    def location(self, temp):
+        """
+        :return: register or stack slot of a temp
+        """
+        register = self.registers.get(id(temp))
+        if register is not None:
+            return register.sized(temp.size)
+        slot = self.slots.get(id(temp))
+        if slot is None:
+            self.frame -= temp.size
+            slot = self.slots[id(temp)] = MemoryLocation(self.frame, temp.size)
+        return slot.memory
+
+    def operand(self, value):
+        if isinstance(value, Temp):
+            return self.location(value)
+        if isinstance(value, Symbol):
+            return Immediate(value.label)
+        return Immediate(value.value)
+
+    def in_register(self, value):
+        return isinstance(value, Temp) and id(value) in self.registers
+
+    @staticmethod
+    def scratch(size, name='a'):
+        return {('a', 4): EAX, ('a', 8): RAX, ('d', 4): EDX, ('d', 8): RDX, ('di', 4): EDI, ('di', 8): RDI}[
+            name, size]
+
+    def move(self, dest, source, size):
+        """
+        Moves between two operands, through rax if both are in memory.
+        """
+        if dest == source:
+            return
+        if isinstance(dest, Memory) and isinstance(source, Memory):
+            self.out.emit(Instruction('mov', self.scratch(size), source),
+                          Instruction('mov', dest, self.scratch(size)))
+        else:
+            self.out.emit(Instruction('mov', dest, source))
+
+    def select(self):
+        out = self.out
+        out.emit(Instruction('push', RBP),
+                 Instruction('mov', RBP, RSP),
+                 Instruction('add', RSP, Immediate(self.frame)))
+        for register in self.saved:
+            out.emit(Instruction('push', register.full))
+        blocks = self.function.blocks
+        for index, block in enumerate(blocks):
+            following = blocks[index + 1] if index + 1 < len(blocks) else None
+            out.emit(Label(block.label))
+            for instr in block.instrs:
+                getattr(self, 'select_' + instr.op)(instr, following)
+
+    def select_arg(self, instr, following):
+        self.move(self.location(instr.dest), MemoryLocation(instr.target, instr.dest.size).memory, instr.dest.size)
+
+    def select_copy(self, instr, following):
+        size = instr.dest.size
+        self.move(self.location(instr.dest), self.operand(instr.args[0]), size)
+
+    def select_neg(self, instr, following):
+        dest = self.location(instr.dest)
+        if self.in_register(instr.dest):
+            self.move(dest, self.operand(instr.args[0]), 4)
+            self.out.emit(Instruction('neg', dest))
+        else:
+            self.out.emit(Instruction('mov', EAX, self.operand(instr.args[0])),
+                          Instruction('neg', EAX),
+                          Instruction('mov', dest, EAX))
+
+    def select_binary(self, instr, mnemonic):
+        dest = self.location(instr.dest)
+        left, right = self.operand(instr.args[0]), self.operand(instr.args[1])
+        if self.in_register(instr.dest) and dest != right:
+            self.move(dest, left, 4)
+            self.out.emit(Instruction(mnemonic, dest, right))
+        else:
+            self.out.emit(Instruction('mov', EAX, left),
+                          Instruction(mnemonic, EAX, right),
+                          Instruction('mov', dest, EAX))
+
+    def select_add(self, instr, following):
+        self.select_binary(instr, 'add')
+
+    def select_sub(self, instr, following):
+        self.select_binary(instr, 'sub')
+
+    def select_mul(self, instr, following):
+        self.select_binary(instr, 'imul')
+
+    def select_div(self, instr, following, result=EAX):
+        divisor = self.operand(instr.args[1])
+        if isinstance(instr.args[1], Const):
+            self.out.emit(Instruction('mov', EDI, divisor))
+            divisor = EDI
+        self.out.emit(Instruction('mov', EAX, self.operand(instr.args[0])),
+                      Instruction('cdq'),
+                      Instruction('idiv', divisor))
+        self.move(self.location(instr.dest), result, 4)
+
+    def select_mod(self, instr, following):
+        self.select_div(instr, following, EDX)
+
+    def select_load(self, instr, following):
+        size = instr.dest.size
+        base = self.operand(instr.args[0])
+        if not self.in_register(instr.args[0]):
+            self.out.emit(Instruction('mov', RAX, base))
+            base = RAX
+        self.move(self.location(instr.dest), Memory(base.name, instr.target, size), size)
+
+    def select_store(self, instr, following):
+        base, value = instr.args
+        size = value.size if not isinstance(value, Const) else 8
+        address = self.operand(base)
+        if not self.in_register(base):
+            self.out.emit(Instruction('mov', RAX, address))
+            address = RAX
+        source = self.operand(value)
+        if not self.in_register(value) and not isinstance(value, Const):
+            self.out.emit(Instruction('mov', self.scratch(size, 'd'), source))
+            source = self.scratch(size, 'd')
+        self.out.emit(Instruction('mov', Memory(address.name, instr.target, size), source))
+
+    def call(self, instr, args, call):
+        """
+        Saves the caller-saved registers living across the call, pushes args on the aligned stack like the AST
+        backend and moves the result to the destination.
+        :param call: instructions of the call itself, run when the arguments are on the stack
+        """
+        saves = [register for register in self.call_saves.get(id(instr), [])
+                 if instr.dest is None or self.registers.get(id(instr.dest)) is not register]
+        for register in saves:
+            self.out.emit(Instruction('push', register.full))
+        self.out.emit(Instruction('push', R12),
+                      Instruction('mov', R12, RSP),
+                      Instruction('and', RSP, Immediate(-16)))
+        if len(args) % 2 == 0:
+            self.out.emit(Instruction('sub', RSP, Immediate(8)))
+        for arg in reversed(args):
+            size = arg.size if not isinstance(arg, Const) else 8
+            self.move(self.scratch(size), self.operand(arg), size)
+            self.out.emit(Instruction('push', RAX))
+        self.out.extend(call)
+        self.out.emit(Instruction('mov', RSP, R12),
+                      Instruction('pop', R12))
+        for register in reversed(saves):
+            self.out.emit(Instruction('pop', register.full))
+        if instr.dest is not None:
+            self.move(self.location(instr.dest), self.scratch(instr.dest.size), instr.dest.size)
+
+    def select_call(self, instr, following):
+        self.call(instr, instr.args, [Instruction('call', Label(instr.target))])
+
+    def select_callv(self, instr, following):
+        self.call(instr, instr.args, [Instruction('mov', RAX, Memory('rsp', 0, 8)),
+                                      Instruction('mov', RAX, Memory('rax', 0, 8)),
+                                      Instruction('call', Memory('rax', instr.target))])
+
+    def select_new(self, instr, following):
+        cls = instr.target
+        code = [Instruction('mov', RDI, Immediate(cls.size)),
+                Instruction('call', Label('malloc')),
+                Instruction('mov', Memory('rax', 0, 8), Immediate('vtable_' + cls.name))]
+        code.extend(Instruction('mov', Memory('rax', cls.get_attr_offset(attr.name), 8), Immediate(0))
+                    for attr in cls.all_fields)
+        # malloc takes its argument in rdi, so nothing is pushed; for this even count of zero call emits its sub rsp, 8
+        # padding, and malloc is reached with the stack aligned like every other call
+        self.call(instr, [], code)
+
+    def select_jmp(self, instr, following):
+        if instr.target is not following:
+            self.out.emit(Instruction('jmp', Label(instr.target.label)))
+
+    def select_br(self, instr, following):
+        relation, if_true, if_false = instr.target
+        left, right = instr.args
+        size = max(getattr(arg, 'size', 4) for arg in (left, right) if not isinstance(arg, Const)) \
+            if not all(isinstance(arg, Const) for arg in (left, right)) else 4
+        first = self.operand(left)
+        if not self.in_register(left):
+            self.move(self.scratch(size), first, size)
+            first = self.scratch(size)
+        self.out.emit(Instruction('cmp', first, self.operand(right)))
+        if if_true is following:
+            self.out.emit(Instruction(JUMPS[NEGATIONS[relation]], Label(if_false.label)))
+        else:
+            self.out.emit(Instruction(JUMPS[relation], Label(if_true.label)))
+            if if_false is not following:
+                self.out.emit(Instruction('jmp', Label(if_false.label)))
+
+    def select_ret(self, instr, following):
+        if instr.args:
+            value = instr.args[0]
+            size = value.size if not isinstance(value, Const) else 4
+            self.move(self.scratch(size), self.operand(value), size)
+        for index, register in enumerate(self.saved):
+            self.out.emit(Instruction('mov', register.full, Memory('rbp', self.frame - 8 * (index + 1), 8)))
+        self.out.emit(Instruction('mov', RSP, RBP),
+                      Instruction('pop', RBP),
+                      Instruction('ret'))
@@ -0,0 +1,164 @@
+"""
+Compiler driver: builds a runnable executable from a .lat file.
+
+Usage: python latc.py file.lat [-o OUT] [--cache-dir DIR] [--parser lark|fast] [-j N] [-O 0|1] [-v]
+
+Runs the pipeline of tests.sh: the compiler writes assembly, nasm assembles it and gcc links it against the runtime
+(defaults.asm and the C helpers in ctest/), which is built once into a static archive. Every artifact is kept in a
+content-addressed cache: the assembly under a hash of the source, of the compiler and of the optimization level, the
+object file under a hash of the assembly and the executable under a hash of the object file and of the runtime.
+Rebuilding an unchanged program costs a hash of the source and a lookup; after an edit only the changed functions are
+compiled again (asm_cache.py).
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import asm_cache
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+CACHE_DIR = os.path.join(ROOT, '.latc_cache')
+
+NASM = ['nasm', '-f', 'elf64', '-F', 'dwarf', '-g']
+CC = ['gcc', '-c']
+LINK = ['gcc', '-no-pie']
+
+RUNTIME_ASM = ['defaults.asm']
+RUNTIME_C = ['ctest/testmain.c', 'ctest/strcnc.c']
+
+
+class BuildError(Exception):
+    pass
+
+
+def digest(*parts):
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+class ArtifactCache:
+    """
+    Files stored under DIR/KIND/KEY, where the key is a hash of everything the file was built from. Entries are never
+    changed, a new input gives a new key.
+    """
+
+    def __init__(self, directory=CACHE_DIR):
+        self.directory = directory
+        self.built = []
+
+    def path(self, kind, key):
+        return os.path.join(self.directory, kind, key)
+
+    def get(self, kind, key, build):
+        """
+        :param build: function writing the artifact to the path it is given, called only if it is not cached yet
+        :return: path of the cached artifact
+        """
+        path = self.path(kind, key)
+        if os.path.exists(path):
+            return path
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # built in a temporary directory first, concurrent builds never see half of an artifact
+        with tempfile.TemporaryDirectory(dir=self.directory) as work:
+            temporary = os.path.join(work, kind)
+            build(temporary, work)
+            os.replace(temporary, path)
+        self.built.append(kind)
+        return path
+
+
+def runtime_archive(cache):
+    """
+    Assembles defaults.asm and compiles the C part of the runtime into a static archive.
+    :return: path of the archive and its key
+    """
+    sources = []
+    for name in RUNTIME_ASM + RUNTIME_C:
+        with open(os.path.join(ROOT, name)) as f:
+            sources.append((name, f.read()))
+    key = digest(NASM, CC, sources)
+
+    def build(path, work):
+        objects = []
+        for name in RUNTIME_ASM + RUNTIME_C:
+            obj = os.path.join(work, os.path.basename(name) + '.o')
+            compiler = NASM if name in RUNTIME_ASM else CC
+            subprocess.check_call(compiler + [os.path.join(ROOT, name), '-o', obj])
+            objects.append(obj)
+        subprocess.check_call(['ar', 'rcs', path] + objects)
+
+    return cache.get('runtime', key + '.a', build), key
+
+
+def build_executable(source, output, cache, parser='lark', jobs=1, optimize=1):
+    """
+    :param source: text of the program
+    :param output: path the executable is copied to
+    :raises BuildError: with the first diagnostic if the program is rejected
+    :raises subprocess.CalledProcessError: if nasm or gcc fail
+    """
+    asm_key = digest(asm_cache.compiler_version(), parser, optimize, source)
+
+    def compile_asm(path, work):
+        # loading the compiler and lark takes longer than a cached build
+        import grammar_test
+
+        options = grammar_test.CompileOptions(parser, jobs, os.path.join(cache.directory, 'functions'), optimize)
+        result = grammar_test.compile_source(source, options)
+        if not result.ok:
+            raise BuildError(str(result.diagnostics[0]))
+        with open(path, 'w') as f:
+            f.write(result.asm)
+
+    asm_path = cache.get('asm', asm_key + '.s', compile_asm)
+    with open(asm_path, 'rb') as f:
+        obj_key = digest(NASM, hashlib.sha1(f.read()).hexdigest())
+    obj_path = cache.get('obj', obj_key + '.o', lambda path, work: subprocess.check_call(NASM + [asm_path, '-o', path]))
+
+    runtime_path, runtime_key = runtime_archive(cache)
+    exe_key = digest(LINK, obj_key, runtime_key)
+    exe_path = cache.get('exe', exe_key, lambda path, work: subprocess.check_call(
+        LINK + ['-o', path, obj_path, runtime_path]))
+
+    shutil.copy(exe_path, output)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Latte compiler driver')
+    arg_parser.add_argument('path', help='.lat file')
+    arg_parser.add_argument('-o', '--output', help='executable, by default the path without .lat')
+    arg_parser.add_argument('--cache-dir', default=CACHE_DIR, help='directory of cached artifacts')
+    arg_parser.add_argument('--parser', choices=['lark', 'fast'], default='lark', help='front end of the compiler')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=1, help='check and compile functions in N processes')
+    arg_parser.add_argument('-O', dest='optimize', type=int, choices=[0, 1], default=1,
+                            help='optimization level, 0 keeps every variable on the stack')
+    arg_parser.add_argument('-v', '--verbose', action='store_true', help='print the artifacts that were built')
+    options = arg_parser.parse_args()
+
+    try:
+        with open(options.path) as f:
+            source = f.read()
+    except FileNotFoundError as e:
+        print(e)
+        return 1
+
+    output = options.output or (options.path[:-4] if options.path.endswith('.lat') else options.path + '.out')
+    cache = ArtifactCache(options.cache_dir)
+    try:
+        build_executable(source, output, cache, options.parser, options.jobs, options.optimize)
+    except (BuildError, subprocess.CalledProcessError) as e:
+        print(e)
+        return 1
+
+    if options.verbose:
+        print('built: {}'.format(', '.join(cache.built) or 'nothing'))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,14 +1,46 @@
 from abc import ABCMeta, abstractmethod
 
-from compiler import BaseBase, TypeException, RegisterLocation, Counter
-from type import INT_TYPE, BOOL_TYPE, STRING_TYPE, is_type_matching
+from compiler import BaseBase, TypeException, RegisterLocation, Emitter
+from type import INT_TYPE, BOOL_TYPE, STRING_TYPE, is_type_matching, get_size
 from expr import ExpApp
+from asm import Instruction, Immediate, EAX, EDX, RDX
+import ir
+
+
+def asm_operand(value, size=4):
+    """
+    :param value: result of ExpBase.operand(), a register or a number
+    """
+    if isinstance(value, RegisterLocation):
+        return value.sized(size)
+    return Immediate(value)
+
+
+def int32(value):
+    """
+    :return: value wrapped to 32 bits, like the result of the instruction computing it
+    """
+    return (value + 2 ** 31) % 2 ** 32 - 2 ** 31
+
+
+def divide(dividend, divisor):
+    """
+    :return: quotient and remainder of idiv, the quotient truncated towards zero and the remainder with the sign of
+    the dividend; AttributeError for the divisions idiv traps on, which are left to run
+    """
+    if divisor == 0 or (dividend == -2 ** 31 and divisor == -1):
+        raise AttributeError("Cannot give real value")
+    quotient = abs(dividend) // abs(divisor)
+    if (dividend < 0) != (divisor < 0):
+        quotient = -quotient
+    return quotient, dividend - divisor * quotient
 
 
 class OperatorBase(BaseBase):
     __metaclass__ = ABCMeta
+    __slots__ = ()
 
-    def calc_to_register(self, location: RegisterLocation):
+    def calc_to_register(self, location: RegisterLocation, out: Emitter):
         raise NotImplementedError()
 
     def get_real_value(self):
@@ -16,6 +48,8 @@ class OperatorBase(BaseBase):
 
 
 class TwoParamsOperatorBase(OperatorBase):
+    __slots__ = ('param1', 'param2')
+
     regsiter1 = RegisterLocation('eax', 'rax')
     regsiter2 = RegisterLocation('ebx', 'rbx')
 
@@ -24,13 +58,13 @@ class TwoParamsOperatorBase(OperatorBase):
         self.param2 = param2
 
     def get_type(self, env):
-        t1 = self.param1.get_type(env)
+        t1 = yield self.param1.get_type(env)
 
         if self.ALLOWED_TYPES != 'Any' and t1 not in self.ALLOWED_TYPES:
             raise TypeException(
                 '{} is not allowed type. Operator {} only accepts {}'.format(t1, self.NAME, self.ALLOWED_TYPES), self)
 
-        t2 = self.param2.get_type(env)
+        t2 = yield self.param2.get_type(env)
 
         if self.ALLOWED_TYPES == 'Any':
             if not (is_type_matching(t1, t2, env) or is_type_matching(t2, t1, env)):
@@ -41,11 +75,13 @@ class TwoParamsOperatorBase(OperatorBase):
 
 
 class OneParamOperatorBase(OperatorBase):
+    __slots__ = ('param',)
+
     def __init__(self, param):
         self.param = param
 
     def get_type(self, env):
-        t = self.param.get_type(env)
+        t = yield self.param.get_type(env)
         if t not in self.ALLOWED_TYPES:
             raise TypeException(
                 '{} is not allowed type. Operator {} only accepts {}'.format(t, self.NAME, self.ALLOWED_TYPES), self)
@@ -53,302 +89,442 @@ class OneParamOperatorBase(OperatorBase):
 
 
 class IntOperator():
+    __slots__ = ()
+
     ALLOWED_TYPES = [INT_TYPE]
     RESULT_TYPE = INT_TYPE
 
 
 class BoolResultOperator():
     __metaclass__ = ABCMeta
+    __slots__ = ()
 
     @abstractmethod
-    def boolean_jmp(self, if_true, if_false):
+    def boolean_jmp(self, if_true, if_false, out: Emitter):
         raise NotImplementedError()
 
-    def calc_to_register(self, location: RegisterLocation):
-        l_true = 'L{}'.format(Counter.get())
-        l_false = 'L{}'.format(Counter.get())
-        l_end = 'L{}'.format(Counter.get())
-
-        return self.boolean_jmp(l_true, l_false) + [
-            l_true + ':',
-            'mov {}, 1'.format(location),
-            'jmp {}'.format(l_end),
-            l_false + ':',
-            'mov {}, 0'.format(location),
-            l_end + ':'
-        ]
+    def calc_to_register(self, location: RegisterLocation, out: Emitter):
+        l_true = out.new_label()
+        l_false = out.new_label()
+        l_end = out.new_label()
+
+        yield self.boolean_jmp(l_true, l_false, out)
+        out.emit(l_true,
+                 Instruction('mov', location.register, Immediate(1)),
+                 Instruction('jmp', l_end),
+                 l_false,
+                 Instruction('mov', location.register, Immediate(0)),
+                 l_end)
+
+    def lower(self, fn):
+        result = fn.temp(4)
+        if_true, if_false, end = fn.new_block(), fn.new_block(), fn.new_block()
+        yield self.lower_jump(fn, if_true, if_false)
+        fn.start(if_true)
+        fn.emit('copy', result, [ir.Const(1)])
+        fn.jump(end)
+        fn.start(if_false)
+        fn.emit('copy', result, [ir.Const(0)])
+        fn.start(end)
+        return result
 
 
 class IntBoolOperator(BoolResultOperator):
     __metaclass__ = ABCMeta
+    __slots__ = ()
 
     ALLOWED_TYPES = [INT_TYPE]
     RESULT_TYPE = BOOL_TYPE
 
     @abstractmethod
-    def boolean_jmp(self, if_true, if_false):
+    def boolean_jmp(self, if_true, if_false, out: Emitter):
         raise NotImplementedError()
 
 
 class BoolOperator(BoolResultOperator):
     __metaclass__ = ABCMeta
+    __slots__ = ()
 
     ALLOWED_TYPES = [BOOL_TYPE]
     RESULT_TYPE = BOOL_TYPE
 
     @abstractmethod
-    def boolean_jmp(self, if_true, if_false):
+    def boolean_jmp(self, if_true, if_false, out: Emitter):
         raise NotImplementedError()
 
 
 class TwoParamsIntOperator(TwoParamsOperatorBase, IntOperator):
-    MNEMONIC = None
+    __slots__ = ()
 
-    def calc_to_register(self, location: RegisterLocation):
-        if self.regsiter1 == location:
-            temp_register = self.regsiter2
-        else:
-            temp_register = self.regsiter1
-
-        return ['push {}'.format(temp_register.full_name)] + \
-               self.param1.mov_to_register(location) + \
-               self.param2.mov_to_register(temp_register) + \
-               [
-                   '{} {}, {}'.format(self.MNEMONIC, location, temp_register),
-                   'pop {}'.format(temp_register.full_name)
-               ]
+    MNEMONIC = None
+    IR_OP = None
+
+    def calc_to_register(self, location: RegisterLocation, out: Emitter):
+        operand = self.param2.operand() if out.optimize else None
+        if operand is not None:
+            yield self.param1.mov_to_register(location, out)
+            out.emit(Instruction(self.MNEMONIC, location.register, asm_operand(operand)))
+            return
+
+        temp_register = out.temporary(location)
+        saved = temp_register is None
+        if saved:
+            if self.regsiter1 == location:
+                temp_register = self.regsiter2
+            else:
+                temp_register = self.regsiter1
+            out.emit(Instruction('push', temp_register.full))
+
+        yield self.param1.mov_to_register(location, out)
+        out.live.append(location)
+        yield self.param2.mov_to_register(temp_register, out)
+        out.live.pop()
+        out.emit(Instruction(self.MNEMONIC, location.register, temp_register.register))
+        if saved:
+            out.emit(Instruction('pop', temp_register.full))
+
+    def lower(self, fn):
+        left = yield self.param1.lower(fn)
+        right = yield self.param2.lower(fn)
+        return fn.emit(self.IR_OP, fn.temp(4), [left, right])
 
 
 class TwoParamsIntToBoolOperator(TwoParamsOperatorBase, IntBoolOperator):
-    COMPARISON = None
-
-    def boolean_jmp(self, if_true, if_false):
-        return ['push {}'.format(self.regsiter1.full_name),
-                'push {}'.format(self.regsiter2.full_name)] + \
-               self.param1.mov_to_register(self.regsiter1) + \
-               self.param2.mov_to_register(self.regsiter2) + \
-               [
-                   'cmp {}, {}'.format(self.regsiter1, self.regsiter2),
-                   'pop {}'.format(self.regsiter2.full_name),
-                   'pop {}'.format(self.regsiter1.full_name),
-                   '{} {}'.format(self.COMPARISON, if_true),
-                   'jmp {}'.format(if_false),
-               ]
+    __slots__ = ()
 
-    def calc_to_register(self, location: RegisterLocation):
-        return BoolResultOperator.calc_to_register(self, location)
+    COMPARISON = None
+    RELATION = None
+
+    def compare(self, comparison, if_true, if_false, out: Emitter):
+        """
+        Compares the parameters where they already are (ExpBase.operand) or in free temporaries (Emitter.temporary)
+        and jumps.
+        :return: False if there are not enough temporaries and nothing was emitted
+        """
+        if not out.optimize:
+            return False
+        first = self.param1.operand()
+        first_ready = isinstance(first, RegisterLocation)
+        if not first_ready:
+            first = out.temporary()
+        second = self.param2.operand()
+        second_ready = second is not None
+        if not second_ready:
+            second = out.temporary(first) if first is not None else None
+        if first is None or second is None:
+            return False
+
+        if not first_ready:
+            yield self.param1.mov_to_register(first, out)
+        if not second_ready:
+            out.live.append(first)
+            yield self.param2.mov_to_register(second, out)
+            out.live.pop()
+        size = get_size(self.param1.checked_type)
+        out.emit(Instruction('cmp', first.sized(size), asm_operand(second, size)),
+                 Instruction(comparison, if_true),
+                 Instruction('jmp', if_false))
+        return True
+
+    def boolean_jmp(self, if_true, if_false, out: Emitter):
+        if (yield self.compare(self.COMPARISON, if_true, if_false, out)):
+            return
+        out.emit(Instruction('push', self.regsiter1.full),
+                 Instruction('push', self.regsiter2.full))
+        yield self.param1.mov_to_register(self.regsiter1, out)
+        yield self.param2.mov_to_register(self.regsiter2, out)
+        out.emit(Instruction('cmp', self.regsiter1.register, self.regsiter2.register),
+                 Instruction('pop', self.regsiter2.full),
+                 Instruction('pop', self.regsiter1.full),
+                 Instruction(self.COMPARISON, if_true),
+                 Instruction('jmp', if_false))
+
+    def calc_to_register(self, location: RegisterLocation, out: Emitter):
+        return BoolResultOperator.calc_to_register(self, location, out)
+
+    def lower_jump(self, fn, if_true, if_false):
+        left = yield self.param1.lower(fn)
+        right = yield self.param2.lower(fn)
+        fn.branch(self.RELATION, left, right, if_true, if_false)
 
 
 class PlusOperator(TwoParamsIntOperator):
+    __slots__ = ('type',)
+
     MNEMONIC = 'add'
     ALLOWED_TYPES = [INT_TYPE, STRING_TYPE]
     RESULT_TYPE = None
+    IR_OP = 'add'
     NAME = '+'
 
     def get_type(self, env):
-        super().get_type(env)
-        self.type = self.param1.get_type(env)
+        yield super().get_type(env)
+        self.type = yield self.param1.get_type(env)
         return self.type
 
-    def calc_to_register(self, location: RegisterLocation):
+    def calc_to_register(self, location: RegisterLocation, out: Emitter):
         if self.type == INT_TYPE:
-            return super().calc_to_register(location)
+            return super().calc_to_register(location, out)
         else:
-            return ExpApp('strConcat', [self.param1, self.param2]).mov_to_register(location)
+            return ExpApp('strConcat', [self.param1, self.param2]).mov_to_register(location, out)
+
+    def lower(self, fn):
+        if self.type == INT_TYPE:
+            return (yield super().lower(fn))
+        args = yield ExpApp.lower_args([self.param1, self.param2], fn)
+        return fn.emit('call', fn.temp(8), args, 'top_strConcat')
 
     def get_real_value(self):
-        return self.param1.get_real_value() + self.param2.get_real_value()
+        left = yield self.param1.get_real_value()
+        right = yield self.param2.get_real_value()
+        if self.type == STRING_TYPE:
+            # values of strings are their bytes, see ExpLitString.get_real_value
+            return left + right
+        return int32(left + right)
 
 
 class MinusOperator(TwoParamsIntOperator):
+    __slots__ = ()
+
     MNEMONIC = 'sub'
+    IR_OP = 'sub'
     NAME = '-'
 
     def get_real_value(self):
-        return self.param1.get_real_value() - self.param2.get_real_value()
+        return int32((yield self.param1.get_real_value()) - (yield self.param2.get_real_value()))
 
 
 class TimesOperator(TwoParamsIntOperator):
+    __slots__ = ()
+
     MNEMONIC = 'imul'
+    IR_OP = 'mul'
     NAME = '*'
 
     def get_real_value(self):
-        return self.param1.get_real_value() * self.param2.get_real_value()
+        return int32((yield self.param1.get_real_value()) * (yield self.param2.get_real_value()))
 
 
 class DivisionOperator(TwoParamsIntOperator):
+    __slots__ = ()
+
     MNEMONIC = 'div'
+    IR_OP = 'div'
     NAME = '/'
     STANDARD_LOCATION = RegisterLocation('eax', 'rax')
     DIVISOR_LOCATION = RegisterLocation('ebx', 'rbx')
+    AFTER_DIVISION = []
 
-    def calc_to_register(self, location: RegisterLocation):
-        result = []
+    def calc_to_register(self, location: RegisterLocation, out: Emitter):
+        if location == self.STANDARD_LOCATION:
+            out.emit(Instruction('push', self.DIVISOR_LOCATION.full))
+        elif location == self.DIVISOR_LOCATION:
+            out.emit(Instruction('push', self.STANDARD_LOCATION.full))
+        else:
+            out.emit(Instruction('push', self.DIVISOR_LOCATION.full),
+                     Instruction('push', self.STANDARD_LOCATION.full))
 
-        result += self.param1.mov_to_register(self.STANDARD_LOCATION)
-        result += self.param2.mov_to_register(self.DIVISOR_LOCATION)
-        result += [
-            'push rdx',
-            'cdq',
-            'idiv {}'.format(self.DIVISOR_LOCATION),
-            'pop rdx'
-        ]
+        yield self.param1.mov_to_register(self.STANDARD_LOCATION, out)
+        yield self.param2.mov_to_register(self.DIVISOR_LOCATION, out)
+        out.emit(Instruction('push', RDX),
+                 Instruction('cdq'),
+                 Instruction('idiv', self.DIVISOR_LOCATION.register))
+        out.extend(self.AFTER_DIVISION)
+        out.emit(Instruction('pop', RDX))
 
         if location == self.STANDARD_LOCATION:
-            result.insert(0, 'push {}'.format(self.DIVISOR_LOCATION.full_name))
-            result.append('pop {}'.format(self.DIVISOR_LOCATION.full_name))
+            out.emit(Instruction('pop', self.DIVISOR_LOCATION.full))
         elif location == self.DIVISOR_LOCATION:
-            result.insert(0, 'push {}'.format(self.STANDARD_LOCATION.full_name))
-            result.append('mov {}, {}'.format(location, self.STANDARD_LOCATION))
-            result.append('pop {}'.format(self.STANDARD_LOCATION.full_name))
+            out.emit(Instruction('mov', location.register, self.STANDARD_LOCATION.register),
+                     Instruction('pop', self.STANDARD_LOCATION.full))
         else:
-            result.insert(0, 'push {}'.format(self.DIVISOR_LOCATION.full_name))
-            result.insert(1, 'push {}'.format(self.STANDARD_LOCATION.full_name))
-            result.append('mov {}, {}'.format(location, self.STANDARD_LOCATION))
-            result.append('pop {}'.format(self.STANDARD_LOCATION.full_name))
-            result.append('pop {}'.format(self.DIVISOR_LOCATION.full_name))
-
-        return result
+            out.emit(Instruction('mov', location.register, self.STANDARD_LOCATION.register),
+                     Instruction('pop', self.STANDARD_LOCATION.full),
+                     Instruction('pop', self.DIVISOR_LOCATION.full))
 
     def get_real_value(self):
-        return self.param1.get_real_value() // self.param2.get_real_value()
+        return divide((yield self.param1.get_real_value()), (yield self.param2.get_real_value()))[0]
 
 
 class ModOperator(DivisionOperator):
+    __slots__ = ()
+
     MNEMONIC = 'div'
+    IR_OP = 'mod'
     NAME = '%'
-
-    def calc_to_register(self, location: RegisterLocation):
-        result = super().calc_to_register(location)
-        idx = result.index('idiv {}'.format(self.DIVISOR_LOCATION))
-        result.insert(idx + 1, 'mov eax, edx')
-        return result
+    AFTER_DIVISION = [Instruction('mov', EAX, EDX)]
 
     def get_real_value(self):
-        return self.param1.get_real_value() % self.param2.get_real_value()
+        return divide((yield self.param1.get_real_value()), (yield self.param2.get_real_value()))[1]
 
 
 class LTOperator(TwoParamsIntToBoolOperator):
+    __slots__ = ()
+
     NAME = '<'
     COMPARISON = 'jl'
+    RELATION = 'lt'
 
     def get_real_value(self):
-        return self.param1.get_real_value() < self.param2.get_real_value()
+        return (yield self.param1.get_real_value()) < (yield self.param2.get_real_value())
 
 
 class LEOperator(TwoParamsIntToBoolOperator):
+    __slots__ = ()
+
     NAME = '<='
     COMPARISON = 'jle'
+    RELATION = 'le'
 
     def get_real_value(self):
-        return self.param1.get_real_value() <= self.param2.get_real_value()
+        return (yield self.param1.get_real_value()) <= (yield self.param2.get_real_value())
 
 
 class GTOperator(TwoParamsIntToBoolOperator):
+    __slots__ = ()
+
     NAME = '>'
     COMPARISON = 'jg'
+    RELATION = 'gt'
 
     def get_real_value(self):
-        return self.param1.get_real_value() > self.param2.get_real_value()
+        return (yield self.param1.get_real_value()) > (yield self.param2.get_real_value())
 
 
 class GEOperator(TwoParamsIntToBoolOperator):
+    __slots__ = ()
+
     NAME = '>='
     COMPARISON = 'jge'
+    RELATION = 'ge'
 
     def get_real_value(self):
-        return self.param1.get_real_value() >= self.param2.get_real_value()
+        return (yield self.param1.get_real_value()) >= (yield self.param2.get_real_value())
 
 
 class EQOperator(TwoParamsIntToBoolOperator):
+    __slots__ = ()
+
     ALLOWED_TYPES = 'Any'
     NAME = '=='
     COMPARISON = 'je'
+    RELATION = 'eq'
 
     def get_real_value(self):
-        return self.param1.get_real_value() == self.param2.get_real_value()
-
-    def boolean_jmp(self, if_true, if_false):
-        return ['push {}'.format(self.regsiter1.full_name),
-                'push {}'.format(self.regsiter2.full_name)] + \
-               self.param1.mov_to_register(self.regsiter1) + \
-               self.param2.mov_to_register(self.regsiter2) + \
-               [
-                   'cmp {}, {}'.format(self.regsiter1.full_name, self.regsiter2.full_name),
-                   'pop {}'.format(self.regsiter2.full_name),
-                   'pop {}'.format(self.regsiter1.full_name),
-                   '{} {}'.format(EQOperator.COMPARISON, if_true),
-                   'jmp {}'.format(if_false),
-               ]
+        if self.param1.checked_type == STRING_TYPE:
+            # strings are compared by address, equal literals may or may not share one
+            raise AttributeError("Cannot give real value")
+        return (yield self.param1.get_real_value()) == (yield self.param2.get_real_value())
+
+    def boolean_jmp(self, if_true, if_false, out: Emitter):
+        if (yield self.compare(EQOperator.COMPARISON, if_true, if_false, out)):
+            return
+        out.emit(Instruction('push', self.regsiter1.full),
+                 Instruction('push', self.regsiter2.full))
+        yield self.param1.mov_to_register(self.regsiter1, out)
+        yield self.param2.mov_to_register(self.regsiter2, out)
+        out.emit(Instruction('cmp', self.regsiter1.full, self.regsiter2.full),
+                 Instruction('pop', self.regsiter2.full),
+                 Instruction('pop', self.regsiter1.full),
+                 Instruction(EQOperator.COMPARISON, if_true),
+                 Instruction('jmp', if_false))
 
 
 class NEOperator(TwoParamsIntToBoolOperator):
+    __slots__ = ()
+
     ALLOWED_TYPES = 'Any'
     NAME = '!='
     COMPARISON = 'jne'
+    RELATION = 'ne'
 
     def get_real_value(self):
-        return self.param1.get_real_value() != self.param2.get_real_value()
+        return not (yield EQOperator.get_real_value(self))
 
-    def boolean_jmp(self, if_true, if_false):
-        return EQOperator.boolean_jmp(self, if_false, if_true)
+    def boolean_jmp(self, if_true, if_false, out: Emitter):
+        return EQOperator.boolean_jmp(self, if_false, if_true, out)
 
 
 class NegOperator(OneParamOperatorBase, IntOperator):
+    __slots__ = ()
+
     NAME = '-'
 
-    def calc_to_register(self, location: RegisterLocation):
-        return self.param.mov_to_register(location) + \
-               ['neg {}'.format(location)]
+    def calc_to_register(self, location: RegisterLocation, out: Emitter):
+        yield self.param.mov_to_register(location, out)
+        out.emit(Instruction('neg', location.register))
+
+    def lower(self, fn):
+        value = yield self.param.lower(fn)
+        return fn.emit('neg', fn.temp(4), [value])
 
     def get_real_value(self):
-        return -self.param.get_real_value()
+        return int32(-(yield self.param.get_real_value()))
 
 
 class NotOperator(OneParamOperatorBase, BoolOperator):
+    __slots__ = ()
+
     NAME = '!'
 
-    def boolean_jmp(self, if_true, if_false):
-        return self.param.boolean_jmp(if_false, if_true)
+    def boolean_jmp(self, if_true, if_false, out: Emitter):
+        return self.param.boolean_jmp(if_false, if_true, out)
+
+    def lower_jump(self, fn, if_true, if_false):
+        return self.param.lower_jump(fn, if_false, if_true)
 
-    def calc_to_register(self, location: RegisterLocation):
-        return BoolResultOperator.calc_to_register(self, location)
+    def calc_to_register(self, location: RegisterLocation, out: Emitter):
+        return BoolResultOperator.calc_to_register(self, location, out)
 
     def get_real_value(self):
-        return not self.param.get_real_value()
+        return not (yield self.param.get_real_value())
 
 
 class AndOperator(TwoParamsOperatorBase, BoolOperator):
+    __slots__ = ()
+
     NAME = '&&'
 
-    def boolean_jmp(self, if_true, if_false):
-        label = 'L{}'.format(Counter.get())
+    def boolean_jmp(self, if_true, if_false, out: Emitter):
+        label = out.new_label()
 
-        result = self.param1.boolean_jmp(label, if_false)
-        result += [label + ':']
-        result += self.param2.boolean_jmp(if_true, if_false)
-        return result
+        yield self.param1.boolean_jmp(label, if_false, out)
+        out.emit(label)
+        yield self.param2.boolean_jmp(if_true, if_false, out)
+
+    def lower_jump(self, fn, if_true, if_false):
+        block = fn.new_block()
+        yield self.param1.lower_jump(fn, block, if_false)
+        fn.start(block)
+        yield self.param2.lower_jump(fn, if_true, if_false)
 
-    def calc_to_register(self, location: RegisterLocation):
-        return BoolResultOperator.calc_to_register(self, location)
+    def calc_to_register(self, location: RegisterLocation, out: Emitter):
+        return BoolResultOperator.calc_to_register(self, location, out)
 
     def get_real_value(self):
-        return self.param1.get_real_value() and self.param2.get_real_value()
+        return (yield self.param1.get_real_value()) and (yield self.param2.get_real_value())
 
 
 class OrOperator(TwoParamsOperatorBase, BoolOperator):
+    __slots__ = ()
+
     NAME = '||'
 
-    def boolean_jmp(self, if_true, if_false):
-        label = 'L{}'.format(Counter.get())
+    def boolean_jmp(self, if_true, if_false, out: Emitter):
+        label = out.new_label()
 
-        result = self.param1.boolean_jmp(if_true, label)
-        result += [label + ':']
-        result += self.param2.boolean_jmp(if_true, if_false)
-        return result
+        yield self.param1.boolean_jmp(if_true, label, out)
+        out.emit(label)
+        yield self.param2.boolean_jmp(if_true, if_false, out)
+
+    def lower_jump(self, fn, if_true, if_false):
+        block = fn.new_block()
+        yield self.param1.lower_jump(fn, if_true, block)
+        fn.start(block)
+        yield self.param2.lower_jump(fn, if_true, if_false)
 
-    def calc_to_register(self, location: RegisterLocation):
-        return BoolResultOperator.calc_to_register(self, location)
+    def calc_to_register(self, location: RegisterLocation, out: Emitter):
+        return BoolResultOperator.calc_to_register(self, location, out)
 
     def get_real_value(self):
-        return self.param1.get_real_value() or self.param2.get_real_value()
+        return (yield self.param1.get_real_value()) or (yield self.param2.get_real_value())
@@ -0,0 +1,154 @@
+"""
+Peephole optimization of the code of a function, run by Emitter.flush at -O1.
+
+RULES is a table of (name, window, rule): rule gets window consecutive lines and returns the lines replacing them or
+None. optimize() slides over the code and applies the first matching rule at every position, and repeats passes until
+one changes nothing, so a replacement can enable another rule. Only Instruction and Label objects match; strings
+(directives, data, code from the cache) are left alone and nothing is moved across them. Labels are never removed, so
+every jump keeps its target.
+
+The only instructions reading flags in the generated code are conditional jumps, which always follow their cmp or
+test, so rules may drop or change instructions setting flags unless a conditional jump comes next.
+"""
+from asm import Instruction, Immediate, Memory, Register
+
+# conditional jumps and the jump taken in the opposite case
+INVERSE_JUMPS = {'je': 'jne', 'jne': 'je', 'jl': 'jge', 'jge': 'jl', 'jg': 'jle', 'jle': 'jg'}
+
+# 64-bit registers; mov to a 32-bit one clears the upper half, so mov eax, eax is not a no-op
+FULL_REGISTERS = {'rax', 'rbx', 'rcx', 'rdx', 'rsi', 'rdi', 'rbp', 'rsp', 'r8', 'r9', 'r10', 'r11', 'r12', 'r13',
+                  'r14', 'r15'}
+
+# 64-bit register -> its lower 32 bits
+DOUBLE_WORDS = {'rax': 'eax', 'rbx': 'ebx', 'rcx': 'ecx', 'rdx': 'edx', 'rsi': 'esi', 'rdi': 'edi', 'rbp': 'ebp',
+                'rsp': 'esp', 'r8': 'r8d', 'r9': 'r9d', 'r10': 'r10d', 'r11': 'r11d', 'r12': 'r12d', 'r13': 'r13d',
+                'r14': 'r14d', 'r15': 'r15d'}
+
+
+def is_instruction(line, *opcodes):
+    return isinstance(line, Instruction) and line.opcode in opcodes
+
+
+def push_pop(push, pop):
+    """
+    push X / pop X
+    """
+    if is_instruction(push, 'push') and is_instruction(pop, 'pop') and push.operands == pop.operands:
+        return []
+    return None
+
+
+def pop_push(pop, push):
+    """
+    pop X / push X  ->  mov X, QWORD [rsp]
+    """
+    if is_instruction(pop, 'pop') and is_instruction(push, 'push') and pop.operands == push.operands \
+            and isinstance(pop.operands[0], Register):
+        return [Instruction('mov', pop.operands[0], Memory('rsp', 0, 8))]
+    return None
+
+
+def memory_self_copy(push, load, store, pop):
+    """
+    push rax / mov eax, M / mov M, eax / pop rax, the copy of MemoryLocation.mov_to_memory to its own place; the
+    register moved through has to be the saved one, any other would keep the value of M
+    """
+    if is_instruction(push, 'push') and is_instruction(load, 'mov') and is_instruction(store, 'mov') \
+            and is_instruction(pop, 'pop') and push.operands == pop.operands \
+            and load.operands == store.operands[::-1] and isinstance(load.operands[1], Memory) \
+            and isinstance(push.operands[0], Register) and isinstance(load.operands[0], Register) \
+            and load.operands[0].name in (push.operands[0].name, DOUBLE_WORDS.get(push.operands[0].name)):
+        return []
+    return None
+
+
+def self_move(move):
+    """
+    mov R, R of a 64-bit register
+    """
+    if is_instruction(move, 'mov') and move.operands[0] == move.operands[1] \
+            and isinstance(move.operands[0], Register) and move.operands[0].name in FULL_REGISTERS:
+        return []
+    return None
+
+
+def jump_to_next(jump, label):
+    """
+    jmp L / L:
+    """
+    if is_instruction(jump, 'jmp') and jump.operands[0] == label:
+        return [label]
+    return None
+
+
+def branch_over_jump(branch, jump, label):
+    """
+    jcc L1 / jmp L2 / L1:  ->  jncc L2 / L1:
+    """
+    if isinstance(branch, Instruction) and branch.opcode in INVERSE_JUMPS and is_instruction(jump, 'jmp') \
+            and branch.operands[0] == label:
+        return [Instruction(INVERSE_JUMPS[branch.opcode], jump.operands[0]), label]
+    return None
+
+
+def compare_zero(compare):
+    """
+    cmp R, 0  ->  test R, R, which sets the flags the same way
+    """
+    if is_instruction(compare, 'cmp') and isinstance(compare.operands[0], Register) \
+            and compare.operands[1] == Immediate(0):
+        return [Instruction('test', compare.operands[0], compare.operands[0])]
+    return None
+
+
+def add_zero(instruction, following):
+    """
+    add X, 0 or sub X, 0 not followed by a conditional jump, like the prologue of a function without a frame
+    """
+    if is_instruction(instruction, 'add', 'sub') and instruction.operands[1] == Immediate(0) \
+            and not (isinstance(following, Instruction) and following.opcode in INVERSE_JUMPS):
+        return [following]
+    return None
+
+
+RULES = [
+    ('push_pop', 2, push_pop),
+    ('pop_push', 2, pop_push),
+    ('memory_self_copy', 4, memory_self_copy),
+    ('self_move', 1, self_move),
+    ('jump_to_next', 2, jump_to_next),
+    ('branch_over_jump', 3, branch_over_jump),
+    ('compare_zero', 1, compare_zero),
+    ('add_zero', 2, add_zero),
+]
+
+RULE_NAMES = [name for name, _, _ in RULES]
+
+
+def optimize(lines, hits):
+    """
+    :param lines: code of a function as emitted
+    :param hits: dict from rule name to the number of its replacements, updated
+    :return: the code with the rules applied until none matches
+    """
+    changed = True
+    while changed:
+        changed = False
+        result = []
+        index = 0
+        while index < len(lines):
+            for name, window, rule in RULES:
+                if index + window > len(lines):
+                    continue
+                replacement = rule(*lines[index:index + window])
+                if replacement is not None:
+                    hits[name] += 1
+                    result.extend(replacement)
+                    index += window
+                    changed = True
+                    break
+            else:
+                result.append(lines[index])
+                index += 1
+        lines = result
+    return lines
@@ -0,0 +1,127 @@
+"""
+Wall time and memory of the compiler phases and of every function, reported as JSON by grammar_test.py --timings.
+
+Memory comes from tracemalloc, which is started only while a report is active: peak_memory is the highest traced
+memory above the level at the start of a phase or function, memory what is still allocated at its end. Tracing
+slows the compiler down several times, Report(memory=False) records only wall time. Outside of an active Report,
+measure() costs a function call.
+"""
+import contextlib
+import json
+import time
+import tracemalloc
+
+_report = None
+
+_NOTHING = contextlib.nullcontext()
+
+
+def measure(phase, name):
+    """
+    :return: context manager recording the checking or compilation of a function in the active report
+    """
+    if _report is None:
+        return _NOTHING
+    return _report.measure(_report.functions, name=name, phase=phase)
+
+
+def call(counter, f, *args):
+    """
+    Calls f, adding its wall time to the counter of the active report.
+    """
+    if _report is None:
+        return f(*args)
+    start = time.perf_counter()
+    try:
+        return f(*args)
+    finally:
+        _report.counters[counter] = _report.counters.get(counter, 0) + time.perf_counter() - start
+
+
+class Report:
+    """
+    with Report() as report: activates the report, phases are recorded with report.phase(name) and functions by
+    measure() in the compiler.
+    """
+
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.phases = []
+        self.functions = []
+        self.counters = {}
+        self.info = {}
+        self.total = None
+        self.frames = []
+        self.start = None
+
+    def __enter__(self):
+        global _report
+        if self.memory:
+            tracemalloc.start()
+        _report = self
+        self.frames.append(self.enter())
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        global _report
+        wall = time.perf_counter() - self.start
+        self.total = dict(wall=wall, **self.exit(self.frames.pop()))
+        _report = None
+        if self.memory:
+            tracemalloc.stop()
+
+    def enter(self):
+        if not self.memory:
+            return None
+        current, peak = tracemalloc.get_traced_memory()
+        if self.frames:
+            self.frames[-1]['peak'] = max(self.frames[-1]['peak'], peak)
+        tracemalloc.reset_peak()
+        return {'start': current, 'peak': current}
+
+    def exit(self, frame):
+        if not self.memory:
+            return {}
+        current, peak = tracemalloc.get_traced_memory()
+        peak = max(frame['peak'], peak)
+        if self.frames:
+            self.frames[-1]['peak'] = max(self.frames[-1]['peak'], peak)
+        return {'peak_memory': peak - frame['start'], 'memory': current - frame['start']}
+
+    @contextlib.contextmanager
+    def measure(self, entries, **fields):
+        """
+        Appends fields with wall time and memory to entries when the block ends, also if it raises.
+        """
+        frame = self.enter()
+        self.frames.append(frame)
+        start = time.perf_counter()
+        try:
+            yield fields
+        finally:
+            wall = time.perf_counter() - start
+            self.frames.pop()
+            fields.update(wall=wall, **self.exit(frame))
+            entries.append(fields)
+
+    def phase(self, name):
+        return self.measure(self.phases, name=name)
+
+    def json(self):
+        return json.dumps(dict(self.info, total=self.total, phases=self.phases, functions=self.functions), indent=2)
+
+
+class TimedWriter:
+    """
+    File wrapper summing the time spent in write, to tell code generation and writing of the output apart.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.wall = 0
+
+    def write(self, text):
+        start = time.perf_counter()
+        self.stream.write(text)
+        self.wall += time.perf_counter() - start
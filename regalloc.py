@@ -0,0 +1,208 @@
+"""
+Register allocation for the arguments and local variables of a function, run when the function has been checked.
+
+Liveness is computed over program points: the arguments are defined at point 0 and every statement, and every
+variable of a declaration, takes the next point in source order. A variable lives from its definition to its last
+use; a variable defined before a while loop and used in it lives to the end of the loop, which jumps back to its
+start. Linear scan (Poletto and Sarkar) walks the intervals by start and hands out the registers code generation
+leaves alone; when none is free, the interval ending last is spilled to the stack. Intervals crossing a call prefer
+the callee-saved r15, saved in the prologue, the caller-saved registers of the others are saved around the calls they
+cross. Caller-saved registers no variable gets are left to code generation as temporaries (Emitter.temporary).
+"""
+import compiler
+import expr
+import stmt
+from asm import Instruction, Memory
+from compiler import CALLEE_SAVED_REGISTERS, CALLER_SAVED_REGISTERS, MemoryLocation
+
+# runtime functions written in assembly, they keep every register
+PRESERVING_CALLS = {'printInt', 'printString', 'strConcat'}
+
+
+class Interval:
+    __slots__ = ('location', 'start', 'end', 'refs', 'calls', 'register')
+
+    def __init__(self, location, start, refs):
+        self.location = location
+        self.start = start
+        self.end = start
+        self.refs = refs
+        self.calls = 0
+        self.register = None
+
+
+class Allocation:
+    """
+    Result of allocate, kept in FunDef.allocation for code generation.
+    """
+
+    def __init__(self, stack_counter, saved, loads, temporaries, call_saves):
+        self.stack_counter = stack_counter
+        # callee-saved registers pushed by the prologue and the instructions restoring them before a return
+        self.saved = saved
+        self.restore = [Instruction('mov', register.full, Memory('rbp', stack_counter - 8 * (index + 1), 8))
+                        for index, register in enumerate(saved)]
+        # (register, stack location) of the arguments the prologue loads to registers
+        self.loads = loads
+        self.temporaries = temporaries
+        # id of a call node -> registers of variables living across it, to be saved by the caller
+        self.call_saves = call_saves
+
+
+class _LoopEnd:
+    __slots__ = ('start',)
+
+    def __init__(self, start):
+        self.start = start
+
+
+def expression_nodes(node):
+    """
+    Nodes of an expression, without the classes that ExpNew and attribute accesses refer to after checking.
+    """
+    stack = [node]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, compiler.BaseBase):
+            if not isinstance(value, compiler.ClassDef):
+                yield value
+                stack.extend(getattr(value, field) for field in value.FIELDS)
+        elif isinstance(value, list):
+            stack.extend(value)
+
+
+def uses(expression, location):
+    """
+    :return: whether the expression reads the variable at location
+    """
+    return any(isinstance(node, expr.ExpVariable) and node.location is location
+               for node in expression_nodes(expression))
+
+
+class Liveness:
+    """
+    Live intervals of the variables of a function body and the program points of its calls.
+    """
+
+    def __init__(self, args):
+        self.point = 0
+        self.intervals = {id(location): Interval(location, 0, []) for location in args}
+        self.calls = []
+
+    def expression(self, node):
+        for node in expression_nodes(node):
+            if isinstance(node, expr.ExpVariable):
+                interval = self.intervals.get(id(node.location))
+                # self and the fields of methods are not allocated
+                if interval is not None:
+                    interval.end = self.point
+                    interval.refs.append(node)
+            elif isinstance(node, (expr.ExpMethodCall, expr.ExpNew)) or \
+                    isinstance(node, expr.ExpApp) and node.name not in PRESERVING_CALLS:
+                self.calls.append((id(node), self.point))
+
+    def scan(self, block):
+        stack = [block]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, _LoopEnd):
+                for interval in self.intervals.values():
+                    if interval.start < node.start <= interval.end:
+                        interval.end = self.point
+            elif isinstance(node, compiler.Block):
+                stack.extend(reversed(node.stmts))
+            elif isinstance(node, stmt.BlockStmt):
+                stack.append(node.block)
+            elif isinstance(node, stmt.DeclStmt):
+                for var in node.vars:
+                    self.point += 1
+                    self.expression(var.value)
+                    self.intervals[id(var.location)] = Interval(var.location, self.point, [var])
+            elif isinstance(node, stmt.IfElseStmt):
+                self.point += 1
+                self.expression(node.cond)
+                stack.extend([node.stmt2, node.stmt1])
+            elif isinstance(node, (stmt.IfStmt, stmt.WhileStmt)):
+                self.point += 1
+                self.expression(node.cond)
+                if isinstance(node, stmt.WhileStmt):
+                    stack.append(_LoopEnd(self.point))
+                stack.append(node.stmt)
+            else:
+                self.point += 1
+                for field in node.FIELDS:
+                    value = getattr(node, field)
+                    if isinstance(value, compiler.BaseBase):
+                        self.expression(value)
+
+
+def linear_scan(intervals):
+    """
+    Sets the register of the intervals that get one, the others stay None.
+    """
+    pool = CALLEE_SAVED_REGISTERS + CALLER_SAVED_REGISTERS
+    taken = set()
+    active = []
+    for interval in sorted(intervals, key=lambda interval: interval.start):
+        for old in list(active):
+            if old.end < interval.start:
+                active.remove(old)
+                taken.discard(id(old.register))
+
+        free = [register for register in pool if id(register) not in taken]
+        preferred = CALLEE_SAVED_REGISTERS if interval.calls else CALLER_SAVED_REGISTERS
+        candidates = [register for register in free if register in preferred] or free
+        if candidates:
+            interval.register = candidates[0]
+            taken.add(id(interval.register))
+            active.append(interval)
+            continue
+
+        victim = max(active, key=lambda interval: interval.end)
+        if victim.end > interval.end:
+            interval.register, victim.register = victim.register, None
+            active.remove(victim)
+            active.append(interval)
+
+
+def allocate(fun, args):
+    """
+    Allocates registers to the variables of a checked function, its ExpVariable and VarDef nodes are moved to the
+    new locations.
+    :param args: stack locations of the arguments
+    :return: Allocation
+    """
+    liveness = Liveness(args)
+    liveness.scan(fun.block)
+    # unused arguments stay where they are, the prologue would load them for nothing
+    intervals = [interval for interval in liveness.intervals.values()
+                 if interval.refs or interval.location not in args]
+
+    for interval in intervals:
+        interval.calls = sum(1 for _, point in liveness.calls if interval.start < point <= interval.end)
+    linear_scan(intervals)
+
+    stack_counter = 0
+    loads = []
+    for interval in intervals:
+        if interval.register is not None:
+            location = interval.register
+            if interval.start == 0:
+                loads.append((location, interval.location))
+        elif interval.start == 0:
+            continue
+        else:
+            stack_counter -= interval.location.size
+            location = MemoryLocation(stack_counter, interval.location.size)
+        for node in interval.refs:
+            node.location = location
+
+    used = [interval.register for interval in intervals if interval.register is not None]
+    saved = [register for register in CALLEE_SAVED_REGISTERS if register in used]
+    temporaries = [register for register in CALLER_SAVED_REGISTERS if register not in used]
+    call_saves = {}
+    for call, point in liveness.calls:
+        call_saves[call] = [interval.register for interval in intervals
+                            if interval.register is not None and interval.register in CALLER_SAVED_REGISTERS
+                            and interval.start < point <= interval.end]
+    return Allocation(stack_counter, saved, loads, temporaries, call_saves)
@@ -0,0 +1,285 @@
+"""
+Parallel replacement for tests.sh and badtests.sh.
+
+Every .lat file in the good directories is compiled, assembled with nasm, linked against the runtime and run; its
+output is compared with the .output file next to it (stdin comes from the .input file if there is one). Every .lat
+file in the bad directories must be rejected by the compiler. The runtime (defaults.asm and the C helpers in ctest/)
+is the static archive cached by latc.py, tests are spread over a process pool and a JSON or JUnit summary with
+per-stage timings can be written for CI.
+
+With --compare-parsers nothing is compiled: every .lat file of both kinds is parsed by the lark grammar and by the
+hand-written parser, which have to agree on the whole AST with positions, or on the position of the syntax error.
+
+Usage: python run_tests.py [-j N] [--shard I/N] [--timeout SEC] [--json FILE] [--junit FILE] [--parser lark|fast]
+                           [--compare-parsers] [--good DIR...] [--bad DIR...]
+"""
+import argparse
+import glob
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from xml.etree import ElementTree
+
+import latc
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+GOOD_DIRS = ['sttests/good/basic', 'sttests/good/virtual', 'sttests/gr5', 'lattests/good',
+             'lattests/extensions/struct', 'lattests/extensions/objects*']
+BAD_DIRS = ['sttests/bad/semantic', 'lattests/bad']
+
+_options = None
+
+
+class StageTimeout(Exception):
+    pass
+
+
+def build_runtime(cache_dir=latc.CACHE_DIR):
+    """
+    Builds the runtime archive unless latc.py has it cached already.
+    :return: list of files to link every test with
+    """
+    path, _ = latc.runtime_archive(latc.ArtifactCache(cache_dir))
+    return [path]
+
+
+def find_tests(patterns, kind):
+    tests = []
+    for pattern in patterns:
+        for directory in sorted(glob.glob(os.path.join(ROOT, pattern))):
+            for path in sorted(glob.glob(os.path.join(directory, '*.lat'))):
+                tests.append((kind, path))
+    return tests
+
+
+def shard(tests, spec):
+    index, count = [int(x) for x in spec.split('/')]
+    if not 0 <= index < count:
+        raise ValueError('Shard index should be in range [0, {})'.format(count))
+    return tests[index::count]
+
+
+def _init_worker(parser_kind='lark', backend='ast'):
+    global _options
+    import grammar_test
+    _options = grammar_test.CompileOptions(parser_kind, backend=backend)
+    grammar_test.shared_parser(parser_kind)
+
+
+def _on_alarm(signum, frame):
+    raise StageTimeout()
+
+
+def _compile(source):
+    import grammar_test
+
+    result = grammar_test.compile_source(source, _options)
+    return result.asm, None if result.ok else str(result.diagnostics[0])
+
+
+def run_test(kind, path, runtime, timeout):
+    """
+    Runs the whole pipeline for one test. Stages share the per-test time limit.
+    :return: dict with status ('pass', 'fail', 'error' or 'timeout'), message and per-stage timings
+    """
+    base = path[:-4]
+    result = {'name': os.path.relpath(path, ROOT), 'kind': kind, 'status': 'pass', 'message': '', 'timings': {}}
+    deadline = time.monotonic() + timeout
+
+    def remaining():
+        left = deadline - time.monotonic()
+        if left <= 0:
+            raise StageTimeout()
+        return left
+
+    def stage(name, fun):
+        start = time.perf_counter()
+        try:
+            return fun()
+        finally:
+            result['timings'][name] = round(time.perf_counter() - start, 6)
+
+    def run(args, stdin=None):
+        return subprocess.run(args, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              timeout=remaining())
+
+    current = 'compile'
+    try:
+        with open(path) as f:
+            source = f.read()
+
+        signal.signal(signal.SIGALRM, _on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, remaining())
+        try:
+            asm, error = stage('compile', lambda: _compile(source))
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+        if kind == 'bad':
+            if error is None:
+                result['status'] = 'fail'
+                result['message'] = 'error not found'
+            else:
+                result['message'] = error
+            return result
+
+        if error is not None:
+            result['status'] = 'fail'
+            result['message'] = error
+            return result
+
+        with open(base + '.s', 'w') as f:
+            f.write(asm)
+
+        for current, args in [('nasm', latc.NASM + [base + '.s', '-o', base + '.o']),
+                              ('link', latc.LINK + ['-o', base, base + '.o'] + runtime)]:
+            process = stage(current, lambda: run(args))
+            if process.returncode != 0:
+                result['status'] = 'error'
+                result['message'] = process.stdout.decode('utf-8', 'replace')
+                return result
+
+        current = 'run'
+        input_path = base + '.input' if os.path.exists(base + '.input') else os.devnull
+        with open(input_path, 'rb') as stdin:
+            process = stage('run', lambda: run([base], stdin))
+        with open(base + '.myout', 'wb') as f:
+            f.write(process.stdout)
+
+        with open(base + '.output', 'rb') as f:
+            expected = f.read()
+        if process.stdout != expected:
+            result['status'] = 'fail'
+            result['message'] = 'DIFF {}'.format(result['name'])
+    except (StageTimeout, subprocess.TimeoutExpired):
+        result['status'] = 'timeout'
+        result['message'] = 'timeout in stage {}'.format(current)
+    except Exception as e:
+        result['status'] = 'error'
+        result['message'] = '{}: {}'.format(e.__class__.__name__, e)
+    return result
+
+
+def _parse_outline(parser, source):
+    """
+    :return: Program.outline() or the position of the syntax error
+    """
+    import grammar_test
+
+    try:
+        program = parser.parse(source)
+    except grammar_test.SYNTAX_ERRORS as e:
+        return grammar_test.syntax_error_message(e)
+    return program.outline()
+
+
+def compare_parsers(kind, path):
+    """
+    Parses a file with the lark and the hand-written parser.
+    :return: result dict like run_test, status 'fail' and the first difference when the parsers disagree
+    """
+    import grammar_test
+
+    result = {'name': os.path.relpath(path, ROOT), 'kind': kind, 'status': 'pass', 'message': '', 'timings': {}}
+    with open(path) as f:
+        source = f.read()
+
+    outlines = {}
+    for parser_kind in grammar_test.PARSERS:
+        parser = grammar_test.shared_parser(parser_kind)
+        start = time.perf_counter()
+        outlines[parser_kind] = _parse_outline(parser, source)
+        result['timings'][parser_kind] = round(time.perf_counter() - start, 6)
+
+    expected, actual = outlines['lark'], outlines['fast']
+    if expected != actual:
+        result['status'] = 'fail'
+        if isinstance(expected, str) or isinstance(actual, str):
+            result['message'] = 'lark: {}, fast: {}'.format(
+                expected if isinstance(expected, str) else 'parsed', actual if isinstance(actual, str) else 'parsed')
+        else:
+            index = next((i for i, (a, b) in enumerate(zip(expected, actual)) if a != b),
+                         min(len(expected), len(actual)))
+            result['message'] = 'node {}: lark {} fast {}'.format(
+                index, expected[index] if index < len(expected) else None,
+                actual[index] if index < len(actual) else None)
+    return result
+
+
+def write_json(results, path, wall_time):
+    summary = {status: sum(1 for r in results if r['status'] == status)
+               for status in ['pass', 'fail', 'error', 'timeout']}
+    with open(path, 'w') as f:
+        json.dump({'summary': summary, 'wall_time': round(wall_time, 6), 'tests': results}, f, indent=2)
+
+
+def write_junit(results, path, wall_time):
+    suite = ElementTree.Element('testsuite', name='latte', tests=str(len(results)),
+                                failures=str(sum(1 for r in results if r['status'] == 'fail')),
+                                errors=str(sum(1 for r in results if r['status'] in ('error', 'timeout'))),
+                                time='{:.6f}'.format(wall_time))
+    for r in results:
+        case = ElementTree.SubElement(suite, 'testcase', classname=r['kind'], name=r['name'],
+                                      time='{:.6f}'.format(sum(r['timings'].values())))
+        if r['status'] == 'fail':
+            ElementTree.SubElement(case, 'failure', message=r['message'])
+        elif r['status'] != 'pass':
+            ElementTree.SubElement(case, 'error', message=r['message'])
+        ElementTree.SubElement(case, 'system-out').text = json.dumps(r['timings'])
+    ElementTree.ElementTree(suite).write(path, encoding='utf-8', xml_declaration=True)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Run Latte compiler tests in parallel')
+    arg_parser.add_argument('--good', nargs='*', default=GOOD_DIRS, help='directories with programs to run')
+    arg_parser.add_argument('--bad', nargs='*', default=BAD_DIRS, help='directories with programs to reject')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+    arg_parser.add_argument('--shard', metavar='I/N', help='run only the I-th of N slices of the tests')
+    arg_parser.add_argument('--timeout', type=float, default=10, help='time limit for one test in seconds')
+    arg_parser.add_argument('--json', metavar='FILE', help='write JSON summary')
+    arg_parser.add_argument('--junit', metavar='FILE', help='write JUnit XML summary')
+    arg_parser.add_argument('--parser', choices=['lark', 'fast'], default='lark', help='front end of the compiler')
+    arg_parser.add_argument('--backend', choices=['ast', 'ir'], default='ast', help='code generator of the compiler')
+    arg_parser.add_argument('--compare-parsers', action='store_true',
+                            help='only parse the tests with both front ends and compare the ASTs')
+    options = arg_parser.parse_args()
+
+    tests = find_tests(options.good, 'good') + find_tests(options.bad, 'bad')
+    if options.shard:
+        tests = shard(tests, options.shard)
+
+    start = time.perf_counter()
+    compare = options.compare_parsers
+    runtime = build_runtime() if not compare and any(kind == 'good' for kind, _ in tests) else []
+
+    with ProcessPoolExecutor(options.jobs, initializer=_init_worker,
+                             initargs=('lark' if compare else options.parser, options.backend)) as pool:
+        if compare:
+            futures = [pool.submit(compare_parsers, kind, path) for kind, path in tests]
+        else:
+            futures = [pool.submit(run_test, kind, path, runtime, options.timeout) for kind, path in tests]
+        results = []
+        for future in futures:
+            result = future.result()
+            if result['status'] != 'pass':
+                print(result['status'].upper(), result['name'], result['message'])
+            results.append(result)
+    wall_time = time.perf_counter() - start
+
+    if options.json:
+        write_json(results, options.json, wall_time)
+    if options.junit:
+        write_junit(results, options.junit, wall_time)
+
+    failed = sum(1 for r in results if r['status'] != 'pass')
+    print('{} tests, {} failed, {:.2f}s'.format(len(results), failed, wall_time))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,38 +1,46 @@
 from abc import ABCMeta, abstractmethod
-from typing import List
 
-from compiler import BaseBase, RedefinitionException, TypeException, RegisterLocation, \
-    Counter, not_so_deep_copy
+from asm import Instruction, Memory, RAX, RBX, RBP, RSP
+from compiler import BaseBase, RedefinitionException, TypeException, RegisterLocation, copy_env
 from type import INT_TYPE, VOID_TYPE, BOOL_TYPE, is_type_matching, get_size
 import compiler
+import ir
+import regalloc
 
 
 class StmtBase(BaseBase):
     __metaclass__ = ABCMeta
+    __slots__ = ()
 
     @abstractmethod
-    def compile(self) -> List[str]:
+    def compile(self, out):
         raise NotImplementedError()
 
 
 class BlockStmt(StmtBase):
+    __slots__ = ('block',)
+
     def __init__(self, block):
         self.block = block
 
     def check_correctness(self, env):
-        block_env = self.block.check_correctness(env)
-        env = not_so_deep_copy(env)
+        block_env = yield self.block.check_correctness(env)
+        env = copy_env(env)
 
         env['was_return'] = env['was_return'] or block_env['was_return']
         env['stack_counter'] = block_env['stack_counter']
-        env['strings'].update(block_env['strings'].items())
         return env
 
-    def compile(self):
-        return self.block.compile()
+    def compile(self, out):
+        return self.block.compile(out)
+
+    def lower(self, fn):
+        return self.block.lower(fn)
 
 
 class DeclStmt(StmtBase):
+    __slots__ = ('type', 'vars')
+
     def __init__(self, type, vars):
         self.type = type
         self.vars = vars
@@ -43,115 +51,185 @@ class DeclStmt(StmtBase):
                 if env['var'][var.name]['level'] == env['level']:
                     raise RedefinitionException('Variable {} redefined'.format(var.name), self)
             try:
-                env = var.check_correctness(env)
+                env = yield var.check_correctness(env)
             except compiler.CompilerException as e:
                 raise compiler.CompilerException(e.rlmsg, self)
         return env
 
-    def compile(self):
-        result = []
+    def compile(self, out):
         for var in self.vars:
-            result += var.compile()
-        return result
+            yield var.compile(out)
+
+    def lower(self, fn):
+        for var in self.vars:
+            yield var.lower(fn)
 
 
 class AsgStmt(StmtBase):
+    __slots__ = ('expr', 'value', 'type')
+
     def __init__(self, expr, value):
         self.expr = expr
         self.value = value
         self.type = None
 
     def check_correctness(self, env):
-        var_type = self.expr.get_type(env)
-        val_type = self.value.get_type(env)
+        var_type = yield self.expr.get_type(env)
+        val_type = yield self.value.get_type(env)
         self.type = var_type
         if not self.expr.is_reference() or not is_type_matching(var_type, val_type, env):
             raise TypeException(
                 'Right side has type {} but tried to assign value of type {}'.format(var_type, val_type), self)
         return env
 
-    def compile(self) -> List[str]:
+    def compile(self, out):
+        target = getattr(self.expr, 'location', None)
+        if isinstance(target, RegisterLocation):
+            return (yield self.compile_to_register(target, out))
+
         r1 = RegisterLocation('eax', 'rax')
         r2 = RegisterLocation('ebx', 'rbx')
-        result = ['push rax', 'push rbx']
-        result += self.expr.get_reference(r1)
+        out.emit(Instruction('push', RAX), Instruction('push', RBX))
+        yield self.expr.get_reference(r1, out)
+
+        yield self.value.mov_to_register(r2, out)
+        out.emit(Instruction('mov', Memory(r1.full_name), r2.sized(get_size(self.type))),
+                 Instruction('pop', RBX),
+                 Instruction('pop', RAX))
+
+    def compile_to_register(self, target, out):
+        """
+        Assignment to a variable kept in a register. The value is computed in the register itself unless it reads
+        the variable, which would be overwritten before it is read.
+        """
+        if not regalloc.uses(self.value, target):
+            return (yield self.value.mov_to_register(target, out))
+
+        r = out.temporary()
+        if r is not None:
+            yield self.value.mov_to_register(r, out)
+            out.emit(Instruction('mov', target.full, r.full))
+            return
 
-        if get_size(self.type) == 4:
-            register = 'ebx'
+        r = RegisterLocation('eax', 'rax')
+        out.emit(Instruction('push', RAX))
+        yield self.value.mov_to_register(r, out)
+        out.emit(Instruction('mov', target.full, RAX),
+                 Instruction('pop', RAX))
+
+    def lower(self, fn):
+        base, place = yield self.expr.lower_reference(fn)
+        value = yield self.value.lower(fn)
+        if base is None:
+            fn.emit('copy', place, [value])
         else:
-            register = 'rbx'
+            fn.emit('store', args=[base, value], target=place)
+
 
-        result += self.value.mov_to_register(r2) + \
-                  ['mov [{}], {}'.format(r1.full_name, register),
-                   'pop rbx',
-                   'pop rax']
-        return result
+def lower_increment(expr, op, fn):
+    """
+    Lowering of ++ and --, op is 'add' or 'sub'.
+    """
+    base, place = yield expr.lower_reference(fn)
+    if base is None:
+        fn.emit(op, place, [place, ir.Const(1)])
+        return
+    value = fn.emit('load', fn.temp(4), [base], place)
+    fn.emit('store', args=[base, fn.emit(op, fn.temp(4), [value, ir.Const(1)])], target=place)
 
 
 class PPStmt(StmtBase):
+    __slots__ = ('expr', 'location')
+
     def __init__(self, expr):
         self.expr = expr
         self.location = None
 
     def check_correctness(self, env):
-        if self.expr.get_type(env) != INT_TYPE:
+        if (yield self.expr.get_type(env)) != INT_TYPE:
             raise TypeException('Right side has inproper type. Only int variables can be ++', self)
 
         return env
 
-    def compile(self):
+    def compile(self, out):
+        target = getattr(self.expr, 'location', None)
+        if isinstance(target, RegisterLocation):
+            out.emit(Instruction('inc', target.register))
+            return
+
         r = RegisterLocation('eax', 'rax')
 
-        result = ['push rax']
-        result += self.expr.get_reference(r)
+        out.emit(Instruction('push', RAX))
+        yield self.expr.get_reference(r, out)
 
-        return result + ['inc DWORD [rax]', 'pop rax']
+        out.emit(Instruction('inc', Memory('rax', 0, 4)), Instruction('pop', RAX))
+
+    def lower(self, fn):
+        return lower_increment(self.expr, 'add', fn)
 
 
 class MMStrmt(StmtBase):
+    __slots__ = ('expr', 'location')
+
     def __init__(self, expr):
         self.expr = expr
         self.location = None
 
     def check_correctness(self, env):
-        if self.expr.get_type(env) != INT_TYPE:
+        if (yield self.expr.get_type(env)) != INT_TYPE:
             raise TypeException('Right side has inproper type. Only int variables can be --', self)
 
         return env
 
-    def compile(self):
+    def compile(self, out):
+        target = getattr(self.expr, 'location', None)
+        if isinstance(target, RegisterLocation):
+            out.emit(Instruction('dec', target.register))
+            return
+
         r = RegisterLocation('eax', 'rax')
 
-        result = ['push rax']
-        result += self.expr.get_reference(r)
+        out.emit(Instruction('push', RAX))
+        yield self.expr.get_reference(r, out)
 
-        return result + ['dec DWORD [rax]', 'pop rax']
+        out.emit(Instruction('dec', Memory('rax', 0, 4)), Instruction('pop', RAX))
+
+    def lower(self, fn):
+        return lower_increment(self.expr, 'sub', fn)
 
 
 class RetVoidStmt(StmtBase):
+    __slots__ = ()
+
     def check_correctness(self, env):
         if env['current_fun'][1] != VOID_TYPE:
             raise TypeException(
                 'Tried to return without value from non-void function {} {}'.format(*env['current_fun']), self)
 
-        env = not_so_deep_copy(env)
+        env = copy_env(env)
         env['was_return'] = True
         return env
 
-    def compile(self):
-        return ['mov rsp, rbp',
-                'pop rbp',
-                'ret']
+    def compile(self, out):
+        out.extend(out.restore)
+        out.emit(Instruction('mov', RSP, RBP),
+                 Instruction('pop', RBP),
+                 Instruction('ret'))
+
+    def lower(self, fn):
+        fn.emit('ret')
 
 
 class RetValueStmt(StmtBase):
+    __slots__ = ('value',)
+
     RESULT_REGISTER = RegisterLocation('eax', 'rax')
 
     def __init__(self, value):
         self.value = value
 
     def check_correctness(self, env):
-        t = self.value.get_type(env)
+        t = yield self.value.get_type(env)
 
         if t == VOID_TYPE:
             raise TypeException("Cannot return void value", self)
@@ -160,85 +238,101 @@ class RetValueStmt(StmtBase):
             raise TypeException('Tried to return wrong type {} from {} instead of {}'.format(t, *env['current_fun']),
                                 self)
 
-        env = not_so_deep_copy(env)
+        env = copy_env(env)
         env['was_return'] = True
         return env
 
-    def compile(self):
+    def compile(self, out):
 
-        return self.value.mov_to_register(self.RESULT_REGISTER) + [
-            'mov rsp, rbp',
-            'pop rbp',
-            'ret'
-        ]
+        yield self.value.mov_to_register(self.RESULT_REGISTER, out)
+        out.extend(out.restore)
+        out.emit(Instruction('mov', RSP, RBP),
+                 Instruction('pop', RBP),
+                 Instruction('ret'))
+
+    def lower(self, fn):
+        value = yield self.value.lower(fn)
+        fn.emit('ret', args=[value])
 
 
 class IfStmt(StmtBase):
+    __slots__ = ('cond', 'stmt')
+
     def __init__(self, cond, stmt):
         self.cond = cond
         self.stmt = stmt
 
     def check_correctness(self, env):
-        if self.cond.get_type(env) != BOOL_TYPE:
+        if (yield self.cond.get_type(env)) != BOOL_TYPE:
             raise TypeException('If condition should be bool', self)
 
         if self.stmt.__class__.__name__ == 'DeclStmt':
             raise TypeException('Declaration as only statement in "if" is not supported', self)
-        env = not_so_deep_copy(env)
-        new_env = self.stmt.check_correctness(env)
+        env = copy_env(env)
+        new_env = yield self.stmt.check_correctness(env)
 
         try:
-            if self.cond.get_real_value():
+            if self.cond.get_condition_value():
                 env['was_return'] = env['was_return'] or new_env['was_return']
         except AttributeError:
             pass
-        env['strings'].update(new_env['strings'].items())
         env['stack_counter'] = new_env['stack_counter']
 
         return env
 
-    def compile(self):
-        l_true = 'L{}'.format(Counter.get())
-        l_end = 'L{}'.format(Counter.get())
-        return self.cond.boolean_jmp(l_true, l_end) + \
-               [l_true + ':'] + \
-               self.stmt.compile() + \
-               [l_end + ':']
+    def compile(self, out):
+        l_true = out.new_label()
+        l_end = out.new_label()
+        yield self.cond.boolean_jmp(l_true, l_end, out)
+        out.emit(l_true)
+        yield self.stmt.compile(out)
+        out.emit(l_end)
+
+    def lower(self, fn):
+        body, end = fn.new_block(), fn.new_block()
+        yield self.cond.lower_jump(fn, body, end)
+        fn.start(body)
+        yield self.stmt.lower(fn)
+        fn.start(end)
 
 
 class EmptyStmt(StmtBase):
-    def compile(self):
-        return []
+    __slots__ = ()
+
+    def compile(self, out):
+        pass
+
+    def lower(self, fn):
+        pass
 
     def check_correctness(self, env):
         return env
 
 
 class IfElseStmt(StmtBase):
+    __slots__ = ('cond', 'stmt1', 'stmt2')
+
     def __init__(self, cond, stmt1, stmt2):
         self.cond = cond
         self.stmt1 = stmt1
         self.stmt2 = stmt2
 
     def check_correctness(self, env):
-        if self.cond.get_type(env) != BOOL_TYPE:
+        if (yield self.cond.get_type(env)) != BOOL_TYPE:
             raise TypeException('If condition should be bool', self)
 
         if self.stmt1.__class__.__name__ == 'DeclStmt' or self.stmt2.__class__.__name__ == 'DeclStmt':
             raise TypeException('Declaration as only statement in "if" is not supported', self)
 
-        env = not_so_deep_copy(env)
+        env = copy_env(env)
 
-        env1 = self.stmt1.check_correctness(env)
+        env1 = yield self.stmt1.check_correctness(env)
         env['stack_counter'] = env1['stack_counter']
-        env2 = self.stmt2.check_correctness(env)
+        env2 = yield self.stmt2.check_correctness(env)
         env2['stack_counter'] = env2['stack_counter']
 
-        env['strings'].update(env1['strings'])
-        env['strings'].update(env2['strings'])
-
         try:
-            if self.cond.get_real_value():
+            if self.cond.get_condition_value():
                 env['was_return'] = env['was_return'] or env1['was_return']
             else:
                 env['was_return'] = env['was_return'] or env2['was_return']
@@ -247,66 +341,93 @@ class IfElseStmt(StmtBase):
 
         return env
 
-    def compile(self):
-        l_true = 'L{}'.format(Counter.get())
-        l_false = 'L{}'.format(Counter.get())
-        l_end = 'L{}'.format(Counter.get())
-        return self.cond.boolean_jmp(l_true, l_false) + \
-               [l_true + ':'] + \
-               self.stmt1.compile() + \
-               ['jmp {}'.format(l_end),
-                l_false + ':'] + \
-               self.stmt2.compile() + \
-               [l_end + ':']
+    def compile(self, out):
+        l_true = out.new_label()
+        l_false = out.new_label()
+        l_end = out.new_label()
+        yield self.cond.boolean_jmp(l_true, l_false, out)
+        out.emit(l_true)
+        yield self.stmt1.compile(out)
+        out.emit(Instruction('jmp', l_end),
+                 l_false)
+        yield self.stmt2.compile(out)
+        out.emit(l_end)
+
+    def lower(self, fn):
+        then, otherwise, end = fn.new_block(), fn.new_block(), fn.new_block()
+        yield self.cond.lower_jump(fn, then, otherwise)
+        fn.start(then)
+        yield self.stmt1.lower(fn)
+        fn.jump(end)
+        fn.start(otherwise)
+        yield self.stmt2.lower(fn)
+        fn.start(end)
 
 
 class WhileStmt(StmtBase):
+    __slots__ = ('cond', 'stmt')
+
     def __init__(self, cond, stmt):
         self.cond = cond
         self.stmt = stmt
 
     def check_correctness(self, env):
-        if self.cond.get_type(env) != BOOL_TYPE:
+        if (yield self.cond.get_type(env)) != BOOL_TYPE:
             raise TypeException('While condition should be bool', self)
         if self.stmt.__class__.__name__ == 'DeclStmt':
             raise TypeException('Declaration as only statement in "while" is not supported', self)
 
-        env = not_so_deep_copy(env)
+        env = copy_env(env)
 
-        new_env = self.stmt.check_correctness(env)
+        new_env = yield self.stmt.check_correctness(env)
         try:
-            if self.cond.get_real_value():
+            if self.cond.get_condition_value():
                 env['was_return'] = True
         except AttributeError:
             pass
-        env['strings'].update(new_env['strings'])
         env['stack_counter'] = new_env['stack_counter']
 
         return env
 
-    def compile(self):
-        l_start = 'L{}'.format(Counter.get())
-        l_cond = 'L{}'.format(Counter.get())
-        l_end = 'L{}'.format(Counter.get())
-        return ['jmp {}'.format(l_cond),
-                l_start + ':'] + \
-               self.stmt.compile() + \
-               [l_cond + ':'] + \
-               self.cond.boolean_jmp(l_start, l_end) + \
-               [l_end + ':']
+    def compile(self, out):
+        l_start = out.new_label()
+        l_cond = out.new_label()
+        l_end = out.new_label()
+        out.emit(Instruction('jmp', l_cond),
+                 l_start)
+        yield self.stmt.compile(out)
+        out.emit(l_cond)
+        yield self.cond.boolean_jmp(l_start, l_end, out)
+        out.emit(l_end)
+
+    def lower(self, fn):
+        body, cond, end = fn.new_block(), fn.new_block(), fn.new_block()
+        fn.jump(cond)
+        fn.start(body)
+        yield self.stmt.lower(fn)
+        fn.start(cond)
+        yield self.cond.lower_jump(fn, body, end)
+        fn.start(end)
 
 
 class ExprStmt(StmtBase):
+    __slots__ = ('expr',)
+
     def __init__(self, expr):
         self.expr = expr
 
     def check_correctness(self, env):
-        self.expr.get_type(env)
+        yield self.expr.get_type(env)
         return env
 
-    def compile(self):
+    def compile(self, out):
         r = RegisterLocation('eax', 'rax')
-        return ['push rax'] + self.expr.mov_to_register(r) + ['pop rax']
+        out.emit(Instruction('push', RAX))
+        yield self.expr.mov_to_register(r, out)
+        out.emit(Instruction('pop', RAX))
+
+    def lower(self, fn):
+        yield self.expr.lower(fn)
 
 
 compiler.RETURN_VOID = RetVoidStmt()
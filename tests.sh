@@ -1,6 +1,4 @@
 #set -e
-nasm -f elf64 -F dwarf -g defaults.asm -o ctest/defaults.o
-
 source venv/bin/activate
 
 DIR=sttests/gr5/
@@ -15,11 +13,7 @@ for d in $DIR/* ; do
     then
        echo checking $d
         y=${d%.lat}
-        python grammar_test.py $d 
-
-        nasm -f elf64 -F dwarf -g ${y}.s
-
-        gcc -o ${y} ctest/testmain.c ctest/strcnc.c ${y}.o ctest/defaults.o
+        python latc.py $d -o ${y}
 
         INPT=${y}.input
         if [ ! -f $INPT ]; then
@@ -1,18 +1,34 @@
 class Type:
-    def __init__(self, type_name):
+    """
+    Types are interned: Type(name) returns the same object for the same name, so types are compared by identity
+    and their sizes are computed only once.
+    """
+    REGISTRY = {}
+    SIZES = {'int': 4, 'bool': 4, 'string': 8}
+    PRIMITIVES = ('int', 'bool', 'string')
+
+    def __new__(cls, type_name):
         if not isinstance(type_name, str):
             raise AttributeError('Only string should be type name')
+
+        try:
+            return Type.REGISTRY[type_name]
+        except KeyError:
+            pass
+
+        self = super().__new__(cls)
         self.type_name = type_name
+        self.size = Type.SIZES.get(type_name, 8)
+        self.is_primitive = type_name in Type.PRIMITIVES
+        Type.REGISTRY[type_name] = self
+        return self
+
+    def __reduce__(self):
+        return Type, (self.type_name,)
 
     def __repr__(self):
         return self.type_name
 
-    def __eq__(self, other):
-        return self.type_name == other.type_name
-
-    def __hash__(self):
-        return hash(self.type_name)
-
 
 INT_TYPE = Type('int')
 BOOL_TYPE = Type('bool')
@@ -22,37 +38,28 @@ NULL_TYPE = Type('null')
 
 
 def get_size(type):
-    try:
-        return {INT_TYPE: 4,
-                BOOL_TYPE: 4,
-                STRING_TYPE: 8}[type]
-    except KeyError:
-        return 8
+    return type.size
 
 
 def is_type_matching(var_type, val_type, env):
-    if var_type == val_type:
+    if var_type is val_type:
         return True
 
-    if var_type in [INT_TYPE, STRING_TYPE, BOOL_TYPE] or val_type in [INT_TYPE, STRING_TYPE, BOOL_TYPE]:
+    if var_type.is_primitive or val_type.is_primitive:
         return False
 
-    if val_type == NULL_TYPE:
+    if val_type is NULL_TYPE:
         return True
 
     try:
-        parent = env['cls'][val_type.type_name].parent
+        ancestors = env['cls'][val_type.type_name].ancestors
     except KeyError:
         raise Exception("Class {} not defined".format(val_type))
-    if parent is None:
-        return False
-    else:
-        # print('Warning, recursion')
-        return is_type_matching(var_type, Type(parent), env)
+    return var_type.type_name in ancestors
 
 
 def can_be_casted(type_from, type_to, env):
-    if type_from == NULL_TYPE and type_to.type_name in env['cls']:
+    if type_from is NULL_TYPE and type_to.type_name in env['cls']:
         return True
 
     return is_type_matching(type_to, type_from, env)